@@ -1,15 +1,23 @@
 # backend/app.py
-import os, io, uuid, re, difflib
-from typing import Dict, List, Optional
+import os, re, uuid, json, codecs, asyncio, difflib, tempfile
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Tuple
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from dotenv import load_dotenv
 from pypdf import PdfReader
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+
+from backend.concurrency import run_cpu, run_llm_blocking, call_llm, stream_llm
+from backend.sessions import make_store
+from backend.lexical import LexicalIndex
+from backend.scoring import top_k_indices, sparse_scores
+from backend.filters import parse_filters
+from backend.chunking import StreamChunker
+from backend.jobs import JobQueue, JobQueueFull, JobError, DONE, FAILED
 
 # ====== load env ======
 load_dotenv()
@@ -17,11 +25,16 @@ HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "8000"))
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+# larger uploads are rejected with 413
+UPLOAD_MAX_BYTES = int(float(os.getenv("UPLOAD_MAX_MB", "100")) * 1024 * 1024)
+# uploads are spooled for the indexing job; beyond this they go to a temp file on disk
+UPLOAD_SPOOL_BYTES = int(float(os.getenv("UPLOAD_SPOOL_MB", "2")) * 1024 * 1024)
+UPLOAD_READ_BYTES = 1024 * 1024   # copy / decode granularity
 
 # ====== import your RAG pipeline for /query ======
 # (Keep this if you want the multi-doc FAISS/Gemini path too)
 try:
-    from backend.rag_pipeline import query_pipeline  # Step 4 code
+    from backend.rag_pipeline import aquery_pipeline, aquery_batch_pipeline, aquery_stream, get_service  # Step 4 code
     HAVE_RAG_PIPELINE = True
     print("✓ RAG pipeline imported successfully")
 except Exception as e:
@@ -42,12 +55,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _sse_stream(events):
+    async for event, data in events:
+        yield _sse(event, data)
+    yield _sse("done", {})
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(_sse_stream(events), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Load the FAISS index / encoder once per process instead of per request
+@app.on_event("startup")
+async def _warm_retrieval_service():
+    if not HAVE_RAG_PIPELINE:
+        return
+    try:
+        await run_cpu(get_service().load)
+        print("✓ Retrieval service loaded")
+    except Exception as e:
+        # no index built yet — /query will retry on first use
+        print(f"✗ Retrieval service not loaded: {e}")
+
 # -------------------------------------------------
 # Health
 # -------------------------------------------------
 @app.get("/healthz")
-def healthz():
-    return {"ok": True, "message": "healthy"}
+async def healthz():
+    out = {"ok": True, "message": "healthy"}
+    if HAVE_RAG_PIPELINE:
+        out["index"] = get_service().info()
+    out["sessions"] = SESSIONS.stats()
+    out["uploads"] = UPLOADS.stats()
+    return out
 
 # -------------------------------------------------
 # /query (multi-document RAG) — optional
@@ -56,19 +98,54 @@ if HAVE_RAG_PIPELINE:
     class QueryIn(BaseModel):
         q: str
         k: Optional[int] = 8
+        retrieve_only: Optional[bool] = False  # skip generation; never waits on the LLM
+        stream: Optional[bool] = False         # Server-Sent Events: citations, tokens, verdict
+        # e.g. {"source": "a.pdf", "page": {"gte": 3, "lte": 7}, "modified": {"gte": "2024-01-01"}}
+        filters: Optional[Dict[str, Any]] = None
+
+    def _parse_filters(spec: Optional[Dict[str, Any]]) -> Optional[Dict]:
+        try:
+            return parse_filters(spec)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
     @app.post("/query")
-    def query(inp: QueryIn):
+    async def query(inp: QueryIn):
         if not inp.q or not inp.q.strip():
             raise HTTPException(status_code=400, detail="q must be a non-empty string")
-        return query_pipeline(inp.q, k=inp.k or 8)
+        filters = _parse_filters(inp.filters)
+        if inp.stream and not inp.retrieve_only:
+            return _sse_response(aquery_stream(inp.q, k=inp.k or 8, filters=filters))
+        return await aquery_pipeline(inp.q, k=inp.k or 8, retrieve_only=bool(inp.retrieve_only), filters=filters)
+
+    class QueryBatchIn(BaseModel):
+        qs: List[str]
+        k: Optional[int] = 8
+        retrieve_only: Optional[bool] = False
+        filters: Optional[Dict[str, Any]] = None   # applied to every question
+
+    MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "64"))
+
+    @app.post("/query/batch")
+    async def query_batch(inp: QueryBatchIn):
+        if not inp.qs or any(not q or not q.strip() for q in inp.qs):
+            raise HTTPException(status_code=400, detail="qs must be a non-empty list of non-empty strings")
+        if len(inp.qs) > MAX_BATCH_QUERIES:
+            raise HTTPException(status_code=400, detail=f"at most {MAX_BATCH_QUERIES} questions per batch")
+        filters = _parse_filters(inp.filters)
+        results = await aquery_batch_pipeline(inp.qs, k=inp.k or 8, retrieve_only=bool(inp.retrieve_only),
+                                              filters=filters)
+        return {"results": results}
 
 # -------------------------------------------------
 # Upload → Ask (single-file, per-session) — NEW
 # -------------------------------------------------
 
-# In-memory store: session_id -> {chunks, vectorizer, tfidf, meta}
-SESSIONS: Dict[str, Dict] = {}
+# session_id -> {chunks, vectorizer, tfidf, lexicon, meta}; bounded by SESSION_BUDGET_MB / SESSION_TTL_SECS
+SESSIONS = make_store()
+# background extraction + indexing of uploads; job id == session id. Status is
+# also published to the session backend so every worker can report it.
+UPLOADS = JobQueue(on_change=lambda job: SESSIONS.put_status(job.id, job.snapshot()))
 
 # ---- Helpers ----
 def _clean_text(s: str) -> str:
@@ -120,13 +197,19 @@ def _closest_token(token: str, vocab_words: List[str]) -> str:
     match = difflib.get_close_matches(token.lower(), vocab_words, n=1, cutoff=0.8)
     return match[0] if match else token.lower()
 
-def _correct_short_query_tokens(q: str, vec) -> str:
+def _correct_short_query_tokens(q: str, vec, lex: Optional[LexicalIndex] = None) -> str:
     """
     For very short queries, correct each token to the nearest vocabulary term.
+    With the session's LexicalIndex only unigrams are candidates and the
+    lookup touches a handful of words instead of the whole vocabulary.
     """
     tokens = (q or "").lower().split()
     if not tokens:
         return q
+    if lex is not None:
+        if not lex.vocab:
+            return q
+        return " ".join(lex.closest(t) or t for t in tokens)
     # build a small vocab list only once
     vocab_words = list(getattr(vec, "vocabulary_", {}).keys()) or []
     if not vocab_words:
@@ -134,34 +217,33 @@ def _correct_short_query_tokens(q: str, vec) -> str:
     corrected = [_closest_token(t, vocab_words) for t in tokens]
     return " ".join(corrected)
 
-def _extract_pdf(file_bytes: bytes) -> str:
-    reader = PdfReader(io.BytesIO(file_bytes))
-    pages = []
-    for p in reader.pages:
-        txt = p.extract_text() or ""
-        pages.append(txt)
-    return "\n\n".join(pages)
+def _iter_pdf_pages(reader: PdfReader) -> Iterator[Tuple[str, Dict]]:
+    """(page text, progress) one page at a time; pages end with a paragraph break."""
+    total = len(reader.pages)
+    for n, p in enumerate(reader.pages, start=1):
+        yield (p.extract_text() or "") + "\n\n", {"pages_done": n, "pages_total": total}
 
-def _extract_txt(file_bytes: bytes) -> str:
-    try:
-        return file_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        return file_bytes.decode("latin-1", errors="ignore")
-
-def _chunk_text(text: str, max_words: int = 220, overlap: int = 40) -> List[str]:
-    words = text.split()
-    if not words:
-        return []
-    chunks, i = [], 0
-    step = max_words - overlap if max_words > overlap else max_words
-    while i < len(words):
-        chunk = " ".join(words[i:i + max_words]).strip()
-        if chunk:
-            chunks.append(chunk)
-        if i + max_words >= len(words):
-            break
-        i += step
-    return chunks
+def _iter_txt_pieces(f: BinaryIO, total: int) -> Iterator[Tuple[str, Dict]]:
+    """
+    Decode UTF-8 (undecodable bytes dropped) a block at a time, each piece
+    cut at its last whitespace so no word straddles two pieces (a block
+    without any whitespace is passed on whole).
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    done = 0
+    carry = ""
+    while True:
+        block = f.read(UPLOAD_READ_BYTES)
+        done += len(block)
+        text = carry + decoder.decode(block, final=not block)
+        carry = ""
+        if block:
+            cut = max(text.rfind(c) for c in " \t\r\n") + 1
+            if cut:
+                text, carry = text[:cut], text[cut:]
+        yield text, {"bytes_done": done, "bytes_total": total}
+        if not block:
+            return
 
 def _build_index(chunks: List[str]):
     # Adjust parameters based on document size to avoid sklearn errors
@@ -178,31 +260,36 @@ def _build_index(chunks: List[str]):
         ngram_range=(1, 2),  # <-- important for short queries
     )
     X = vec.fit_transform(chunks)
+    # only kept for introspection; can be as large as the vocabulary itself
+    vec.stop_words_ = None
     return vec, X
 
-def _retrieve(vec, X, chunks: List[str], query: str, top_k: int = 6) -> List[Dict]:
+def _build_lexicon(chunks: List[str], vec) -> LexicalIndex:
+    return LexicalIndex(chunks, getattr(vec, "vocabulary_", {}))
+
+def _retrieve(vec, X, chunks: List[str], query: str, top_k: int = 6,
+              lex: Optional[LexicalIndex] = None) -> List[Dict]:
     original_q = _normalize_query(query)
+    if lex is None:
+        lex = _build_lexicon(chunks, vec)
 
     # correct typos for short queries using vectorizer vocabulary
-    corrected_q = _correct_short_query_tokens(original_q, vec)
+    corrected_q = _correct_short_query_tokens(original_q, vec, lex)
 
     # expand short queries with synonyms (you already added _expand_query_if_short)
     expanded_q = _expand_query_if_short(corrected_q)
 
     # cosine over expanded query
     qv = vec.transform([expanded_q])
-    sims = cosine_similarity(qv, X).ravel()
+    sims = sparse_scores(X, qv)
 
     # light lexical boost if very short and exact word appears
     tokens = corrected_q.split()
     is_short = (len(tokens) <= 2 or len(corrected_q) <= 12)
     if is_short and tokens:
-        for i, c in enumerate(chunks):
-            text_low = c.lower()
-            if any(t in text_low for t in tokens):
-                sims[i] += 0.15  # small bump for exact containment
+        sims[lex.contains_any(tokens)] += 0.15  # small bump for exact containment
 
-    idxs = sims.argsort()[::-1][:top_k]
+    idxs = top_k_indices(sims, top_k)
     out = []
     for rank, i in enumerate(idxs, start=1):
         out.append({
@@ -236,6 +323,88 @@ def _build_context(hits: List[Dict], *, max_blocks: int = 4, budget_chars: int =
         count += 1
     return "\n".join(buf)
 
+IDK = "I don't know based on the provided document."
+
+_GEMINI_SYSTEM = (
+    "You answer ONLY using the numbered CONTEXT blocks.\n"
+    "If the answer is not fully supported by CONTEXT, reply exactly:\n"
+    "\"I don't know based on the provided document.\"\n"
+    "Every factual sentence MUST include a bracket citation like [1] or [2]."
+)
+
+_GEMINI_RULES = (
+    "Rules:\n"
+    "1) Use only the provided CONTEXT.\n"
+    "2) 1–4 short sentences. Be concise.\n"
+    "3) Every sentence MUST include a citation [n].\n"
+    "4) If unsupported, say: I don't know based on the provided document."
+)
+
+_GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "top_p": 0.9,
+    "top_k": 40,
+    "max_output_tokens": 160,   # keep it tight
+}
+
+_GEMINI_MODEL = None
+
+def _gemini_model():
+    """Configure the Gemini client once per process and reuse the model handle."""
+    global _GEMINI_MODEL
+    if _GEMINI_MODEL is None and GOOGLE_API_KEY:
+        import google.generativeai as genai
+        genai.configure(api_key=GOOGLE_API_KEY)
+        _GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL, generation_config=_GENERATION_CONFIG)
+    return _GEMINI_MODEL
+
+def _answer_fallback(context: str) -> str:
+    # Short, safe extractive fallback (not the whole doc)
+    lines = [l for l in context.splitlines() if l and not l.startswith("[") and l not in ("BEGIN", "END")]
+    snippet = " ".join(lines)[:400]
+    return snippet or IDK
+
+def _gemini_prompt(question: str, context: str) -> str:
+    return (
+        f"{_GEMINI_SYSTEM}\n\n{_GEMINI_RULES}\n\n"
+        f"QUESTION:\n{question}\n\n"
+        f"CONTEXT (numbered blocks):\n{context}\n\n"
+        "Answer:"
+    )
+
+def _ground_check(raw: str, context: str, *, strict: bool = True) -> str:
+    """Apply the strict-grounding rules to a raw model answer."""
+    raw = (raw or "").strip()
+    if not raw:
+        return IDK
+    if not strict:
+        return raw
+
+    # Require at least one [n] citation
+    has_citation = re.search(r"\[\d+\]", raw) is not None
+
+    # Limit to 4 sentences max (split on . ! ?)
+    sentences = re.split(r"(?<=[.!?])\s+", raw.strip())
+    sentences = [s for s in sentences if s]
+    if len(sentences) > 4:
+        sentences = sentences[:4]
+    trimmed = " ".join(sentences)
+
+    # Require citations on each sentence
+    all_cited = all(re.search(r"\[\d+\]", s) for s in sentences)
+
+    # Simple overlap check: ensure significant token overlap with context
+    ctx_text = " ".join([l for l in context.splitlines() if not l.startswith("[")])
+    ctx_tokens = set(re.findall(r"[A-Za-z0-9]+", ctx_text.lower()))
+    ans_tokens = re.findall(r"[A-Za-z0-9]+", trimmed.lower())
+    overlap = sum(1 for t in ans_tokens if t in ctx_tokens)
+    grounded_ratio = overlap / max(len(ans_tokens), 1)
+
+    if not has_citation or not all_cited or grounded_ratio < 0.3:
+        return IDK
+
+    return trimmed
+
 def _gemini_answer(question: str, context: str, *, strict: bool = True) -> str:
     """
     Strictly grounded answerer:
@@ -244,91 +413,149 @@ def _gemini_answer(question: str, context: str, *, strict: bool = True) -> str:
     - Requires bracket citations [1], [2] matching CONTEXT blocks.
     - Falls back to 'I don't know based on the provided document.' if not grounded.
     """
-    import re
-
-    def _fallback():
-        # Short, safe extractive fallback (not the whole doc)
-        lines = [l for l in context.splitlines() if l and not l.startswith("[") and l not in ("BEGIN", "END")]
-        snippet = " ".join(lines)[:400]
-        return snippet or "I don't know based on the provided document."
-
     if not context.strip():
-        return "I don't know based on the provided document."
+        return IDK
 
     # If no key configured, don't dump the whole text — return short extract
     if not GOOGLE_API_KEY:
-        return _fallback()
+        return _answer_fallback(context)
 
     try:
-        import google.generativeai as genai
-        genai.configure(api_key=GOOGLE_API_KEY)
+        raw = _gemini_model().generate_content(_gemini_prompt(question, context)).text
+        return _ground_check(raw, context, strict=strict)
+    except Exception as e:
+        # If Gemini errors, don't dump everything — return short extract
+        return _answer_fallback(context)
 
-        system = (
-            "You answer ONLY using the numbered CONTEXT blocks.\n"
-            "If the answer is not fully supported by CONTEXT, reply exactly:\n"
-            "\"I don't know based on the provided document.\"\n"
-            "Every factual sentence MUST include a bracket citation like [1] or [2]."
-        )
-
-        rules = (
-            "Rules:\n"
-            "1) Use only the provided CONTEXT.\n"
-            "2) 1–4 short sentences. Be concise.\n"
-            "3) Every sentence MUST include a citation [n].\n"
-            "4) If unsupported, say: I don't know based on the provided document."
-        )
-
-        prompt = (
-            f"{system}\n\n{rules}\n\n"
-            f"QUESTION:\n{question}\n\n"
-            f"CONTEXT (numbered blocks):\n{context}\n\n"
-            "Answer:"
-        )
-
-        generation_config = {
-            "temperature": 0.1,
-            "top_p": 0.9,
-            "top_k": 40,
-            "max_output_tokens": 160,   # keep it tight
-        }
-
-        model = genai.GenerativeModel(GEMINI_MODEL, generation_config=generation_config)
-        raw = (model.generate_content(prompt).text or "").strip()
-
-        if not raw:
-            return "I don't know based on the provided document."
-
-        if strict:
-            # Require at least one [n] citation
-            has_citation = re.search(r"\[\d+\]", raw) is not None
-
-            # Limit to 4 sentences max (split on . ! ?)
-            sentences = re.split(r"(?<=[.!?])\s+", raw.strip())
-            sentences = [s for s in sentences if s]
-            if len(sentences) > 4:
-                sentences = sentences[:4]
-            trimmed = " ".join(sentences)
-
-            # Require citations on each sentence
-            all_cited = all(re.search(r"\[\d+\]", s) for s in sentences)
-
-            # Simple overlap check: ensure significant token overlap with context
-            ctx_text = " ".join([l for l in context.splitlines() if not l.startswith("[")])
-            ctx_tokens = set(re.findall(r"[A-Za-z0-9]+", ctx_text.lower()))
-            ans_tokens = re.findall(r"[A-Za-z0-9]+", trimmed.lower())
-            overlap = sum(1 for t in ans_tokens if t in ctx_tokens)
-            grounded_ratio = overlap / max(len(ans_tokens), 1)
-
-            if not has_citation or not all_cited or grounded_ratio < 0.3:
-                return "I don't know based on the provided document."
-
-            return trimmed
+async def _gemini_answer_async(question: str, context: str, *, strict: bool = True) -> str:
+    """Same contract as _gemini_answer, awaited under the LLM concurrency limit + timeout."""
+    if not context.strip():
+        return IDK
+    if not GOOGLE_API_KEY:
+        return _answer_fallback(context)
+    try:
+        model = _gemini_model()
+        prompt = _gemini_prompt(question, context)
+        if hasattr(model, "generate_content_async"):
+            resp = await call_llm(lambda: model.generate_content_async(prompt))
+        else:
+            resp = await call_llm(lambda: run_llm_blocking(model.generate_content, prompt))
+        return _ground_check(resp.text, context, strict=strict)
+    except Exception:
+        # timeouts included — answer from the context instead of hanging the request
+        return _answer_fallback(context)
 
-        return raw
+class StreamingGrounder:
+    """
+    Incremental version of the strict checks for streamed answers: each
+    sentence must carry a [n] citation before any of it is sent (so only
+    the sentence being generated is buffered), and nothing past the 4th
+    sentence is sent. The full overlap check runs once at the end (see
+    verdict()).
+    """
 
+    _SENT_END = re.compile(r"(?<=[.!?])\s+")
+
+    def __init__(self, context: str, strict: bool = True):
+        self.context = context
+        self.strict = strict
+        self.text = ""
+        self.sentences = 0
+        self._pos = 0          # start of the sentence still being generated
+        self._sent = 0         # end of the text already released to the client
+        self.violation = False
+        self.truncated = False
+
+    def feed(self, piece: str) -> str:
+        """Add model output; returns the part that may be sent to the client."""
+        if self.stop:
+            return ""
+        self.text += piece
+        if not self.strict:
+            return piece
+        # check the sentences this piece completed; the one still being
+        # generated is held back until its citation has been seen
+        for m in self._SENT_END.finditer(self.text, self._pos):
+            sent = self.text[self._pos:m.start()]
+            self._pos = m.end()
+            if not sent.strip():
+                continue
+            self.sentences += 1
+            if not re.search(r"\[\d+\]", sent):
+                self.violation = True
+                return ""
+            if self.sentences >= 4:
+                self.truncated = True
+                return self._release(m.start())
+        return self._release(self._pos)
+
+    def flush(self) -> str:
+        """The model finished: check the last (unterminated) sentence and release it."""
+        if not self.strict or self.stop:
+            return ""
+        tail = self.text[self._pos:]
+        self._pos = len(self.text)
+        if tail.strip():
+            self.sentences += 1
+            if not re.search(r"\[\d+\]", tail):
+                self.violation = True
+                return ""
+        return self._release(self._pos)
+
+    def _release(self, end: int) -> str:
+        out = self.text[self._sent:end]
+        self._sent = max(self._sent, end)
+        return out
+
+    @property
+    def stop(self) -> bool:
+        return self.violation or self.truncated
+
+    def verdict(self) -> Dict:
+        if self.violation:
+            return {"answer": IDK, "grounded": False, "complete": True}
+        final = _ground_check(self.text, self.context, strict=self.strict)
+        return {"answer": final, "grounded": not self.strict or final != IDK, "complete": True}
+
+async def _gemini_stream(question: str, context: str) -> AsyncIterator[str]:
+    """Yield raw Gemini output pieces under the LLM concurrency limit."""
+    model = _gemini_model()
+    prompt = _gemini_prompt(question, context)
+    async for piece in stream_llm(lambda: model.generate_content_async(prompt, stream=True)):
+        yield piece
+
+async def _ask_stream(question: str, context: str, citations: List[Dict], hits: List[Dict],
+                      filename: str, strict: bool = True):
+    yield "citations", {"citations": citations, "retrieved": hits, "filename": filename}
+    if not context.strip() or not GOOGLE_API_KEY:
+        # same short answers as the blocking path; not model output, so not graded
+        text = _answer_fallback(context) if context.strip() else IDK
+        yield "token", {"text": text}
+        yield "verdict", {"answer": text, "grounded": False, "complete": True}
+        return
+    grounder = StreamingGrounder(context, strict=strict)
+    try:
+        async for piece in _gemini_stream(question, context):
+            out = grounder.feed(piece)
+            if out:
+                yield "token", {"text": out}
+            if grounder.stop:
+                break
     except Exception as e:
-        # If Gemini errors, don't dump everything — return short extract
-        return _fallback()
+        print(f"✗ Gemini stream failed after {len(grounder.text)} chars: {e!r}")
+        if not grounder.text:
+            # nothing streamed yet: same extractive fallback as the blocking path
+            fallback = _answer_fallback(context)
+            yield "token", {"text": fallback}
+            yield "verdict", {"answer": fallback, "grounded": False, "complete": True}
+            return
+        # cut off mid-answer: never grade the partial text as if it were whole
+        yield "verdict", {"answer": IDK, "grounded": False, "complete": False, "error": str(e)}
+        return
+    out = grounder.flush()
+    if out:
+        yield "token", {"text": out}
+    yield "verdict", grounder.verdict()
 
 # ---- Schemas for /ask ----
 class AskIn(BaseModel):
@@ -336,54 +563,158 @@ class AskIn(BaseModel):
     q: str
     k: Optional[int] = 6
     strict: Optional[bool] = True  # default ON
+    retrieve_only: Optional[bool] = False  # skip generation; never waits on the LLM
+    stream: Optional[bool] = False         # Server-Sent Events: citations, tokens, verdict
+
+# ---- Background indexing ----
+def _publish_session(sid: str, chunks: List[str], meta: Dict):
+    vec, X = _build_index(chunks)
+    lex = _build_lexicon(chunks, vec)
+    SESSIONS.put(sid, {"chunks": list(chunks), "vectorizer": vec, "tfidf": X, "lexicon": lex, "meta": dict(meta)})
+
+def _spool_upload(src: BinaryIO) -> Tuple[BinaryIO, int]:
+    """Copy the request's upload into a file the job owns, a block at a time, enforcing UPLOAD_MAX_BYTES."""
+    dst = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    size = 0
+    while True:
+        block = src.read(UPLOAD_READ_BYTES)
+        if not block:
+            break
+        size += len(block)
+        if size > UPLOAD_MAX_BYTES:
+            dst.close()
+            raise HTTPException(status_code=413, detail=f"File larger than {UPLOAD_MAX_BYTES // (1024 * 1024)} MB.")
+        dst.write(block)
+    dst.seek(0)
+    return dst, size
+
+def _index_upload(job, sid: str, filename: str, kind: str, f: BinaryIO, size: int) -> Dict:
+    """
+    Background job: extract page by page (text files block by block),
+    chunk to the embedder's token limit as text arrives and publish the session whenever the chunk
+    count has doubled, so early pages are searchable while the rest is
+    still extracting and the repeated TF-IDF builds cost at most ~2x the
+    final one. Only the current page and the chunks are held in memory.
+    """
+    try:
+        if kind == "pdf":
+            try:
+                pieces = _iter_pdf_pages(PdfReader(f))
+            except Exception as e:
+                raise JobError(f"Could not read the PDF: {e}")
+        else:
+            pieces = _iter_txt_pieces(f, size)
+        job.update(chunks=0, searchable_chunks=0)
+        chunker = StreamChunker()
+        chunks: List[str] = []
+        published = 0
+        meta = {"filename": filename, "indexing": True}
+        for text, progress in pieces:
+            chunks.extend(c for c in map(_clean_text, chunker.feed(text)) if c)
+            if chunks and len(chunks) >= 2 * published:
+                try:
+                    _publish_session(sid, chunks, meta)
+                    published = len(chunks)
+                except ValueError:
+                    pass   # TF-IDF pruned every term of this prefix; retry at the next doubling
+            job.update(chunks=len(chunks), searchable_chunks=published, **progress)
+        chunks.extend(c for c in map(_clean_text, chunker.finish()) if c)
+    finally:
+        f.close()
+    if not chunks:
+        raise JobError("No readable text found (maybe scanned PDF?).")
+    meta["indexing"] = False
+    try:
+        _publish_session(sid, chunks, meta)
+    except ValueError as e:
+        raise JobError(f"Could not index the text: {e}")
+    job.update(chunks=len(chunks), searchable_chunks=len(chunks))
+    return {"session_id": sid, "chunks": len(chunks), "filename": filename}
 
 # ---- Routes ----
-@app.post("/upload")
-async def upload(file: UploadFile = File(...)):
+@app.post("/upload", status_code=202)
+async def upload(response: Response, file: UploadFile = File(...), wait: bool = False):
     """
-    Accept a single PDF or TXT, extract & chunk text,
-    build a TF-IDF index for this session, and return session_id.
+    Accept a single PDF or TXT (up to UPLOAD_MAX_MB) and index it in the
+    background: returns at once with the session id (which is also the
+    job id) to poll at /upload/{job_id}. Chunks become searchable via
+    /ask as pages are extracted. wait=true blocks until indexing
+    finishes and returns the old {session_id, chunks, filename} response.
     """
     fname = (file.filename or "").lower()
-    data = await file.read()
-
     if fname.endswith(".pdf"):
-        raw = _extract_pdf(data)
+        kind = "pdf"
     elif fname.endswith(".txt"):
-        raw = _extract_txt(data)
+        kind = "txt"
     else:
         raise HTTPException(status_code=400, detail="Only .pdf and .txt are supported.")
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File larger than {UPLOAD_MAX_BYTES // (1024 * 1024)} MB.")
+    # the form parser already spooled the body; the request closes that file when it ends
+    spool, size = await run_cpu(_spool_upload, file.file)
 
-    text = _clean_text(raw)
-    if not text:
-        raise HTTPException(status_code=422, detail="No readable text found (maybe scanned PDF?).")
-
-    chunks = _chunk_text(text, max_words=220, overlap=40)
-    if not chunks:
-        raise HTTPException(status_code=422, detail="Could not create chunks from the file.")
-
-    vec, X = _build_index(chunks)
     sid = str(uuid.uuid4())
-    SESSIONS[sid] = {"chunks": chunks, "vectorizer": vec, "tfidf": X, "meta": {"filename": file.filename}}
-    return {"session_id": sid, "chunks": len(chunks), "filename": file.filename}
+    try:
+        job = UPLOADS.submit(_index_upload, sid, file.filename, kind, spool, size, job_id=sid,
+                             meta={"session_id": sid, "filename": file.filename, "bytes": size})
+    except JobQueueFull:
+        spool.close()
+        raise HTTPException(status_code=429, detail="Too many uploads in progress; retry shortly.",
+                            headers={"Retry-After": "5"})
+    if not wait:
+        return job.snapshot()
+    await asyncio.wrap_future(job.future)
+    if job.state == FAILED:
+        raise HTTPException(status_code=422, detail=job.error)
+    response.status_code = 200
+    return job.result
+
+def _job_status(job_id: str) -> Optional[Dict]:
+    """This worker's live job, else the status another worker published."""
+    job = UPLOADS.get(job_id)
+    if job is not None:
+        return job.snapshot()
+    return SESSIONS.get_status(job_id)
+
+@app.get("/upload/{job_id}")
+async def upload_status(job_id: str):
+    status = await run_cpu(_job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired upload job.")
+    return status
 
 @app.post("/ask")
-def ask(inp: AskIn):
-    s = SESSIONS.get(inp.session_id)
+async def ask(inp: AskIn):
+    s = await run_cpu(SESSIONS.get, inp.session_id)
     if not s:
+        status = await run_cpu(_job_status, inp.session_id)
+        if status is not None and status["status"] not in (DONE, FAILED):
+            raise HTTPException(status_code=409, detail="Upload is still being indexed; nothing searchable yet.")
         raise HTTPException(status_code=404, detail="Invalid or expired session_id. Upload again.")
     k = int(inp.k or 6)
 
     # Tighter retrieval improves grounding
     k = min(k, 4)
 
-    hits = _retrieve(s["vectorizer"], s["tfidf"], s["chunks"], inp.q, top_k=k)
+    hits = await run_cpu(_retrieve, s["vectorizer"], s["tfidf"], s["chunks"], inp.q, top_k=k,
+                         lex=s.get("lexicon"))
     context = _build_context(hits, max_blocks=min(4, k), budget_chars=1600)
-    answer = _gemini_answer(inp.q, context, strict=True)
-
     citations = [{"id": i + 1, "source": s["meta"]["filename"]} for i, _ in enumerate(hits)]
+    if inp.retrieve_only:
+        return {"answer": None, "citations": citations, "retrieved": hits, "filename": s["meta"]["filename"]}
+    if inp.stream:
+        return _sse_response(_ask_stream(inp.q, context, citations, hits, s["meta"]["filename"], strict=True))
+    answer = await _gemini_answer_async(inp.q, context, strict=True)
+
     return {"answer": answer, "citations": citations, "retrieved": hits, "filename": s["meta"]["filename"]}
 
+@app.get("/sessions/{session_id}")
+async def session_info(session_id: str):
+    info = await run_cpu(SESSIONS.session_info, session_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Invalid or expired session_id. Upload again.")
+    return {"session_id": session_id, **info}
+
 @app.get("/debug/models")
 def debug_models():
     try:
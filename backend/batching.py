@@ -0,0 +1,78 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+
+# how long the first query of a batch waits for company (ms); 0 disables batching
+MICROBATCH_MS = float(os.getenv("RAG_MICROBATCH_MS", "5"))
+MICROBATCH_MAX = int(os.getenv("RAG_MICROBATCH_MAX", "64"))
+
+SearchBatchFn = Callable[[List[str], int], List[List[Dict]]]
+
+class MicroBatcher:
+    """
+    Coalesce concurrent single-query searches into one batched call.
+    Callers block on submit(...).result(); a single background thread
+    gathers whatever arrives within `max_wait_ms` of the first query (up
+    to `max_batch`) and runs one encode + one FAISS search for all of them.
+    `trim(result, top_k)` cuts a query's result (searched at the batch's
+    largest k) down to what its caller asked for.
+    """
+
+    def __init__(self, search_batch: SearchBatchFn, max_batch: int = MICROBATCH_MAX,
+                 max_wait_ms: float = MICROBATCH_MS, trim: Callable[[Any, int], Any] = lambda hits, k: hits[:k]):
+        self.search_batch = search_batch
+        self.trim = trim
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self._q: "queue.Queue[Tuple[str, int, Future]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="query-microbatcher", daemon=True)
+        self._thread.start()
+        self.batches = 0
+        self.queries = 0
+
+    def submit(self, query: str, top_k: int) -> Future:
+        fut: Future = Future()
+        self._q.put((query, top_k, fut))
+        return fut
+
+    def search(self, query: str, top_k: int) -> List[Dict]:
+        return self.submit(query, top_k).result()
+
+    def _collect(self) -> List[Tuple[str, int, Future]]:
+        batch = [self._q.get()]
+        end = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = end - time.monotonic()
+            try:
+                # past the deadline: only drain what is already queued
+                item = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # one search at the largest k, each caller gets its own prefix
+            k = max(item[1] for item in batch)
+            try:
+                results = self.search_batch([item[0] for item in batch], k)
+            except BaseException as e:
+                for _, _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, top_k, fut), hits in zip(batch, results):
+                fut.set_result(self.trim(hits, top_k))
+            self.batches += 1
+            self.queries += len(batch)
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch": round(self.queries / self.batches, 2) if self.batches else 0.0,
+        }
@@ -0,0 +1,69 @@
+import time
+import random
+import argparse
+from typing import List
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from .app import _build_index, _build_lexicon, _retrieve
+from .scoring import top_k_indices, sparse_scores
+
+def synthetic_chunks(n: int, words_per_chunk: int = 120, vocab_size: int = 20000, seed: int = 0) -> List[str]:
+    """Zipf-ish random text, roughly the shape of an uploaded document after chunking."""
+    rng = random.Random(seed)
+    vocab = [f"w{i:05d}" for i in range(vocab_size)]
+    weights = [1.0 / (i + 1) for i in range(vocab_size)]
+    return [" ".join(rng.choices(vocab, weights=weights, k=words_per_chunk)) for _ in range(n)]
+
+def _timeit(fn, queries: List[str], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for q in queries:
+            fn(q)
+        best = min(best, (time.perf_counter() - t0) / len(queries))
+    return best * 1000.0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Microbenchmark of the /ask retrieval core")
+    ap.add_argument("--chunks", type=int, default=100_000)
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args(argv)
+
+    chunks = synthetic_chunks(args.chunks)
+    t0 = time.perf_counter()
+    vec, X = _build_index(chunks)
+    lex = _build_lexicon(chunks, vec)
+    print(f"{args.chunks} chunks, {X.shape[1]} terms, nnz={X.nnz}, built in {time.perf_counter() - t0:.1f}s")
+
+    rng = random.Random(1)
+    queries = [" ".join(rng.choice(chunks).split()[:rng.randint(3, 8)]) for _ in range(args.queries)]
+    qvs = {q: vec.transform([q]) for q in queries}
+
+    def score_old(q):
+        sims = cosine_similarity(qvs[q], X).ravel()
+        return [chunks[i] for i in sims.argsort()[::-1][:args.k]]
+
+    def score_new(q):
+        sims = sparse_scores(X, qvs[q])
+        return [chunks[i] for i in top_k_indices(sims, args.k)]
+
+    for q in queries:
+        a = cosine_similarity(qvs[q], X).ravel()
+        b = sparse_scores(X, qvs[q])
+        assert np.allclose(a, b), "sparse dot product disagrees with cosine_similarity"
+
+    rows = [
+        ("score+select: cosine_similarity + argsort", _timeit(score_old, queries, args.repeat)),
+        ("score+select: sparse dot + argpartition", _timeit(score_new, queries, args.repeat)),
+        ("_retrieve (long query, end to end)", _timeit(lambda q: _retrieve(vec, X, chunks, q, args.k, lex=lex),
+                                                       queries, args.repeat)),
+    ]
+    for name, ms in rows:
+        print(f"{name:<45} {ms:8.2f} ms/query")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import shutil
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .metastore import iter_meta_lines
+from .scoring import top_k_indices
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# words, plus codes glued by - . / : kept whole ("ERR-0x1f", "v2.3.1", "A12/B")
+_TOKEN = re.compile(r"\w+(?:[-./:]\w+)*")
+_WORD = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms; compound codes are indexed whole and by their parts."""
+    out: List[str] = []
+    for m in _TOKEN.finditer((text or "").lower()):
+        tok = m.group()
+        out.append(tok)
+        if not _WORD.fullmatch(tok):
+            out.extend(_WORD.findall(tok))
+    return out
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the chunks of the FAISS index, stored next to it as
+    bm25/{doc_ids,doc_len,ptr,rows,tfs}.npy + terms.txt: postings in CSR
+    form (one slice of doc rows / term frequencies per term), loaded
+    memory-mapped like the rest of the index directory.
+    """
+
+    FILES = ("doc_ids", "doc_len", "ptr", "rows", "tfs")
+
+    def __init__(self, terms: List[str], arrays: Dict[str, np.ndarray], k1: float = BM25_K1, b: float = BM25_B):
+        self.term_ids = {t: i for i, t in enumerate(terms)}
+        self.doc_ids = arrays["doc_ids"]
+        self.doc_len = arrays["doc_len"]
+        self.ptr = arrays["ptr"]
+        self.rows = arrays["rows"]
+        self.tfs = arrays["tfs"]
+        self.k1, self.b = k1, b
+        n = len(self.doc_ids)
+        self.set_collection_stats(n, float(self.doc_len.mean()) if n else 0.0, np.diff(self.ptr).astype(np.float64))
+
+    def set_collection_stats(self, n: int, avgdl: float, df: np.ndarray):
+        """Document count, average length and per-term document frequencies the scores are based on."""
+        # per-document part of the BM25 denominator, computed once
+        self._norm = (self.k1 * (1 - self.b + self.b * self.doc_len / avgdl)).astype(np.float32) if avgdl else \
+            np.full(len(self.doc_ids), self.k1, dtype=np.float32)
+        self._idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[int, str]]) -> "BM25Index":
+        """One streaming pass over (chunk id, text); postings kept as compact arrays."""
+        terms: Dict[str, int] = {}
+        t_ids, t_rows, t_tfs = array("i"), array("i"), array("i")
+        doc_ids, doc_len = array("q"), array("i")
+        for row, (chunk_id, text) in enumerate(docs):
+            toks = tokenize(text)
+            doc_ids.append(int(chunk_id))
+            doc_len.append(len(toks))
+            for t, tf in Counter(toks).items():
+                t_ids.append(terms.setdefault(t, len(terms)))
+                t_rows.append(row)
+                t_tfs.append(tf)
+        tid = np.frombuffer(t_ids, dtype=np.int32)
+        order = np.argsort(tid, kind="stable")   # rows stay ascending within a term
+        ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tid, minlength=len(terms)), out=ptr[1:])
+        arrays = {
+            "doc_ids": np.frombuffer(doc_ids, dtype=np.int64).copy(),
+            "doc_len": np.frombuffer(doc_len, dtype=np.int32).copy(),
+            "ptr": ptr,
+            "rows": np.frombuffer(t_rows, dtype=np.int32)[order],
+            "tfs": np.minimum(np.frombuffer(t_tfs, dtype=np.int32)[order], 65535).astype(np.uint16),
+        }
+        return cls(list(terms), arrays)
+
+    @classmethod
+    def from_meta(cls, meta_path: str) -> "BM25Index":
+        def docs():
+            for chunk_id, line in iter_meta_lines(meta_path):
+                yield chunk_id, json.loads(line).get("content") or ""
+        return cls.build(docs())
+
+    @staticmethod
+    def dir_for(index_dir: str) -> str:
+        return os.path.join(index_dir, "bm25")
+
+    def save(self, index_dir: str):
+        """Write into a fresh directory, then swap it in for the previous one."""
+        final = self.dir_for(index_dir)
+        tmp, old = final + ".tmp", final + ".old"
+        for d in (tmp, old):
+            shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in self.FILES:
+            np.save(os.path.join(tmp, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp, "terms.txt"), "w", encoding="utf-8") as f:
+            for t in self.term_ids:   # insertion order == term id
+                f.write(t + "\n")
+        if os.path.exists(final):
+            os.replace(final, old)   # open memory maps of the old files stay valid
+        os.replace(tmp, final)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True) -> Optional["BM25Index"]:
+        d = cls.dir_for(index_dir)
+        if not os.path.exists(os.path.join(d, "terms.txt")):
+            return None
+        arrays = {name: np.load(os.path.join(d, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                  for name in cls.FILES}
+        with open(os.path.join(d, "terms.txt"), "r", encoding="utf-8") as f:
+            terms = f.read().split("\n")[:-1]
+        return cls(terms, arrays)
+
+    def search(self, query: str, top_k: int = 8, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(chunk ids, scores) of the best top_k documents with a nonzero score, among rows `allowed` if given."""
+        tids = sorted({self.term_ids[t] for t in tokenize(query) if t in self.term_ids})
+        if not tids or not len(self.doc_ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        for t in tids:
+            lo, hi = self.ptr[t], self.ptr[t + 1]
+            rows = self.rows[lo:hi]
+            tf = self.tfs[lo:hi].astype(np.float32)
+            scores[rows] += self._idf[t] * tf * (self.k1 + 1) / (tf + self._norm[rows])
+        if allowed is None:
+            top = top_k_indices(scores, top_k)
+        else:
+            top = allowed[top_k_indices(scores[allowed], top_k)]
+        top = top[scores[top] > 0]
+        return self.doc_ids[top], scores[top]
+
+    def search_batch(self, queries: List[str], top_k: int = 8,
+                     allowed: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [self.search(q, top_k, allowed) for q in queries]
+
+
+def share_collection_stats(indexes: List[BM25Index]):
+    """
+    Score every index with the statistics of their union (document count,
+    average length, document frequencies), so BM25 scores of different
+    shards are comparable and their rankings can be merged by score.
+    """
+    if len(indexes) < 2:
+        return
+    n = sum(len(ix) for ix in indexes)
+    total_len = sum(float(ix.doc_len.sum()) for ix in indexes)
+    df: Dict[str, int] = {}
+    for ix in indexes:
+        counts = np.diff(ix.ptr).tolist()
+        for t, i in ix.term_ids.items():
+            df[t] = df.get(t, 0) + counts[i]
+    for ix in indexes:
+        # term_ids is in term id order
+        local = np.fromiter((df[t] for t in ix.term_ids), dtype=np.float64, count=len(ix.term_ids))
+        ix.set_collection_stats(n, total_len / n if n else 0.0, local)
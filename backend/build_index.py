@@ -1,29 +1,231 @@
 import os
 import json
-from typing import List, Dict
-from .vectorestore import VectorStore
+import random
+import argparse
+from array import array
+from typing import List, Dict, Tuple, Iterator, Optional, Union
+from .vectorestore import VectorStore, INDEX_TYPE, INDEX_TYPES, INDEX_TRAIN_SIZE, TRAINED_TYPES, COMPRESSED_TYPES
+from .shards import ShardedVectorStore, SHARDS, SHARD_BY, SHARD_BY_CHOICES, read_manifest, is_sharded, remove_shards
+from .bm25 import BM25Index
+from .filters import FilterColumns
+from .embed_cache import ChunkKeys, chunk_key
+from .metastore import iter_meta_lines
 
 PROCESSED_JSONL = os.path.join(os.path.dirname(__file__), "data", "processed", "chunks.jsonl")
+DELTA_JSONL = os.path.join(os.path.dirname(__file__), "data", "processed", "delta.jsonl")
 INDEX_DIR = os.path.join(os.path.dirname(__file__), "data", "index")
 EMBED_MODEL=os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
 
-def load_chunks(path: str) -> List[Dict]:
-    chunks: List[Dict] = []
+def iter_chunks(path: str) -> Iterator[Dict]:
+    """
+    Stream the chunk records to index from chunks.jsonl one line at a
+    time; near-duplicates ("dup_of") are indexed through their canonical chunk.
+    """
     if not os.path.exists(path):
         raise FileNotFoundError(f"Chunks file not found: {path} . Run ingest first.")
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
-            chunks.append(json.loads(line))
+            if line.strip():
+                rec = json.loads(line)
+                if "dup_of" not in rec:
+                    yield rec
+
+def load_chunks(path: str) -> List[Dict]:
+    chunks = list(iter_chunks(path))
     if not chunks:
         raise RuntimeError(f"No chunks found in {path}. Run ingest first.")
     return chunks
 
-def main():
-    chunk=load_chunks(PROCESSED_JSONL)
-    vs=VectorStore(embedding_model_name=EMBED_MODEL)
-    vs.build(chunk)
+def load_delta(path: str) -> Tuple[List[Dict], List[int]]:
+    """
+    Collapse delta.jsonl into (upserts, delete_ids); later ops on the
+    same id win, so several ingest runs can queue up before a build.
+    """
+    latest: Dict[int, Dict] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            op = json.loads(line)
+            if op["op"] == "delete":
+                latest[int(op["id"])] = None
+            else:
+                latest[int(op["record"]["id"])] = op["record"]
+    upserts = [r for r in latest.values() if r is not None]
+    deletes = [i for i, r in latest.items() if r is None]
+    return upserts, deletes
+
+def sample_chunks(path: str, n: int, seed: int = 0) -> List[Dict]:
+    """Reservoir-sample n chunk records (one pass, O(n) memory) for index training."""
+    rng = random.Random(seed)
+    sample: List[Dict] = []
+    for i, c in enumerate(iter_chunks(path)):
+        if i < n:
+            sample.append(c)
+        else:
+            j = rng.randint(0, i)
+            if j < n:
+                sample[j] = c
+    return sample
+
+def stores(vs: Union[VectorStore, ShardedVectorStore]) -> List[VectorStore]:
+    """The stores that own index files: the shards of a sharded store, else the store itself."""
+    return vs.shards if isinstance(vs, ShardedVectorStore) else [vs]
+
+def read_stats(vs: VectorStore) -> Dict:
+    if not os.path.exists(vs.stats_path):
+        return {}
+    with open(vs.stats_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def can_update_in_place(vs: Union[VectorStore, ShardedVectorStore], built_type: Optional[str] = None) -> bool:
+    """
+    Whether the index on disk can take the delta. `built_type` is the
+    engine a shard actually built (the manifest's entry), which may be
+    flat where the requested engine had too few vectors to train.
+    """
+    if isinstance(vs, ShardedVectorStore):
+        manifest = read_manifest(vs.index_dir)
+        built = {e["id"]: e.get("index_type") for e in manifest.get("shards", [])}
+        return (is_sharded(vs.index_dir) and manifest.get("n_shards") == vs.n_shards
+                and manifest.get("shard_by") == vs.shard_by
+                and read_stats(vs).get("index_type") == vs.index_type
+                and all(i in built and can_update_in_place(s, built[i]) for i, s in zip(vs.shard_ids, vs.shards)))
+    if is_sharded(vs.index_dir) or not os.path.exists(vs.index_path):
+        return False
+    stats = read_stats(vs)
+    return (bool(stats.get("id_map")) and stats.get("model") == vs.model_name
+            and stats.get("index_type", "flat") == (built_type or vs.index_type) and vs.supports_delete)
+
+def write_side_indexes(vs: VectorStore) -> int:
+    """
+    (Re)build the BM25, metadata filter and chunk key side indexes from
+    the metadata the next save() will publish, in one pass over it.
+    Written before save() so stats.json, which triggers reloads, still
+    changes last.
+    """
+    cols = FilterColumns()
+    ids, keys = array("q"), bytearray()
+    def docs():
+        for chunk_id, line in iter_meta_lines(vs.staged_meta_path):
+            rec = json.loads(line)
+            cols.add(chunk_id, rec)
+            ids.append(chunk_id)
+            keys.extend(chunk_key(rec))
+            yield chunk_id, rec.get("content") or ""
+    bm25 = BM25Index.build(docs())
+    bm25.save(vs.index_dir)
+    cols.finish().save(vs.index_dir)
+    ChunkKeys.build(ids, bytes(keys)).save(vs.index_dir)
+    return len(bm25)
+
+def gc_embed_cache(vs: VectorStore, force: bool = False) -> int:
+    """
+    Drop cached embeddings no chunk in the published meta.jsonl(s) refers to.
+    Runs when forced or once dead entries outnumber live ones.
+    """
+    cache = vs.open_embed_cache()
+    if cache is None:
+        return 0
+    try:
+        # the cache is shared by every shard: only keys no shard refers to are dead
+        live = {chunk_key(json.loads(line)) for s in stores(vs) for _, line in iter_meta_lines(s.meta_path)}
+        if not force and len(cache) <= 2 * len(live):
+            return 0
+        return cache.gc(live)
+    finally:
+        vs.close_embed_cache()
+
+def finish_embed_cache(vs: VectorStore, force_gc: bool = False):
+    st = vs.embed_stats
+    if st and st["hits"] + st["misses"]:
+        print(f"Embedding cache: {st['hits']} reused, {st['misses']} encoded, {st['entries']} entries "
+              f"({st['bytes'] / 1e6:.1f} MB {st['dtype']}).")
+    removed = gc_embed_cache(vs, force=force_gc)
+    if removed:
+        print(f"Embedding cache: dropped {removed} unreferenced entries.")
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Build or update the FAISS index from chunks.jsonl")
+    ap.add_argument("--full", action="store_true", help="rebuild from chunks.jsonl instead of applying delta.jsonl")
+    ap.add_argument("--index-type", choices=INDEX_TYPES, default=None,
+                    help=f"index engine (default: existing index's type, else $INDEX_TYPE={INDEX_TYPE})")
+    ap.add_argument("--shards", type=int, help=f"partition the index into N shards (default: existing layout, "
+                                                  f"else $RAG_SHARDS={SHARDS}); changing it needs --full")
+    ap.add_argument("--shard-by", choices=SHARD_BY_CHOICES, default=None,
+                    help=f"how chunks are assigned to shards (default: existing, else $RAG_SHARD_BY={SHARD_BY})")
+    ap.add_argument("--nlist", type=int, help="IVF cells (default ~4*sqrt(n))")
+    ap.add_argument("--pq-m", type=int, help="PQ sub-quantizers for ivf_pq / pq")
+    ap.add_argument("--pq-nbits", type=int, help="bits per PQ code")
+    ap.add_argument("--hnsw-m", type=int, help="HNSW graph degree")
+    ap.add_argument("--ef-construction", type=int, help="HNSW build-time candidate list")
+    ap.add_argument("--nprobe", type=int, help="default IVF cells probed per query")
+    ap.add_argument("--ef-search", type=int, help="default HNSW candidate list per query")
+    ap.add_argument("--train-size", type=int, default=INDEX_TRAIN_SIZE, help="training sample size for IVF/PQ/SQ8")
+    ap.add_argument("--no-recall-report", action="store_true",
+                    help="skip measuring recall of compressed indexes against exact search")
+    ap.add_argument("--gc-cache", action="store_true", help="drop cached embeddings of chunks no longer indexed")
+    return ap.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {k: v for k, v in {
+        "nlist": args.nlist, "pq_m": args.pq_m, "pq_nbits": args.pq_nbits, "hnsw_m": args.hnsw_m,
+        "ef_construction": args.ef_construction, "nprobe": args.nprobe, "ef_search": args.ef_search,
+    }.items() if v is not None}
+    probe = os.path.join(INDEX_DIR, "stats.json")
+    index_type = args.index_type
+    if index_type is None and os.path.exists(probe):
+        with open(probe, "r", encoding="utf-8") as f:
+            index_type = json.load(f).get("index_type", "flat")
+    manifest = read_manifest(INDEX_DIR) if is_sharded(INDEX_DIR) else {}
+    n_shards = args.shards or manifest.get("n_shards") or SHARDS
+    if n_shards > 1:
+        vs = ShardedVectorStore(embedding_model_name=EMBED_MODEL, index_dir=INDEX_DIR,
+                                index_type=index_type or INDEX_TYPE, index_params=params,
+                                n_shards=n_shards, shard_by=args.shard_by or manifest.get("shard_by") or SHARD_BY)
+    else:
+        vs=VectorStore(embedding_model_name=EMBED_MODEL, index_dir=INDEX_DIR,
+                       index_type=index_type or INDEX_TYPE, index_params=params)
+    if not args.full and can_update_in_place(vs):
+        if not os.path.exists(DELTA_JSONL):
+            print(f"Index in {vs.index_dir} is up to date (no pending changes).")
+            if args.gc_cache:
+                finish_embed_cache(vs, force_gc=True)
+            return
+        upserts, deletes = load_delta(DELTA_JSONL)
+        vs.load_index()
+        vs.apply_delta(upserts, deletes)
+        for s in stores(vs):
+            if s.dirty:
+                write_side_indexes(s)
+        vs.save()
+        os.remove(DELTA_JSONL)
+        finish_embed_cache(vs, force_gc=args.gc_cache)
+        print(f"Index updated in {vs.index_dir}: +{len(upserts)} upserted, -{len(deletes)} deleted, "
+              f"{vs.count} vectors.")
+        return
+    train_sample = None
+    if vs.index_type in TRAINED_TYPES:
+        train_sample = sample_chunks(PROCESSED_JSONL, args.train_size)
+    vs.build(iter_chunks(PROCESSED_JSONL), train_sample=train_sample)
+    if not vs.count:
+        raise RuntimeError(f"No chunks found in {PROCESSED_JSONL}. Run ingest first.")
+    for s in stores(vs):
+        if s.index_type in COMPRESSED_TYPES and not args.no_recall_report:
+            s.quantization = s.quantization_report() or None
+            if s.quantization:
+                q = s.quantization
+                print(f"Recall@{q['k']} vs exact search: {q['recall']:.3f} "
+                      f"({q['recall_rescored']:.3f} with x{q['rescore_factor']} re-scoring) [{s.index_dir}].")
+        write_side_indexes(s)
     vs.save()
-    print(f"Index built and saved to {vs.index_dir} with {len(vs.meta)} vectors.")
+    if not isinstance(vs, ShardedVectorStore):
+        remove_shards(INDEX_DIR)
+    # a full build already reflects every pending change
+    if os.path.exists(DELTA_JSONL):
+        os.remove(DELTA_JSONL)
+    finish_embed_cache(vs, force_gc=args.gc_cache)
+    layout = f", {vs.n_shards} shards by {vs.shard_by}" if isinstance(vs, ShardedVectorStore) else ""
+    print(f"Index built and saved to {vs.index_dir} with {vs.count} vectors ({vs.index_type}{layout}).")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
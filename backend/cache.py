@@ -0,0 +1,110 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import numpy as np
+
+CACHE_SIZE = int(os.getenv("RAG_CACHE_SIZE", "10000"))        # entries per layer
+CACHE_TTL = float(os.getenv("RAG_CACHE_TTL", "3600"))         # seconds; 0 = no expiry
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", str(CACHE_TTL)))
+
+_MISSING = object()
+
+class TTLCache:
+    """Thread-safe LRU cache with a per-entry time-to-live and hit/miss counters."""
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires and expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def normalize_query(q: str) -> str:
+    return " ".join((q or "").split())
+
+def vector_key(v: np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(v, dtype="float32").tobytes()).hexdigest()
+
+def text_key(s: str) -> str:
+    return hashlib.sha1((s or "").encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    """
+    Layered cache for the /query path:
+      embeddings: normalized query -> query vector
+      hits:       (vector digest, k, index version) -> retrieved hits
+      answers:    (normalized question, context digest) -> answer
+    Hits are keyed by index version, so a rebuild never serves stale
+    results; invalidate() drops the layers a reload made unreachable.
+    """
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL,
+                 answer_ttl: float = ANSWER_CACHE_TTL):
+        self.embeddings = TTLCache(maxsize, ttl)
+        self.hits = TTLCache(maxsize, ttl)
+        self.answers = TTLCache(maxsize, answer_ttl)
+
+    def invalidate(self, model_changed: bool = False):
+        self.hits.clear()
+        self.answers.clear()
+        if model_changed:
+            self.embeddings.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "embeddings": self.embeddings.stats(),
+            "hits": self.hits.stats(),
+            "answers": self.answers.stats(),
+        }
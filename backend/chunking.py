@@ -1,10 +1,25 @@
+import os
 import re
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
 
-from typing import List, Dict
+import numpy as np
 
 WHITESPACE_RE = re.compile(r"\s+")
 MULTI_NL_RE = re.compile(r"\n{3,}")
 
+# chunks are sized in tokens of the embedding model, so nothing is cut off at encode time
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+# all-MiniLM-L6-v2 truncates at 256 tokens, special tokens included
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+# sentence ends, and blank lines (paragraph breaks)
+_BOUNDARY = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n[ \t]*\n\s*")
+# approximate word pieces when the model's tokenizer is unavailable
+_FALLBACK_TOKEN = re.compile(r"\w{1,6}|[^\w\s]")
+
 def clean_text(text: str) -> str:
     if not text:
         return ""
@@ -13,30 +28,201 @@ def clean_text(text: str) -> str:
     text = MULTI_NL_RE.sub("\n\n", text)
     return text.strip()
 
-def chunk_text(text: str, max_tokens: int = 1000, overlap_tokens: int = 120) -> List[str]:
-    words = text.split()
-    if not words:
-        return []
-    chunks: List[str] = []
-    start = 0
-    step = max_tokens - overlap_tokens if max_tokens > overlap_tokens else max_tokens
-    while start < len(words):
-        end = min(start + max_tokens, len(words))
-        chunk = " ".join(words[start:end])
-        chunks.append(chunk)
-        if end >= len(words):
-            break
-        start += step
-    return chunks
+def content_sha(text: str) -> str:
+    """sha256 of a chunk's text; keys the embedding cache."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class Tokenizer:
+    """
+    Token offsets from the embedding model's fast tokenizer (no special
+    tokens), or a regex approximation of word pieces if it can't be loaded.
+    """
+
+    def __init__(self, name: str = CHUNK_TOKENIZER):
+        self.name = name
+        self._tok = None
+        self.special = 2   # [CLS] ... [SEP]
+        try:
+            from transformers import AutoTokenizer
+            repo = name if "/" in name or os.path.exists(name) else f"sentence-transformers/{name}"
+            tok = AutoTokenizer.from_pretrained(repo)
+            if tok.is_fast:
+                self._tok = tok
+                self.special = tok.num_special_tokens_to_add()
+            else:
+                print(f"[chunking] {name}: no fast tokenizer; approximating token counts")
+        except Exception as e:
+            print(f"[chunking] tokenizer {name} unavailable ({type(e).__name__}); approximating token counts")
+
+    def starts(self, text: str) -> np.ndarray:
+        """Start offset of every token of `text`."""
+        if self._tok is None:
+            return np.fromiter((m.start() for m in _FALLBACK_TOKEN.finditer(text)), dtype=np.int64)
+        offsets = self._tok(text, add_special_tokens=False, return_offsets_mapping=True,
+                            verbose=False)["offset_mapping"]
+        return np.fromiter((s for s, _ in offsets), dtype=np.int64, count=len(offsets))
+
+_TOKENIZERS: Dict[str, Tokenizer] = {}
+_TOKENIZERS_LOCK = threading.Lock()
+
+def get_tokenizer(name: str = CHUNK_TOKENIZER) -> Tokenizer:
+    """One Tokenizer per name and process (ingest workers each load their own)."""
+    with _TOKENIZERS_LOCK:
+        if name not in _TOKENIZERS:
+            _TOKENIZERS[name] = Tokenizer(name)
+        return _TOKENIZERS[name]
+
+def _pieces(text: str, starts: np.ndarray, a: int, b: int, piece: int, stable: Optional[int] = None):
+    """
+    Cut tokens [a, b) into runs of at most `piece` tokens, each ending at
+    a line break in its second half, else at a word start. A cut depends
+    only on the `piece` tokens before it, so with `stable` (the tokens
+    from there on may still change) only runs cut before it are returned,
+    and they are the runs the complete text would give.
+    Yields (first token, cut token).
+    """
+    t = a
+    while t < b:
+        cut = min(t + piece, b)
+        if stable is not None and t + piece >= stable:
+            return
+        if cut < b:
+            window = range(cut, t + max(1, piece // 2), -1)
+            cut = next((c for c in window if text[starts[c] - 1] == "\n"),
+                       next((c for c in window if text[starts[c] - 1].isspace()), cut))
+        yield t, cut
+        t = cut
+
+def _units(text: str, starts: np.ndarray, piece: int, final: bool):
+    """
+    Sentences of `text` as parallel lists (starts, ends, token counts,
+    ends-a-paragraph) plus the offset of the unterminated tail. Sentences
+    longer than `piece` tokens are cut into runs (see _pieces). When not
+    `final` the tail may still continue: only its complete runs are
+    returned, so text without sentence ends (logs, CSV, code) still
+    yields units as it arrives instead of piling up in the tail.
+    """
+    us, ue, para = [], [], []
+    pos = 0
+    for m in _BOUNDARY.finditer(text):
+        if m.start() > pos:
+            us.append(pos), ue.append(m.start()), para.append(m.group().count("\n") >= 2)
+        pos = m.end()
+    tail = pos
+    if final and pos < len(text) and text[pos:].strip():
+        us.append(pos), ue.append(len(text)), para.append(True)
+    a = np.searchsorted(starts, np.array(us, dtype=np.int64))
+    b = np.searchsorted(starts, np.array(ue, dtype=np.int64))
+    out_s, out_e, out_n, out_p = [], [], [], []
+    for i in range(len(us)):
+        n = int(b[i] - a[i])
+        if n <= piece:
+            out_s.append(us[i]), out_e.append(ue[i]), out_n.append(n), out_p.append(para[i])
+            continue
+        # long run without sentence punctuation
+        start = us[i]
+        for t, cut in _pieces(text, starts, int(a[i]), int(b[i]), piece):
+            end = ue[i] if cut >= b[i] else int(starts[cut])
+            out_s.append(start), out_e.append(end), out_n.append(cut - t), out_p.append(para[i] and cut >= b[i])
+            start = end
+    if not final:
+        # the last word may still grow (and tokenize differently): tokens from it on are not final
+        last = max(text.rfind(" ", tail), text.rfind("\n", tail))
+        stable = int(np.searchsorted(starts, last)) if last > tail else 0
+        ta = int(np.searchsorted(starts, tail))
+        for t, cut in _pieces(text, starts, ta, stable, piece, stable=stable):
+            end = int(starts[cut])
+            out_s.append(tail), out_e.append(end), out_n.append(cut - t), out_p.append(False)
+            tail = end
+    return out_s, out_e, out_n, out_p, tail
+
+def chunk_spans(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                tokenizer: Optional[Tokenizer] = None, final: bool = True) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    Split `text` into (start, end) character spans of at most `max_tokens`
+    model tokens (special tokens included), in one pass over its
+    sentences: a chunk grows sentence by sentence and, when the next one
+    does not fit, is closed at its last paragraph break if that keeps it
+    more than half full. The next chunk repeats up to `overlap_tokens`
+    of trailing sentences, never across a paragraph break.
+
+    Returns (spans, resume): with final=False the open chunk is not
+    emitted and `resume` is where to continue once more text is appended.
+    """
+    tok = tokenizer or get_tokenizer()
+    budget = max(8, max_tokens - tok.special)
+    overlap = max(0, min(overlap_tokens, budget // 2))
+    us, ue, un, up, tail = _units(text, tok.starts(text), max(overlap, budget // 8, 1), final)
+    spans: List[Tuple[int, int]] = []
+    g, size = 0, 0   # first unit and token count of the open chunk
+    for i in range(len(us)):
+        while size + un[i] > budget and i > g:
+            # close the open chunk, at its last paragraph break if that keeps it over half full
+            end, acc = i - 1, 0
+            for j in range(g, i - 1):
+                acc += un[j]
+                if up[j] and acc * 2 > budget:
+                    end = j
+            spans.append((us[g], ue[end]))
+            nxt = end + 1
+            if not up[end]:
+                back = 0
+                # repeat trailing sentences while they fit the overlap (and leave room for sentence i)
+                while nxt - 1 > g and not up[nxt - 1] and back + un[nxt - 1] <= overlap \
+                        and back + un[nxt - 1] + un[i] <= budget:
+                    nxt -= 1
+                    back += un[nxt]
+            g = nxt
+            size = sum(un[g:i])
+        size += un[i]
+    if not final:
+        return spans, us[g] if g < len(us) else tail
+    if g < len(us):
+        spans.append((us[g], ue[-1]))
+    return spans, len(text)
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    return [text[s:e] for s, e in chunk_spans(text, max_tokens, overlap_tokens)[0]]
+
+
+class StreamChunker:
+    """
+    chunk_spans over text that arrives in pieces (pages, decoded blocks):
+    only the open chunk's text is kept between feeds, so memory does not
+    grow with the document. Yields raw slices; callers clean them.
+    """
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 tokenizer: Optional[Tokenizer] = None):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.buf = ""
+
+    def _split(self, final: bool) -> List[str]:
+        spans, resume = chunk_spans(self.buf, self.max_tokens, self.overlap_tokens, self.tokenizer, final)
+        out = [self.buf[s:e] for s, e in spans]
+        self.buf = self.buf[resume:]
+        return out
+
+    def feed(self, text: str) -> List[str]:
+        self.buf += text
+        return self._split(final=False)
+
+    def finish(self) -> List[str]:
+        return self._split(final=True)
 
 def build_chunk_records(source: str, page: int | None, text: str) -> List[Dict]:
+    """Chunk raw page/file text (boundaries need its newlines) and clean each chunk."""
     records: List[Dict] = []
-    for idx, chunk in enumerate(chunk_text(text)):
+    chunks = (clean_text(c) for c in chunk_text(text))
+    for idx, chunk in enumerate(c for c in chunks if c):
         records.append({
             "source": source,
             "page": page,
             "chunk_id": idx,
             "content": chunk,
+            "sha": content_sha(chunk),
             "preview": chunk[:300]
         })
 
@@ -0,0 +1,69 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+# CPU-bound request stages (encode, FAISS/TF-IDF search, rerank) run here,
+# never on the event loop and never behind LLM calls
+CPU_WORKERS = int(os.getenv("RAG_CPU_WORKERS", str(os.cpu_count() or 4)))
+# blocking LLM client calls (sync SDK fallbacks) get their own pool
+LLM_WORKERS = int(os.getenv("RAG_LLM_WORKERS", "16"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT_SECS", "20"))
+# fan-out of index searches from inside a CPU task (e.g. BM25 next to FAISS);
+# separate so a saturated CPU pool can't deadlock waiting on itself
+SEARCH_WORKERS = int(os.getenv("RAG_SEARCH_WORKERS", "4"))
+
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="rag-cpu")
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="rag-llm")
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="rag-search")
+
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+
+def llm_semaphore() -> asyncio.Semaphore:
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _llm_semaphore
+
+async def run_cpu(fn: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CPU_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+async def run_llm_blocking(fn: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(LLM_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+async def call_llm(make_call: Callable[[], Awaitable[Any]], timeout: float = LLM_TIMEOUT) -> Any:
+    """
+    Await an LLM coroutine under the process-wide concurrency limit and a
+    timeout that also covers waiting for a slot (asyncio.TimeoutError
+    propagates to the caller's fallback).
+    """
+    async def _guarded():
+        async with llm_semaphore():
+            return await make_call()
+    return await asyncio.wait_for(_guarded(), timeout=timeout)
+
+async def stream_llm(make_stream: Callable[[], Awaitable[Any]], timeout: float = LLM_TIMEOUT) -> AsyncIterator[str]:
+    """
+    Yield text pieces from a streaming LLM response while holding one
+    concurrency slot. `timeout` bounds waiting for a slot + the first
+    response, and then each gap between chunks.
+    """
+    sem = llm_semaphore()
+    await asyncio.wait_for(sem.acquire(), timeout=timeout)
+    try:
+        stream = await asyncio.wait_for(make_stream(), timeout=timeout)
+        it = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(it.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                break
+            text = getattr(chunk, "text", None) or ""
+            if text:
+                yield text
+    finally:
+        sem.release()
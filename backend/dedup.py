@@ -0,0 +1,92 @@
+import os
+import re
+import hashlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# index near-duplicate chunks once, with back-references to every occurrence
+DEDUP = os.getenv("RAG_DEDUP", "1") == "1"
+# most SimHash bits (of 64) two chunks may differ in and still count as near-duplicates
+DEDUP_MAX_BITS = int(os.getenv("RAG_DEDUP_MAX_BITS", "3"))
+SHINGLE_WORDS = 3
+
+# fields of an occurrence kept in the canonical chunk's "also" list
+OCCURRENCE_FIELDS = ("id", "path", "source", "page", "modified")
+
+_WORD = re.compile(r"\w+")
+
+def simhash(text: str) -> int:
+    """64-bit SimHash of the text's lowercased word 3-shingles (0 for text without words)."""
+    words = _WORD.findall((text or "").lower())
+    if not words:
+        return 0
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    h = np.fromiter((int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+                     for s in shingles), dtype="<u8", count=len(shingles))
+    bits = np.unpackbits(h.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(h)
+    return int(np.packbits(votes, bitorder="little").view("<u8")[0])
+
+def fingerprint(rec: Dict) -> int:
+    """The record's stored "simhash" (hex), else computed from its content."""
+    fp = rec.get("simhash")
+    return int(fp, 16) if fp else simhash(rec.get("content") or "")
+
+def occurrence(rec: Dict) -> Dict:
+    return {f: rec.get(f) for f in OCCURRENCE_FIELDS}
+
+
+class NearDupIndex:
+    """
+    Canonical chunks by SimHash. Two fingerprints at most `max_bits`
+    apart agree exactly on at least one of `max_bits + 1` bands
+    (pigeonhole), so a lookup only compares against the canonicals
+    sharing a band value instead of all of them.
+    """
+
+    def __init__(self, max_bits: int = DEDUP_MAX_BITS):
+        self.max_bits = max_bits
+        n = max_bits + 1
+        self.bands: List[Tuple[int, int]] = []   # (shift, mask)
+        shift = 0
+        for i in range(n):
+            width = 64 // n + (1 if i < 64 % n else 0)
+            self.bands.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables: List[Dict[int, List[Tuple[int, int]]]] = [{} for _ in self.bands]
+
+    def find(self, fp: int) -> Optional[int]:
+        """Id of the closest canonical within max_bits, or None."""
+        best, best_d = None, self.max_bits + 1
+        for (shift, mask), table in zip(self.bands, self.tables):
+            for other, chunk_id in table.get((fp >> shift) & mask, ()):
+                d = (fp ^ other).bit_count()
+                if d < best_d:
+                    best, best_d = chunk_id, d
+        return best
+
+    def add(self, fp: int, chunk_id: int):
+        for (shift, mask), table in zip(self.bands, self.tables):
+            table.setdefault((fp >> shift) & mask, []).append((fp, chunk_id))
+
+
+def assign_canonicals(entries: Iterable[Tuple[int, int, int]], max_bits: int = DEDUP_MAX_BITS) -> Dict[int, int]:
+    """
+    Leader clustering over (priority, chunk id, fingerprint): in
+    (priority, id) order each chunk joins the closest canonical chunk
+    seen so far or becomes one. Returns {duplicate id: canonical id}.
+    Giving the previous canonicals priority 0 keeps them stable across
+    incremental runs, so unchanged chunks are not re-embedded.
+    """
+    index = NearDupIndex(max_bits)
+    dup_of: Dict[int, int] = {}
+    for _, chunk_id, fp in sorted(entries):
+        if not fp:
+            continue   # no words: nothing to compare
+        leader = index.find(fp)
+        if leader is None:
+            index.add(fp, chunk_id)
+        else:
+            dup_of[chunk_id] = leader
+    return dup_of
@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .chunking import content_sha
+
+try:
+    import fcntl
+except ImportError:   # non-POSIX: no cross-process lock
+    fcntl = None
+
+# reuse embeddings of unchanged chunk text across builds
+EMBED_CACHE = os.getenv("RAG_EMBED_CACHE", "1") == "1"
+EMBED_CACHE_DIR = os.getenv("RAG_EMBED_CACHE_DIR", os.path.join(os.path.dirname(__file__), "data", "embed_cache"))
+# float32 (exact) | float16 (half the disk, ~1e-3 relative error)
+EMBED_CACHE_DTYPE = os.getenv("RAG_EMBED_CACHE_DTYPE", "float32")
+
+# sorted key table: 16-byte content key -> row of the vectors file
+KEY_DTYPE = np.dtype([("key", "S16"), ("row", "<i8")])
+
+def chunk_key(chunk: Dict) -> bytes:
+    """Cache key of a chunk record: its content sha (computed if the record predates "sha")."""
+    sha = chunk.get("sha") or content_sha(chunk.get("content") or "")
+    return bytes.fromhex(sha)[:16]
+
+
+
+class ChunkKeys:
+    """
+    chunk id -> content key of every chunk in one index directory
+    (chunk_keys.npy, sorted by id), so serving can look up exact
+    vectors in the embedding cache without parsing meta.jsonl records.
+    """
+
+    FILE = "chunk_keys.npy"
+    DTYPE = np.dtype([("id", "<i8"), ("key", "S16")])
+
+    def __init__(self, table: np.ndarray):
+        self.table = table
+
+    @classmethod
+    def build(cls, ids: Iterable[int], keys: bytes) -> "ChunkKeys":
+        ids = np.fromiter(ids, dtype=np.int64)
+        table = np.empty(len(ids), dtype=cls.DTYPE)
+        table["id"] = ids
+        table["key"] = np.frombuffer(keys, dtype="S16")
+        table.sort(order="id")
+        return cls(table)
+
+    def save(self, index_dir: str):
+        path = os.path.join(index_dir, self.FILE)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, self.table)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True) -> Optional["ChunkKeys"]:
+        path = os.path.join(index_dir, cls.FILE)
+        if not os.path.exists(path):
+            return None
+        return cls(np.load(path, mmap_mode="r" if mmap else None))
+
+    def get(self, ids: List[int]) -> List[bytes]:
+        """Keys of the ids, b"" for ids not in the table."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.table) or not len(ids):
+            return [b""] * len(ids)
+        pos = np.minimum(np.searchsorted(self.table["id"], ids), len(self.table) - 1)
+        found = self.table["id"][pos] == ids
+        return [k if ok else b"" for k, ok in zip(self.table["key"][pos].tolist(), found.tolist())]
+
+
+class EmbeddingCache:
+    """
+    Content-addressed store of encoder outputs for one (model, normalize,
+    dim) namespace: an append-only memory-mapped matrix (vectors-<gen>.bin)
+    plus a sorted key table (keys-<gen>.npy) looked up with searchsorted.
+    info.json names the live generation, so gc() can compact into new
+    files and switch over atomically. One writer process at a time
+    (flock); threads of that process may share the instance.
+    """
+
+    def __init__(self, model_name: str, normalize: bool, dim: int, root: str = EMBED_CACHE_DIR,
+                 dtype: str = EMBED_CACHE_DTYPE, readonly: bool = False):
+        self.dir = self.dir_for(model_name, normalize, dim, root)
+        self.readonly = readonly
+        self._lock_f = None
+        if not readonly:
+            os.makedirs(self.dir, exist_ok=True)
+            self._lock_f = open(os.path.join(self.dir, ".lock"), "a+")
+            if fcntl is not None:
+                fcntl.flock(self._lock_f, fcntl.LOCK_EX)
+        info = self._read_info()
+        self.dim = dim
+        # an existing cache keeps the dtype it was created with
+        self.dtype = np.dtype(info.get("dtype", dtype))
+        self.generation = int(info.get("generation", 0))
+        self.model_name, self.normalize = model_name, normalize
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self._table = self._load_table()
+        self._pending: Dict[bytes, int] = {}
+        self._mu = threading.RLock()   # shard builds share one cache across threads
+        self._out = None
+        if not readonly:
+            self._write_info(model_name, normalize)
+            self._out = open(self._vectors_path(), "a+b")
+        # a crash can leave a torn last row; new rows overwrite it
+        path = self._vectors_path()
+        self.rows = os.path.getsize(path) // self.row_bytes if os.path.exists(path) else 0
+        self._vec: Optional[np.memmap] = None
+        self.hits = self.misses = 0
+        if readonly and self.rows:
+            self._vectors()   # map now: a later gc() may unlink this generation
+
+    @staticmethod
+    def dir_for(model_name: str, normalize: bool, dim: int, root: str = EMBED_CACHE_DIR) -> str:
+        ns = hashlib.sha1(f"{model_name}|{normalize}|{dim}".encode("utf-8")).hexdigest()[:12]
+        safe = re.sub(r"[^A-Za-z0-9._-]+", "_", model_name)[-40:]
+        return os.path.join(root, f"{safe}-{ns}")
+
+    @classmethod
+    def open_readonly(cls, model_name: str, normalize: bool, dim: int,
+                      root: str = EMBED_CACHE_DIR) -> Optional["EmbeddingCache"]:
+        """Lock-free view for serving (exact re-scoring); None if no cache was built."""
+        if not os.path.exists(os.path.join(cls.dir_for(model_name, normalize, dim, root), "info.json")):
+            return None
+        try:
+            return cls(model_name, normalize, dim, root, readonly=True)
+        except FileNotFoundError:   # raced a gc switch-over
+            return None
+
+    # ---- files ----
+    def _info_path(self) -> str:
+        return os.path.join(self.dir, "info.json")
+
+    def _vectors_path(self, gen: Optional[int] = None) -> str:
+        return os.path.join(self.dir, f"vectors-{self.generation if gen is None else gen}.bin")
+
+    def _keys_path(self, gen: Optional[int] = None) -> str:
+        return os.path.join(self.dir, f"keys-{self.generation if gen is None else gen}.npy")
+
+    def _read_info(self) -> Dict:
+        if not os.path.exists(self._info_path()):
+            return {}
+        with open(self._info_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_info(self, model_name: str, normalize: bool):
+        with open(self._info_path() + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"model": model_name, "normalize": normalize, "dim": self.dim,
+                       "dtype": self.dtype.name, "generation": self.generation}, f, indent=2)
+        os.replace(self._info_path() + ".tmp", self._info_path())
+
+    def _load_table(self) -> np.ndarray:
+        path = self._keys_path()
+        return np.load(path) if os.path.exists(path) else np.empty(0, dtype=KEY_DTYPE)
+
+    def _vectors(self) -> np.ndarray:
+        # (re)map after appends so new rows are visible
+        if self._vec is None or len(self._vec) < self.rows:
+            if self._out is not None:
+                self._out.flush()
+            self._vec = np.memmap(self._vectors_path(), dtype=self.dtype, mode="r", shape=(self.rows, self.dim))
+        return self._vec
+
+    def __len__(self):
+        return len(self._table) + len(self._pending)
+
+    # ---- lookups ----
+    def _rows_for(self, keys: List[bytes]) -> np.ndarray:
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._table):
+            karr = np.array(keys, dtype="S16")
+            pos = np.minimum(np.searchsorted(self._table["key"], karr), len(self._table) - 1)
+            found = self._table["key"][pos] == karr
+            rows[found] = self._table["row"][pos[found]]
+        if self._pending:
+            for i in np.nonzero(rows < 0)[0]:
+                rows[i] = self._pending.get(keys[i], -1)
+        return rows
+
+    def get(self, keys: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """(hit mask, float32 vectors) for the keys; rows of misses are zero."""
+        with self._mu:
+            out = np.zeros((len(keys), self.dim), dtype=np.float32)
+            rows = self._rows_for(keys)
+            mask = rows >= 0
+            if mask.any():
+                out[mask] = self._vectors()[rows[mask]]
+            n_hits = int(mask.sum())
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+            return mask, out
+
+    def put(self, keys: List[bytes], vectors: np.ndarray):
+        """Append vectors for keys not stored yet (visible to get() at once, durable after flush())."""
+        with self._mu:
+            if self.readonly:
+                raise RuntimeError("embedding cache opened read-only")
+            rows = self._rows_for(keys)
+            new, seen = [], set()
+            for i, k in enumerate(keys):
+                if rows[i] < 0 and k not in seen:
+                    seen.add(k)
+                    new.append(i)
+            if not new:
+                return
+            self._out.seek(self.rows * self.row_bytes)
+            self._out.truncate()
+            self._out.write(np.ascontiguousarray(vectors[new], dtype=self.dtype).tobytes())
+            for i in new:
+                self._pending[keys[i]] = self.rows
+                self.rows += 1
+
+    def flush(self):
+        """Publish appended rows: merge them into the sorted key table."""
+        with self._mu:
+            if self.readonly:
+                return
+            self._out.flush()
+            os.fsync(self._out.fileno())
+            if not self._pending:
+                return
+            add = np.empty(len(self._pending), dtype=KEY_DTYPE)
+            add["key"] = list(self._pending)
+            add["row"] = list(self._pending.values())
+            table = np.concatenate([self._table, add])
+            table.sort(order="key")
+            tmp = self._keys_path() + ".tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, table)
+            os.replace(tmp, self._keys_path())
+            self._table = table
+            self._pending.clear()
+
+    def gc(self, live: Iterable[bytes]) -> int:
+        """Drop entries whose key is not in `live`; returns how many were removed."""
+        self.flush()
+        live_arr = np.array(sorted(set(live)), dtype="S16")
+        keep = np.isin(self._table["key"], live_arr)
+        removed = int((~keep).sum())
+        if not removed:
+            return 0
+        kept = self._table[keep]
+        gen = self.generation + 1
+        src = self._vectors()
+        with open(self._vectors_path(gen), "wb") as f:
+            for start in range(0, len(kept), 65536):
+                f.write(np.ascontiguousarray(src[kept["row"][start:start + 65536]]).tobytes())
+            os.fsync(f.fileno())
+        table = kept.copy()
+        table["row"] = np.arange(len(kept))
+        np.save(self._keys_path(gen), table)
+        old = self.generation
+        self._vec = None
+        self._out.close()
+        self.generation = gen
+        self._write_info(self.model_name, self.normalize)   # the switch-over
+        for path in (self._vectors_path(old), self._keys_path(old)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._table, self.rows = table, len(table)
+        self._out = open(self._vectors_path(), "a+b")
+        return removed
+
+    def stats(self) -> Dict:
+        return {"entries": len(self), "bytes": self.rows * self.row_bytes, "dtype": self.dtype.name,
+                "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.flush()
+        self._vec = None
+        if self._out is not None:
+            self._out.close()
+        if self._lock_f is not None:
+            if fcntl is not None:
+                fcntl.flock(self._lock_f, fcntl.LOCK_UN)
+            self._lock_f.close()
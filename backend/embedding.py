@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# torch (default) | onnx (ONNX Runtime through sentence-transformers; needs optimum[onnxruntime])
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+# which export of the hub repo to run with the onnx backend; the generic fp32 one by default.
+# CPU-specific int8 exports (e.g. onnx/model_qint8_avx512.onnx) only load where the repo ships them
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model.onnx")
+# torch backend only: dynamic int8 quantization of the Linear layers
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "0") == "1"
+# intra-op threads for torch / ONNX Runtime; 0 = library default (all cores)
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+# padded tokens per forward pass; short texts get bigger batches, long ones smaller
+EMBED_TOKEN_BUDGET = int(os.getenv("EMBED_TOKEN_BUDGET", "4096"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "256"))
+# progress bars only for build-sized encodes, never for request-time queries
+PROGRESS_MIN = 1000
+
+CHARS_PER_TOKEN = 4   # cheap length estimate; avoids tokenizing twice
+
+def _set_torch_threads(n: int):
+    if n > 0:
+        import torch
+        torch.set_num_threads(n)
+
+def _load_model(name: str, backend: str, quantize: bool, threads: int):
+    from sentence_transformers import SentenceTransformer
+    if backend == "onnx":
+        try:
+            import onnxruntime as ort
+            opts = ort.SessionOptions()
+            if threads > 0:
+                opts.intra_op_num_threads = threads
+            kwargs = {"provider": "CPUExecutionProvider", "session_options": opts}
+            if EMBED_ONNX_FILE:
+                kwargs["file_name"] = EMBED_ONNX_FILE
+            return SentenceTransformer(name, backend="onnx", model_kwargs=kwargs, device="cpu")
+        except ImportError as e:
+            print(f"[embedding] ONNX backend unavailable ({e}); using torch")
+    _set_torch_threads(threads)
+    model = SentenceTransformer(name)
+    if quantize and str(model.device) == "cpu":
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class EmbeddingEngine:
+    """
+    Wraps a sentence-transformers model with the same encode() contract
+    (list of texts -> float32 array) plus:
+
+    - length-bucketed batching: texts are sorted by length and cut into
+      batches under a padded-token budget, so a batch of short queries
+      is not padded to the longest chunk and long chunks don't blow up
+      activation memory;
+    - configurable intra-op threads and an optional ONNX Runtime /
+      int8-quantized model for CPU-only hosts;
+    - no progress bar for request-time encodes.
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", model=None, backend: str = EMBED_BACKEND,
+                 quantize: bool = EMBED_QUANTIZE, threads: int = EMBED_THREADS,
+                 token_budget: int = EMBED_TOKEN_BUDGET, max_batch: int = EMBED_MAX_BATCH):
+        self.model_name = model_name
+        self.backend = backend if model is None else "custom"
+        self.quantize = quantize and model is None
+        if model is None:
+            model = _load_model(model_name, backend, quantize, threads)
+        else:
+            _set_torch_threads(threads)
+        self.model = model
+        self.token_budget = max(1, token_budget)
+        self.max_batch = max(1, max_batch)
+        self.max_tokens = int(getattr(model, "max_seq_length", None) or 512)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def _batches(self, texts: List[str]) -> List[np.ndarray]:
+        est = np.minimum(np.fromiter((len(t) // CHARS_PER_TOKEN + 2 for t in texts), dtype=np.int64,
+                                     count=len(texts)), self.max_tokens)
+        order = np.argsort(-est, kind="stable")
+        out, i = [], 0
+        while i < len(order):
+            # longest text of the batch comes first, so it sets the padded length
+            size = int(max(1, min(self.max_batch, self.token_budget // int(est[order[i]]))))
+            out.append(order[i:i + size])
+            i += size
+        return out
+
+    def encode(self, texts: List[str], show_progress_bar: Optional[bool] = None, **_) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        if show_progress_bar is None:
+            show_progress_bar = len(texts) >= PROGRESS_MIN
+        batches = self._batches(texts)
+        if show_progress_bar:
+            from tqdm import tqdm
+            batches = tqdm(batches, desc="encode", unit="batch")
+        out = None
+        for idx in batches:
+            emb = self.model.encode([texts[i] for i in idx], batch_size=len(idx), convert_to_numpy=True,
+                                    show_progress_bar=False)
+            if out is None:
+                out = np.empty((len(texts), emb.shape[1]), dtype=np.float32)
+            out[idx] = emb
+        return out
+
+
+def as_engine(model, model_name: str) -> EmbeddingEngine:
+    """Reuse an engine, wrap an already-loaded model, or load `model_name`."""
+    if isinstance(model, EmbeddingEngine):
+        return model
+    return EmbeddingEngine(model_name, model=model)
+
+
+def parity(engine: EmbeddingEngine, reference: EmbeddingEngine, texts: List[str]) -> Dict:
+    """Cosine similarity between the two engines' embeddings of the same texts, plus timings."""
+    t0 = time.perf_counter()
+    a = reference.encode(texts, show_progress_bar=False)
+    t1 = time.perf_counter()
+    b = engine.encode(texts, show_progress_bar=False)
+    t2 = time.perf_counter()
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    cos = (a * b).sum(axis=1)
+    # single-query latency, the request-time path
+    q = texts[: min(32, len(texts))]
+    t3 = time.perf_counter()
+    for t in q:
+        reference.encode([t])
+    t4 = time.perf_counter()
+    for t in q:
+        engine.encode([t])
+    t5 = time.perf_counter()
+    return {
+        "texts": len(texts),
+        "cos_min": float(cos.min()),
+        "cos_mean": float(cos.mean()),
+        "reference_batch_secs": round(t1 - t0, 3),
+        "engine_batch_secs": round(t2 - t1, 3),
+        "reference_query_ms": round((t4 - t3) / len(q) * 1000, 2),
+        "engine_query_ms": round((t5 - t4) / len(q) * 1000, 2),
+    }
+
+
+def _sample_texts(path: str, n: int) -> List[str]:
+    texts: List[str] = []
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    texts.append(json.loads(line).get("content") or "")
+                if len(texts) >= n:
+                    break
+    if not texts:
+        texts = [f"sample sentence {i} about refunds, shipping and password resets" * (1 + i % 8) for i in range(n)]
+    return texts
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Check an embedding backend against plain torch fp32")
+    ap.add_argument("--model", default=os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    ap.add_argument("--chunks", default=os.path.join(os.path.dirname(__file__), "data", "processed", "chunks.jsonl"))
+    ap.add_argument("--n", type=int, default=512, help="texts to compare")
+    ap.add_argument("--min-cos", type=float, default=0.99, help="fail below this cosine similarity")
+    args = ap.parse_args(argv)
+    reference = EmbeddingEngine(args.model, backend="torch", quantize=False, token_budget=10**9,
+                                max_batch=32)   # ~ SentenceTransformer.encode defaults
+    engine = EmbeddingEngine(args.model)
+    report = parity(engine, reference, _sample_texts(args.chunks, args.n))
+    report.update({"backend": engine.backend, "quantize": engine.quantize})
+    print(json.dumps(report, indent=2))
+    if report["cos_min"] < args.min_cos:
+        sys.exit(f"parity check failed: min cosine {report['cos_min']:.4f} < {args.min_cos}")
+
+if __name__ == "__main__":
+    main()
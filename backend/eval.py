@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import resource   # not on Windows
+except ImportError:
+    resource = None
+
+from .rag_pipeline import INDEX_DIR, build_context
+from .rerank import mmr_rerank
+from .filters import parse_filters
+
+# default labeled query set: one JSON object per line (see load_queries)
+EVAL_QUERIES = os.getenv("RAG_EVAL_QUERIES", os.path.join(os.path.dirname(__file__), "data", "eval", "queries.jsonl"))
+# quality metrics may drop by this much (absolute) before --baseline flags a regression
+EVAL_TOLERANCE = float(os.getenv("RAG_EVAL_TOLERANCE", "0.01"))
+
+QUALITY_KEYS = ("recall", "mrr", "ndcg")
+
+
+class StubAnswerer:
+    """
+    Deterministic stand-in for the LLM: the first sentence of context
+    block [1] with a [1] citation, after an optional fixed delay, so the
+    end-to-end stage is reproducible offline and its latency is ours.
+    """
+
+    def __init__(self, delay_ms: float = 0.0):
+        self.delay = delay_ms / 1000.0
+
+    def answer(self, question: str, context: str) -> Tuple[str, bool]:
+        """(answer, degraded) like Answerer.answer; never degraded."""
+        if self.delay:
+            time.sleep(self.delay)
+        if not context.strip():
+            return "I don't know based on the provided documents.", False
+        first = context.split("\n\n", 1)[0].split("\n", 1)[-1].strip()
+        sentence = first.split(". ", 1)[0].rstrip(".")
+        return f"{sentence[:300]}. [1]", False
+
+
+def load_queries(path: str) -> List[Dict]:
+    """
+    Labeled queries, one JSON object per line: {"q": ..., "filters": {...}}
+    plus any of "relevant_ids" (chunk ids, or {id: grade}), "relevant"
+    ([{"source", "page"?, "grade"?}]) and "relevant_text" (substrings of
+    a relevant chunk, case-insensitive). Each label is one relevant item.
+    """
+    out = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                out.append(json.loads(line))
+    return [q for q in out if q.get("q")]
+
+def _relevant_items(query: Dict) -> List[Dict]:
+    items = []
+    ids = query.get("relevant_ids") or []
+    for chunk_id, grade in (ids.items() if isinstance(ids, dict) else ((i, 1) for i in ids)):
+        items.append({"id": int(chunk_id), "grade": float(grade)})
+    for r in query.get("relevant") or []:
+        items.append({"source": r.get("source"), "page": r.get("page"), "grade": float(r.get("grade", 1))})
+    for t in query.get("relevant_text") or []:
+        items.append({"text": " ".join(t.lower().split()), "grade": 1.0})
+    return items
+
+def _matches(hit: Dict, item: Dict) -> bool:
+    if "id" in item:
+        return hit.get("id") == item["id"]
+    if "source" in item:
+        # a near-duplicate indexed once still counts for every place it occurs
+        for occ in [hit] + list(hit.get("also") or []):
+            if occ.get("source") == item["source"] and item["page"] in (None, occ.get("page")):
+                return True
+        return False
+    return item["text"] in " ".join((hit.get("content") or hit.get("text") or "").lower().split())
+
+def score_ranking(hits: List[Dict], items: List[Dict], k: int) -> Dict[str, float]:
+    """recall@k, MRR and nDCG@k of one ranking; each relevant item is credited once."""
+    found, gains, first = set(), [], 0
+    for rank, hit in enumerate(hits[:k], start=1):
+        gain = 0.0
+        for n, item in enumerate(items):
+            if n not in found and _matches(hit, item):
+                found.add(n)
+                gain = max(gain, item["grade"])
+        if gain and not first:
+            first = rank
+        gains.append(gain)
+    dcg = sum(g / math.log2(r + 1) for r, g in enumerate(gains, start=1))
+    ideal = sorted((it["grade"] for it in items), reverse=True)[:k]
+    idcg = sum(g / math.log2(r + 1) for r, g in enumerate(ideal, start=1))
+    return {"recall": len(found) / len(items), "mrr": 1.0 / first if first else 0.0,
+            "ndcg": dcg / idcg if idcg else 0.0}
+
+def _rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _latency(secs: List[float], wall: float) -> Dict[str, float]:
+    ms = np.asarray(secs) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]) if len(ms) else (0.0, 0.0, 0.0)
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3),
+            "mean_ms": round(float(ms.mean()), 3) if len(ms) else 0.0,
+            "qps": round(len(ms) / wall, 2) if wall > 0 else 0.0}
+
+def run_stage(name: str, fn: Callable[[Dict], List[Dict]], queries: List[Dict], k: int,
+              warmup: int = 5, memory_queries: int = 50) -> Dict:
+    """
+    Time fn(query) -> ranking over every query, score the rankings, then
+    replay up to `memory_queries` under tracemalloc for the stage's peak
+    Python-heap allocation (a separate pass: tracing skews the timings).
+    """
+    for query in queries[:warmup]:
+        fn(query)
+    secs, per_query, t0 = [], [], time.perf_counter()
+    for query in queries:
+        t = time.perf_counter()
+        hits = fn(query)
+        secs.append(time.perf_counter() - t)
+        per_query.append((query, hits))
+    wall = time.perf_counter() - t0
+
+    scores = []
+    for query, hits in per_query:
+        items = _relevant_items(query)
+        if items:
+            scores.append(score_ranking(hits, items, k))
+    quality = {key: round(float(np.mean([s[key] for s in scores])), 4) if scores else None for key in QUALITY_KEYS}
+
+    tracemalloc.start()
+    try:
+        for query in queries[:memory_queries]:
+            fn(query)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    out = {"queries": len(queries), "judged": len(scores), "k": k, **quality, **_latency(secs, wall),
+           "peak_alloc_mb": round(peak / 2**20, 2), "rss_peak_mb": _rss_mb()}
+    print(f"[eval] {name:<10} recall@{k}={out['recall']} mrr={out['mrr']} ndcg@{k}={out['ndcg']} "
+          f"p50={out['p50_ms']}ms p95={out['p95_ms']}ms p99={out['p99_ms']}ms qps={out['qps']} "
+          f"peak={out['peak_alloc_mb']}MB")
+    return out
+
+
+def open_vectorstore(index_dir: str):
+    """The index under index_dir, opened with the model it was built with."""
+    from .shards import ShardedVectorStore, is_sharded
+    from .vectorestore import VectorStore
+    with open(os.path.join(index_dir, "stats.json"), "r", encoding="utf-8") as f:
+        model_name = json.load(f).get("model") or "all-MiniLM-L6-v2"
+    vs = (ShardedVectorStore if is_sharded(index_dir) else VectorStore)(model_name, index_dir=index_dir)
+    vs.load()
+    return vs
+
+def index_stages(vs, queries: List[Dict], k: int, args) -> Dict[str, Dict]:
+    """VectorStore.search, MMR over its hits (as the pipeline does) and the stubbed end to end answer."""
+    from .rag_pipeline import _hit_embeddings
+    stages: Dict[str, Dict] = {}
+    depth = max(k, args.mmr_depth)
+    cache: Dict[int, List[Dict]] = {}
+
+    def search(query: Dict) -> List[Dict]:
+        hits = vs.search(query["q"], top_k=depth, filters=parse_filters(query.get("filters")))
+        cache[id(query)] = hits
+        return hits
+    stages["search"] = run_stage("search", search, queries, k, args.warmup, args.memory_queries)
+
+    def mmr(query: Dict) -> List[Dict]:
+        hits = [dict(h) for h in cache[id(query)]]
+        return mmr_rerank(hits, top_n=k, lambda_mult=args.mmr_lambda, embeddings=_hit_embeddings(vs, hits))
+    stages["mmr"] = run_stage("mmr", mmr, queries, k, args.warmup, args.memory_queries)
+
+    stub = StubAnswerer(args.llm_ms)
+    def pipeline(query: Dict) -> List[Dict]:
+        hits = search(query)
+        reranked = mmr_rerank(hits, top_n=k, lambda_mult=args.mmr_lambda, embeddings=_hit_embeddings(vs, hits))
+        stub.answer(query["q"], build_context(reranked))
+        return reranked
+    stages["pipeline"] = run_stage("pipeline", pipeline, queries, k, args.warmup, args.memory_queries)
+    return stages
+
+def upload_stage(path: str, queries: List[Dict], k: int, args) -> Dict:
+    """_retrieve over a session built from one .pdf/.txt the way /upload chunks it; judge with relevant_text."""
+    from .app import _build_index, _build_lexicon, _clean_text, _iter_pdf_pages, _iter_txt_pieces, _retrieve
+    from .chunking import StreamChunker
+    t0 = time.perf_counter()
+    with open(path, "rb") as f:
+        if path.lower().endswith(".pdf"):
+            from pypdf import PdfReader
+            pieces = _iter_pdf_pages(PdfReader(f))
+        else:
+            pieces = _iter_txt_pieces(f, os.path.getsize(path))
+        chunker = StreamChunker()
+        chunks: List[str] = []
+        for text, _ in pieces:
+            chunks.extend(c for c in map(_clean_text, chunker.feed(text)) if c)
+        chunks.extend(c for c in map(_clean_text, chunker.finish()) if c)
+    vec, X = _build_index(chunks)
+    lex = _build_lexicon(chunks, vec)
+    build = time.perf_counter() - t0
+
+    # only text labels can be judged against an upload (it has no chunk ids or sources)
+    judged = [{"q": q["q"], "relevant_text": q.get("relevant_text") or []} for q in queries]
+    out = run_stage("upload", lambda query: _retrieve(vec, X, chunks, query["q"], top_k=k, lex=lex),
+                    judged, k, args.warmup, args.memory_queries)
+    out.update(file=os.path.basename(path), chunks=len(chunks), build_secs=round(build, 3))
+    return out
+
+
+def synthesize_queries(chunks_jsonl: str, n: int, seed: int = 0) -> List[Dict]:
+    """Known-item queries: a sentence from a random indexed chunk, relevant to that chunk only."""
+    with open(chunks_jsonl, "r", encoding="utf-8") as f:
+        recs = [r for r in map(json.loads, f) if "dup_of" not in r and r.get("content")]
+    rng = random.Random(seed)
+    out = []
+    for r in rng.sample(recs, min(n, len(recs))):
+        sentences = [s.strip() for s in r["content"].split(". ") if len(s.split()) >= 5]
+        text = rng.choice(sentences) if sentences else r["content"]
+        out.append({"q": " ".join(text.split()[:24]), "relevant_ids": [r["id"]]})
+    return out
+
+def compare(current: Dict, baseline: Dict, tolerance: float = EVAL_TOLERANCE,
+            max_latency_ratio: Optional[float] = None) -> List[str]:
+    """Regressions of current vs baseline: quality drops beyond `tolerance`, p95 growth beyond the ratio."""
+    problems = []
+    for name, stage in current.get("stages", {}).items():
+        old = baseline.get("stages", {}).get(name)
+        if not old:
+            continue
+        for key in QUALITY_KEYS:
+            if stage.get(key) is not None and old.get(key) is not None and stage[key] < old[key] - tolerance:
+                problems.append(f"{name}.{key}: {old[key]} -> {stage[key]}")
+        if max_latency_ratio and old.get("p95_ms") and stage["p95_ms"] > old["p95_ms"] * max_latency_ratio:
+            problems.append(f"{name}.p95_ms: {old['p95_ms']} -> {stage['p95_ms']}")
+    return problems
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Offline retrieval quality + latency evaluation")
+    ap.add_argument("--queries", default=EVAL_QUERIES, help="labeled query set (JSONL)")
+    ap.add_argument("--index-dir", default=INDEX_DIR)
+    ap.add_argument("--k", type=int, default=6)
+    ap.add_argument("--mmr-depth", type=int, default=8, help="hits fetched for MMR to rerank down to k")
+    ap.add_argument("--mmr-lambda", type=float, default=0.7)
+    ap.add_argument("--upload-file", help="also evaluate _retrieve over this .pdf/.txt")
+    ap.add_argument("--no-index", action="store_true", help="skip the vector index stages")
+    ap.add_argument("--llm-ms", type=float, default=0.0, help="fixed delay of the stub LLM")
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--memory-queries", type=int, default=50)
+    ap.add_argument("--synthesize", type=int, default=0, metavar="N",
+                    help="write N known-item queries from --chunks to --queries and exit")
+    ap.add_argument("--chunks", default=os.path.join(os.path.dirname(__file__), "data", "processed", "chunks.jsonl"))
+    ap.add_argument("--out", help="write the results JSON here")
+    ap.add_argument("--baseline", help="results JSON of an earlier run; exit 1 on regressions")
+    ap.add_argument("--tolerance", type=float, default=EVAL_TOLERANCE)
+    ap.add_argument("--max-latency-ratio", type=float, help="also fail when a stage's p95 grows by more than this factor")
+    args = ap.parse_args(argv)
+
+    if args.synthesize:
+        queries = synthesize_queries(args.chunks, args.synthesize)
+        os.makedirs(os.path.dirname(os.path.abspath(args.queries)), exist_ok=True)
+        with open(args.queries, "w", encoding="utf-8") as f:
+            for q in queries:
+                f.write(json.dumps(q, ensure_ascii=False) + "\n")
+        print(f"[eval] wrote {len(queries)} queries to {args.queries}")
+        return 0
+
+    queries = load_queries(args.queries)
+    if not queries:
+        print(f"[eval] no queries in {args.queries}")
+        return 2
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "queries_path": args.queries,
+               "k": args.k, "python": platform.python_version(), "stages": {}}
+    if not args.no_index:
+        vs = open_vectorstore(args.index_dir)
+        with open(os.path.join(args.index_dir, "stats.json"), "r", encoding="utf-8") as f:
+            stats = json.load(f)
+        results["index"] = {"dir": args.index_dir, "model": stats.get("model"), "count": stats.get("count"),
+                            "index_type": stats.get("index_type"), "version": stats.get("version")}
+        results["stages"].update(index_stages(vs, queries, args.k, args))
+    if args.upload_file:
+        results["stages"]["upload"] = upload_stage(args.upload_file, queries, args.k, args)
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"[eval] results -> {args.out}")
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance, args.max_latency_ratio)
+        for p in problems:
+            print(f"[eval] REGRESSION {p}")
+        if problems:
+            return 1
+        print("[eval] no regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
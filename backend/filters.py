@@ -0,0 +1,228 @@
+import os
+import json
+import shutil
+from array import array
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .metastore import iter_meta_lines
+
+# exact-match fields (one code per chunk) and integer range fields
+CATEGORICAL_FIELDS = ("source", "path")
+NUMERIC_FIELDS = ("page", "modified")
+FILTER_FIELDS = CATEGORICAL_FIELDS + NUMERIC_FIELDS
+MISSING = -1   # page of a .txt chunk, modified of a record from before ingest stored it
+
+def _to_int(field: str, v: Any) -> int:
+    if isinstance(v, bool):
+        raise ValueError(f"filter {field!r}: expected a number, got {v!r}")
+    if isinstance(v, (int, float)):
+        return int(v)
+    if field == "modified" and isinstance(v, str):
+        # ISO date / datetime; naive values are taken as UTC
+        try:
+            dt = datetime.fromisoformat(v)
+        except ValueError:
+            raise ValueError(f"filter 'modified': {v!r} is not an ISO date or a unix timestamp")
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp())
+    raise ValueError(f"filter {field!r}: expected a number, got {v!r}")
+
+def parse_filters(spec: Optional[Dict]) -> Optional[Dict[str, Dict]]:
+    """
+    Validate a /query filter object into {field: {"in": [...]} | {"gte": a, "lte": b}}:
+
+        {"source": "a.pdf"}                 exact match (a list matches any)
+        {"page": 3} / {"page": [1, 2]}
+        {"page": {"gte": 3, "lt": 8}}        ranges: gt / gte / lt / lte
+        {"modified": {"gte": "2024-01-01"}}  ISO dates or unix seconds
+
+    Fields combine with AND. Raises ValueError on anything else.
+    """
+    if not spec:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError("filters must be an object")
+    out: Dict[str, Dict] = {}
+    for field, cond in spec.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"unknown filter field {field!r}; expected one of {FILTER_FIELDS}")
+        if isinstance(cond, dict) and "in" in cond and len(cond) == 1:
+            cond = cond["in"]
+        if field in CATEGORICAL_FIELDS:
+            values = cond if isinstance(cond, list) else [cond]
+            if not all(isinstance(v, str) for v in values):
+                raise ValueError(f"filter {field!r}: expected a string or a list of strings")
+            out[field] = {"in": sorted(set(values))}
+        elif isinstance(cond, dict):
+            bad = set(cond) - {"gt", "gte", "lt", "lte"}
+            if bad or not cond:
+                raise ValueError(f"filter {field!r}: range keys are gt, gte, lt, lte")
+            lo, hi = None, None
+            if "gte" in cond:
+                lo = _to_int(field, cond["gte"])
+            if "gt" in cond:
+                lo = max(lo if lo is not None else MISSING, _to_int(field, cond["gt"]) + 1)
+            if "lte" in cond:
+                hi = _to_int(field, cond["lte"])
+            if "lt" in cond:
+                v = _to_int(field, cond["lt"]) - 1
+                hi = v if hi is None else min(hi, v)
+            # missing values (-1) never match a range
+            out[field] = {"gte": max(lo if lo is not None else 0, 0), "lte": hi}
+        else:
+            values = cond if isinstance(cond, list) else [cond]
+            out[field] = {"in": sorted({_to_int(field, v) for v in values})}
+    return out
+
+def filter_key(filters: Optional[Dict]) -> str:
+    """Canonical string of parsed filters, for cache keys."""
+    return json.dumps(filters, sort_keys=True) if filters else ""
+
+
+class FilterColumns:
+    """
+    Filter fields of records appended in meta.jsonl order, kept as compact
+    arrays. Every occurrence of a record is a filter row: the record itself
+    plus each near-duplicate listed in its "also".
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.occ_row = array("q")   # meta.jsonl row of each occurrence
+        self.codes = {f: array("i") for f in CATEGORICAL_FIELDS}
+        self.values = {f: array("q") for f in NUMERIC_FIELDS}
+        self.vocab: Dict[str, Dict[str, int]] = {f: {} for f in CATEGORICAL_FIELDS}
+
+    def add(self, chunk_id: int, rec: Dict):
+        row = len(self.ids)
+        self.ids.append(int(chunk_id))
+        for occ in [rec] + (rec.get("also") or []):
+            self.occ_row.append(row)
+            for f in CATEGORICAL_FIELDS:
+                v = occ.get(f)
+                self.codes[f].append(MISSING if v is None else self.vocab[f].setdefault(str(v), len(self.vocab[f])))
+            for f in NUMERIC_FIELDS:
+                v = occ.get(f)
+                self.values[f].append(MISSING if v is None else int(v))
+
+    def finish(self) -> "FilterIndex":
+        arrays = {"ids": np.frombuffer(self.ids, dtype=np.int64).copy(),
+                  "occ_row": np.frombuffer(self.occ_row, dtype=np.int64).copy()}
+        for f in CATEGORICAL_FIELDS:
+            n_values = len(self.vocab[f])
+            c = np.frombuffer(self.codes[f], dtype=np.int32)
+            present = np.nonzero(c >= 0)[0]
+            order = present[np.argsort(c[present], kind="stable")]   # rows stay ascending per value
+            ptr = np.zeros(n_values + 1, dtype=np.int64)
+            np.cumsum(np.bincount(c[present], minlength=n_values), out=ptr[1:])
+            arrays[f], arrays[f + "_ptr"], arrays[f + "_rows"] = c.copy(), ptr, order.astype(np.int64)
+        for f in NUMERIC_FIELDS:
+            v = np.frombuffer(self.values[f], dtype=np.int64).copy()
+            order = np.argsort(v, kind="stable")
+            arrays[f], arrays[f + "_order"], arrays[f + "_sorted"] = v, order, v[order]
+        return FilterIndex(arrays, {f: list(self.vocab[f]) for f in CATEGORICAL_FIELDS})
+
+
+class FilterIndex:
+    """
+    Per-field lookup structures over the chunks of one index, written
+    next to it as filters/*.npy and loaded memory-mapped:
+
+    - ids.npy: chunk id of every row (meta.jsonl line order, the same
+      rows as the BM25 index);
+    - occ_row.npy: the row of every occurrence (a chunk plus the
+      near-duplicates folded into it), which is what fields describe;
+    - categorical fields: a code per occurrence plus CSR postings
+      (occurrences of each value), so an exact match costs O(matches);
+    - numeric fields: the value per occurrence plus the occurrences (and
+      values) sorted by value, so a range is two searchsorted calls.
+
+    select() intersects the per-field occurrence sets, so all conditions
+    hold for one occurrence, and maps them to rows; search passes the
+    resulting ids to FAISS as an IDSelector.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], vocab: Dict[str, List[str]]):
+        self.arrays = arrays
+        self.ids = arrays["ids"]
+        self.occ_row = arrays.get("occ_row")   # absent in indexes built before dedup: one occurrence per row
+        self.vocab = vocab
+        self._codes = {f: {v: i for i, v in enumerate(vocab[f])} for f in CATEGORICAL_FIELDS}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, records) -> "FilterIndex":
+        """From (chunk id, record) pairs in meta.jsonl order."""
+        cols = FilterColumns()
+        for chunk_id, rec in records:
+            cols.add(chunk_id, rec)
+        return cols.finish()
+
+    @classmethod
+    def from_meta(cls, meta_path: str) -> "FilterIndex":
+        return cls.build((chunk_id, json.loads(line)) for chunk_id, line in iter_meta_lines(meta_path))
+
+    @staticmethod
+    def dir_for(index_dir: str) -> str:
+        return os.path.join(index_dir, "filters")
+
+    def save(self, index_dir: str):
+        """Write into a fresh directory, then swap it in for the previous one."""
+        final = self.dir_for(index_dir)
+        tmp, old = final + ".tmp", final + ".old"
+        for d in (tmp, old):
+            shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, arr in self.arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), arr)
+        with open(os.path.join(tmp, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f, ensure_ascii=False)
+        if os.path.exists(final):
+            os.replace(final, old)
+        os.replace(tmp, final)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True) -> Optional["FilterIndex"]:
+        d = cls.dir_for(index_dir)
+        if not os.path.exists(os.path.join(d, "vocab.json")):
+            return None
+        with open(os.path.join(d, "vocab.json"), "r", encoding="utf-8") as f:
+            vocab = json.load(f)
+        arrays = {name[:-4]: np.load(os.path.join(d, name), mmap_mode="r" if mmap else None)
+                  for name in os.listdir(d) if name.endswith(".npy")}
+        return cls(arrays, vocab)
+
+    def _rows(self, field: str, cond: Dict) -> np.ndarray:
+        if field in CATEGORICAL_FIELDS:
+            ptr, rows = self.arrays[field + "_ptr"], self.arrays[field + "_rows"]
+            parts = [rows[ptr[c]:ptr[c + 1]] for c in (self._codes[field].get(v) for v in cond["in"]) if c is not None]
+            return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        order, sorted_vals = self.arrays[field + "_order"], self.arrays[field + "_sorted"]
+        if "in" in cond:
+            parts = [order[np.searchsorted(sorted_vals, v, "left"):np.searchsorted(sorted_vals, v, "right")]
+                     for v in cond["in"]]
+            return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        lo = np.searchsorted(sorted_vals, cond["gte"], "left")
+        hi = len(sorted_vals) if cond["lte"] is None else np.searchsorted(sorted_vals, cond["lte"], "right")
+        return np.sort(order[lo:max(lo, hi)])
+
+    def select(self, filters: Dict[str, Dict]) -> np.ndarray:
+        """Sorted rows with an occurrence matching every (parsed) filter."""
+        occ: Optional[np.ndarray] = None
+        # most selective field first keeps the intersections small
+        for part in sorted((self._rows(f, c) for f, c in filters.items()), key=len):
+            occ = part if occ is None else np.intersect1d(occ, part, assume_unique=True)
+            if not len(occ):
+                break
+        if occ is None:
+            return np.arange(len(self.ids))
+        if self.occ_row is None or len(self.occ_row) == len(self.ids):
+            return occ   # no folded duplicates: occurrences are rows
+        return np.unique(self.occ_row[occ])
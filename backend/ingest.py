@@ -1,8 +1,15 @@
 import os
+import sys
 import json
-from typing import List, Dict
+import signal
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
 from pypdf import PdfReader
-from .chunking import clean_text, build_chunk_records
+from .chunking import build_chunk_records
+from .dedup import DEDUP, simhash, fingerprint, occurrence, assign_canonicals
 
 # Try to import chardet; fall back gracefully
 try:
@@ -13,19 +20,31 @@ except Exception:
 RAW_DIR = os.path.join(os.path.dirname(__file__), "data", "raw")
 PROCESSED_DIR = os.path.join(os.path.dirname(__file__), "data", "processed")
 OUTPUT_JSONL = os.path.join(PROCESSED_DIR, "chunks.jsonl")
+# path -> {size, mtime, sha256, ids} for every file ingested so far
+MANIFEST_PATH = os.path.join(PROCESSED_DIR, "manifest.json")
+# upserts/tombstones not yet applied to the FAISS index (consumed by build_index)
+DELTA_JSONL = os.path.join(PROCESSED_DIR, "delta.jsonl")
+
+# extraction runs in a process pool (pypdf is CPU-bound); 1 = in-process
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+# a single file (or page range) taking longer than this is skipped
+INGEST_FILE_TIMEOUT = float(os.getenv("INGEST_FILE_TIMEOUT", "300"))
+# PDFs with more pages than this are split into page ranges across workers (0 = never)
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "50"))
 
 def ensure_dirs():
     os.makedirs(RAW_DIR, exist_ok=True)
     os.makedirs(PROCESSED_DIR, exist_ok=True)
 
-def read_pdf(path: str) -> List[Dict]:
+def read_pdf(path: str, pages: Optional[range] = None) -> List[Dict]:
     reader = PdfReader(path)
     out: List[Dict] = []
-    for i, page in enumerate(reader.pages):
-        raw = page.extract_text() or ""
-        txt = clean_text(raw)
-        if txt:
-            out.extend(build_chunk_records(os.path.basename(path), i + 1, txt))
+    if pages is None:
+        pages = range(len(reader.pages))
+    for i in pages:
+        raw = reader.pages[i].extract_text() or ""
+        if raw.strip():
+            out.extend(build_chunk_records(os.path.basename(path), i + 1, raw))
     return out
 
 def detect_encoding(path: str) -> str:
@@ -48,38 +67,334 @@ def read_txt(path: str) -> List[Dict]:
     except Exception:
         with open(path, "r", encoding="utf-8", errors="ignore") as f:
             raw = f.read()
-    txt = clean_text(raw)
-    if not txt:
+    if not raw.strip():
         return []
-    return build_chunk_records(os.path.basename(path), None, txt)
+    return build_chunk_records(os.path.basename(path), None, raw)
 
-def walk_and_ingest(raw_dir: str) -> List[Dict]:
-    records: List[Dict] = []
-    for root, _, files in os.walk(raw_dir):
-        for fn in files:
-            path = os.path.join(root, fn)
-            lower = fn.lower()
-            if lower.endswith(".pdf"):
-                records.extend(read_pdf(path))
-            elif lower.endswith((".txt", ".md")):
-                records.extend(read_txt(path))
-            else:
+def is_supported(fn: str) -> bool:
+    return fn.lower().endswith((".pdf", ".txt", ".md"))
+
+def read_file(path: str) -> List[Dict]:
+    if path.lower().endswith(".pdf"):
+        return read_pdf(path)
+    return read_txt(path)
+
+def walk_and_ingest(raw_dir: str) -> Iterator[Dict]:
+    """Yield chunk records for every supported file, one file at a time."""
+    files = []
+    for root, dirs, names in os.walk(raw_dir):
+        dirs.sort()
+        for fn in sorted(names):
+            if not is_supported(fn):
                 continue
-    return records
+            path = os.path.join(root, fn)
+            files.append((path, os.path.relpath(path, raw_dir).replace(os.sep, "/")))
+    for _, recs in extract_files(files):
+        yield from recs or []
 
-def write_jsonl(path: str, records: List[Dict]):
+def write_jsonl(path: str, records: Iterable[Dict]) -> int:
+    n = 0
     with open(path, "w", encoding="utf-8") as f:
         for r in records:
             f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+# -------------------------------------------------
+# Incremental ingest
+# -------------------------------------------------
+def file_sha256(path: str, block: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(block), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+def chunk_uid(rel_path: str, page: Optional[int], chunk_id: int) -> int:
+    """Stable 63-bit id for a chunk, used as its FAISS id."""
+    key = f"{rel_path}|{page}|{chunk_id}".encode("utf-8")
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], "big") & ((1 << 63) - 1)
+
+def load_manifest(path: str = MANIFEST_PATH) -> Dict:
+    if not os.path.exists(path):
+        return {"files": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest: Dict, path: str = MANIFEST_PATH):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def ingest_file(path: str, rel_path: str, pages: Optional[range] = None) -> List[Dict]:
+    records = read_pdf(path, pages) if pages is not None else read_file(path)
+    modified = int(os.path.getmtime(path))   # file mtime, unix seconds; filterable at query time
+    for r in records:
+        r["path"] = rel_path
+        r["modified"] = modified
+        r["id"] = chunk_uid(rel_path, r.get("page"), r["chunk_id"])
+        r["simhash"] = f"{simhash(r['content']):016x}"   # near-duplicate fingerprint, computed in the worker
+    return records
+
+# -------------------------------------------------
+# Parallel extraction
+# -------------------------------------------------
+class ExtractTimeout(BaseException):
+    # BaseException so parser code with broad `except Exception` can't swallow it
+    pass
+
+def _on_alarm(signum, frame):
+    raise ExtractTimeout()
+
+def _extract_task(path: str, rel_path: str, pages: Optional[range], timeout: float) -> List[Dict]:
+    """Worker entry point: extract one file or page range under a wall-clock limit."""
+    use_alarm = (timeout > 0 and hasattr(signal, "SIGALRM")
+                 and threading.current_thread() is threading.main_thread())
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return ingest_file(path, rel_path, pages)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def _split_tasks(path: str, pages_per_task: int) -> List[Optional[range]]:
+    if pages_per_task <= 0 or not path.lower().endswith(".pdf"):
+        return [None]
+    try:
+        n = len(PdfReader(path).pages)
+    except Exception:
+        return [None]
+    if n <= pages_per_task:
+        return [None]
+    return [range(i, min(i + pages_per_task, n)) for i in range(0, n, pages_per_task)]
+
+def extract_files(files: List[Tuple[str, str]], workers: int = INGEST_WORKERS,
+                  timeout: float = INGEST_FILE_TIMEOUT,
+                  pages_per_task: int = INGEST_PAGES_PER_TASK) -> Iterator[Tuple[str, Optional[List[Dict]]]]:
+    """
+    Extract + chunk (path, rel_path) pairs on a process pool.
+    Yields (rel_path, records) in input order; records is None when the
+    file failed or timed out. At most 2 * workers tasks are in flight, so
+    results stream back without queueing the whole corpus.
+    """
+    if workers <= 1:
+        for path, rel in files:
+            try:
+                yield rel, _extract_task(path, rel, None, timeout)
+            except ExtractTimeout:
+                print(f"[ingest] ✗ {rel}: timed out after {timeout:g}s, skipped")
+                yield rel, None
+            except Exception as e:
+                print(f"[ingest] ✗ {rel}: {type(e).__name__} {e}")
+                yield rel, None
+        return
+
+    # parent-side backstop for platforms without SIGALRM in the worker
+    wait = None if hasattr(signal, "SIGALRM") or timeout <= 0 else timeout
+    max_in_flight = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque = deque()   # (rel, [futures]) in submission order
+        in_flight = 0
+        it = iter(files)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and in_flight < max_in_flight:
+                nxt = next(it, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                path, rel = nxt
+                futs = [pool.submit(_extract_task, path, rel, pages, timeout)
+                        for pages in _split_tasks(path, pages_per_task)]
+                pending.append((rel, futs))
+                in_flight += len(futs)
+            if not pending:
+                break
+            rel, futs = pending.popleft()
+            records: Optional[List[Dict]] = []
+            for fut in futs:
+                try:
+                    part = fut.result(timeout=wait)
+                    if records is not None:
+                        records.extend(part)
+                except (ExtractTimeout, FutureTimeout):
+                    print(f"[ingest] ✗ {rel}: timed out after {timeout:g}s, skipped")
+                    fut.cancel()
+                    records = None
+                except Exception as e:
+                    print(f"[ingest] ✗ {rel}: {type(e).__name__} {e}")
+                    records = None
+            in_flight -= len(futs)
+            yield rel, records
+
+def scan_changes(raw_dir: str, manifest: Dict):
+    """
+    Compare data/raw with the manifest.
+    Returns (changed, unchanged, deleted): changed is a list of
+    (rel_path, abs_path, size, mtime, sha256); unchanged/deleted are rel paths.
+    Files whose size+mtime match are trusted without hashing; otherwise the
+    content hash decides (a touched-but-identical file is not re-chunked).
+    """
+    known = manifest.get("files", {})
+    changed, unchanged, seen = [], [], set()
+    for root, dirs, files in os.walk(raw_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            if not is_supported(fn):
+                continue
+            path = os.path.join(root, fn)
+            rel = os.path.relpath(path, raw_dir).replace(os.sep, "/")
+            seen.add(rel)
+            st = os.stat(path)
+            prev = known.get(rel)
+            if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime:
+                unchanged.append(rel)
+                continue
+            sha = file_sha256(path)
+            if prev and prev["sha256"] == sha:
+                prev["mtime"] = st.st_mtime
+                unchanged.append(rel)
+                continue
+            changed.append((rel, path, st.st_size, st.st_mtime, sha))
+    deleted = sorted(set(known) - seen)
+    return changed, unchanged, deleted
+
+def incremental_ingest(raw_dir: str, processed_jsonl: str = OUTPUT_JSONL,
+                       manifest_path: str = MANIFEST_PATH, delta_path: str = DELTA_JSONL) -> Dict:
+    """
+    Re-chunk only new/modified files, emit tombstones for deleted ones.
+    chunks.jsonl is rewritten by copying the lines of unchanged files
+    (no re-parsing), then near-duplicates are resolved across the whole
+    corpus (see dedup_chunks); the upserts/deletes are appended to
+    delta.jsonl for build_index to apply to the existing FAISS index.
+    """
+    manifest = load_manifest(manifest_path)
+    known = manifest.setdefault("files", {})
+    changed, unchanged, deleted = scan_changes(raw_dir, manifest)
+
+    delete_ids: List[int] = []
+    failed = set()
+    info = {rel: (size, mtime, sha) for rel, _, size, mtime, sha in changed}
+    # per line of the new chunks.jsonl: (id, fingerprint, re-extracted?, had dup_of/also/simhash)
+    lines: List[Tuple[int, int, bool, bool, bool, bool]] = []
+    tmp = processed_jsonl + ".new"   # before dedup
+    with open(tmp, "w", encoding="utf-8") as out, open(delta_path, "a", encoding="utf-8") as delta:
+        # changed files stream back from the worker pool in a deterministic order
+        for rel, records in extract_files([(path, rel) for rel, path, *_ in changed]):
+            if records is None:
+                # keep the previous version of a file we could not extract
+                failed.add(rel)
+                continue
+            size, mtime, sha = info[rel]
+            new_ids = {r["id"] for r in records}
+            old_ids = known.get(rel, {}).get("ids", [])
+            for i in old_ids:
+                if i not in new_ids:
+                    delete_ids.append(i)
+                    delta.write(json.dumps({"op": "delete", "id": i}) + "\n")
+            for r in records:
+                out.write(json.dumps(r, ensure_ascii=False) + "\n")
+                lines.append((r["id"], fingerprint(r), True, False, False, True))
+            known[rel] = {"size": size, "mtime": mtime, "sha256": sha, "ids": sorted(new_ids)}
+        for rel in deleted:
+            for i in known.pop(rel).get("ids", []):
+                delete_ids.append(i)
+                delta.write(json.dumps({"op": "delete", "id": i}) + "\n")
+
+        keep = set(unchanged) | failed
+        if os.path.exists(processed_jsonl):
+            with open(processed_jsonl, "r", encoding="utf-8") as f:
+                for line in f:
+                    rec = json.loads(line)
+                    if rec.get("path") in keep:
+                        out.write(line)
+                        lines.append((rec["id"], fingerprint(rec), False, "dup_of" in rec, "also" in rec,
+                                      "simhash" in rec))
+    with open(delta_path, "a", encoding="utf-8") as delta:
+        dd = dedup_chunks(tmp, processed_jsonl, lines, delta)
+    os.remove(tmp)
+    if os.path.getsize(delta_path) == 0:
+        os.remove(delta_path)
+    save_manifest(manifest, manifest_path)
+    return {
+        "changed_files": len(changed) - len(failed),
+        "failed_files": len(failed),
+        "deleted_files": len(deleted),
+        "unchanged_files": len(unchanged),
+        "upserts": dd["upserts"],
+        "deletes": len(delete_ids) + dd["deletes"],
+        "duplicates": dd["duplicates"],
+        "total": len(lines),
+    }
+
+def dedup_chunks(src: str, dst: str, lines: List[Tuple[int, int, bool, bool, bool, bool]], delta) -> Dict:
+    """
+    Resolve near-duplicates over every chunk of `src` (described by
+    `lines`) and write the result to `dst`: a duplicate keeps its line
+    with "dup_of" (the canonical chunk's id) and is not indexed; the
+    canonical chunk lists every duplicate occurrence in "also", so a hit
+    can cite all of them. Writes delta ops for re-extracted chunks and for
+    unchanged ones whose status or back-references changed; other lines
+    are copied without parsing. Previous canonicals are kept when possible.
+    """
+    dup_of: Dict[int, int] = {}
+    if DEDUP:
+        # previous canonicals of unchanged files first, so they stay canonical
+        dup_of = assign_canonicals((0 if not fresh and not was_dup else 1, cid, fp)
+                                   for cid, fp, fresh, was_dup, _, _ in lines)
+    also: Dict[int, List[Dict]] = {}
+    if dup_of:
+        with open(src, "r", encoding="utf-8") as f:
+            for line, (cid, *_) in zip(f, lines):
+                if cid in dup_of:
+                    also.setdefault(dup_of[cid], []).append(occurrence(json.loads(line)))
+        for occ in also.values():
+            occ.sort(key=lambda o: (str(o.get("path")), o.get("page") or 0, o["id"]))
+    upserts = deletes = 0
+    tmp = dst + ".tmp"
+    with open(src, "r", encoding="utf-8") as f, open(tmp, "w", encoding="utf-8") as out:
+        for line, (cid, fp, fresh, was_dup, had_also, has_fp) in zip(f, lines):
+            new_dup, new_also = dup_of.get(cid), also.get(cid)
+            if not (fresh or was_dup or had_also or new_dup or new_also or not has_fp):
+                out.write(line)
+                continue
+            rec = json.loads(line)
+            old_dup, old_also = rec.pop("dup_of", None), rec.pop("also", None)
+            rec["simhash"] = f"{fp:016x}"
+            if new_dup is not None:
+                rec["dup_of"] = new_dup
+            if new_also:
+                rec["also"] = new_also
+            line = json.dumps(rec, ensure_ascii=False)
+            out.write(line + "\n")
+            if new_dup is not None and (fresh or old_dup is None):
+                delta.write(json.dumps({"op": "delete", "id": cid}) + "\n")
+                deletes += 1
+            elif new_dup is None and (fresh or old_dup is not None or old_also != new_also):
+                delta.write('{"op": "upsert", "record": ' + line + "}\n")
+                upserts += 1
+    os.replace(tmp, dst)
+    return {"upserts": upserts, "deletes": deletes, "duplicates": len(dup_of)}
 
 def main():
     ensure_dirs()
-    records = walk_and_ingest(RAW_DIR)
-    if not records:
+    if "--full" in sys.argv[1:]:
+        # forget previous runs: every file is re-chunked and build_index should rebuild
+        for path in (MANIFEST_PATH, DELTA_JSONL, OUTPUT_JSONL):
+            if os.path.exists(path):
+                os.remove(path)
+    summary = incremental_ingest(RAW_DIR, OUTPUT_JSONL, MANIFEST_PATH, DELTA_JSONL)
+    if not summary["total"]:
         print("[ingest] No usable text found in data/raw. Add PDFs/TXT and rerun.")
         return
-    write_jsonl(OUTPUT_JSONL, records)
-    print(f"[ingest] Wrote {len(records)} chunk records → {OUTPUT_JSONL}")
+    print(f"[ingest] {summary['changed_files']} changed, {summary['failed_files']} failed, {summary['deleted_files']} deleted, "
+          f"{summary['unchanged_files']} unchanged file(s); {summary['upserts']} upserts, "
+          f"{summary['deletes']} tombstones → {DELTA_JSONL}")
+    if summary["duplicates"]:
+        print(f"[ingest] {summary['duplicates']} near-duplicate chunks indexed through their canonical chunk")
+    print(f"[ingest] {summary['total']} chunk records in {OUTPUT_JSONL}")
 
 if __name__ == "__main__":
     main()
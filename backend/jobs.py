@@ -0,0 +1,153 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# background upload indexing; kept apart from the query CPU pool so a burst
+# of large uploads can't starve searches
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+# queued + running jobs; beyond this /upload answers 429
+UPLOAD_MAX_PENDING = int(os.getenv("UPLOAD_MAX_PENDING", "16"))
+# how long finished jobs stay visible to the status endpoint
+JOB_TTL = float(os.getenv("UPLOAD_JOB_TTL_SECS", "3600"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobError(Exception):
+    """Raised inside a job for an expected failure; the message is shown to the client."""
+
+
+class Job:
+    """State of one background job; `progress` is free-form and updated by the job itself."""
+
+    def __init__(self, job_id: str, meta: Dict, on_change: Optional[Callable[["Job"], None]] = None):
+        self.id = job_id
+        self.meta = meta
+        self.state = QUEUED
+        self.progress: Dict[str, Any] = {}
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.future: Optional[Future] = None
+        self.on_change = on_change
+        self._lock = threading.Lock()
+
+    def update(self, **progress):
+        with self._lock:
+            self.progress.update(progress)
+        self.changed()
+
+    def changed(self):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(self)
+        except Exception as e:
+            # status publishing must never fail the job itself
+            print(f"[jobs] {self.id} status not published: {e!r}")
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            end = self.finished or time.time()
+            return {
+                "job_id": self.id,
+                "status": self.state,
+                **self.meta,
+                **self.progress,
+                "error": self.error,
+                "queued_secs": round((self.started or end) - self.created, 2),
+                "run_secs": round(end - self.started, 2) if self.started else 0.0,
+            }
+
+
+class JobQueue:
+    """
+    Bounded pool of background jobs with pollable status. submit() fails
+    fast with JobQueueFull once `max_pending` jobs are queued or running,
+    so a burst of requests can't pile up unbounded work; finished jobs
+    are forgotten after `ttl` seconds. on_change(job) is called on every
+    state or progress change, e.g. to publish status for other workers.
+    """
+
+    def __init__(self, workers: int = UPLOAD_WORKERS, max_pending: int = UPLOAD_MAX_PENDING,
+                 ttl: float = JOB_TTL, name: str = "rag-upload",
+                 on_change: Optional[Callable[[Job], None]] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=name)
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.ttl = ttl
+        self.on_change = on_change
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.completed = self.failed = self.rejected = 0
+
+    def submit(self, fn: Callable, *args, meta: Optional[Dict] = None, job_id: Optional[str] = None,
+               **kwargs) -> Job:
+        """Run fn(job, *args, **kwargs) in the pool; its return value becomes job.result."""
+        with self._lock:
+            self._purge_locked()
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise JobQueueFull(f"{self._pending} jobs already pending")
+            self._pending += 1
+            job = Job(job_id or uuid.uuid4().hex, meta or {}, self.on_change)
+            self._jobs[job.id] = job
+        job.changed()
+        job.future = self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job: Job, fn: Callable, args, kwargs):
+        job.started = time.time()
+        job.state = RUNNING
+        job.changed()
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.state = DONE
+        except JobError as e:
+            job.error = str(e)
+            job.state = FAILED
+        except Exception as e:
+            print(f"[jobs] {job.id} failed: {e!r}")
+            job.error = f"internal error: {type(e).__name__}"
+            job.state = FAILED
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                self._pending -= 1
+                if job.state == DONE:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            job.changed()
+        return job.result
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._purge_locked()
+            return self._jobs.get(job_id)
+
+    def _purge_locked(self):
+        if self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        # insertion order ~ finish order is not guaranteed, so scan; the table is small
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j.state == RUNNING)
+            return {"workers": self.workers, "pending": self._pending, "running": running,
+                    "max_pending": self.max_pending, "completed": self.completed,
+                    "failed": self.failed, "rejected": self.rejected, "tracked": len(self._jobs)}
@@ -0,0 +1,124 @@
+import re
+import difflib
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+_WORD = re.compile(r"\w+")
+_SEP = "\x00"          # never present in cleaned upload text
+ALPHABET_SIZE = 63     # most frequent vocabulary characters; the rest share one column
+
+class LexicalIndex:
+    """
+    Per-upload lexical structures, built once next to the TF-IDF matrix:
+
+    - the lowercased corpus as one string (chunk start offsets alongside),
+    - word -> chunk postings (CSR arrays) over the distinct lowercase
+      words, for the exact-containment boost of short queries,
+    - a character-count filter over the vocabulary unigrams for typo
+      correction: only words whose difflib quick_ratio bound reaches the
+      cutoff are scored with the real SequenceMatcher ratio.
+
+    Both lookups return exactly what the per-chunk scan / full
+    get_close_matches did (the latter restricted to unigrams).
+    """
+
+    def __init__(self, chunks: List[str], vocabulary: Dict[str, int]):
+        lower = [c.lower() for c in chunks]
+        self.n_chunks = len(lower)
+        self.corpus = _SEP.join(lower)
+        self.starts = np.cumsum([0] + [len(c) + 1 for c in lower[:-1]]).astype(np.int64)
+
+        # distinct words -> chunks containing them
+        postings: Dict[str, List[int]] = {}
+        for i, c in enumerate(lower):
+            for w in set(_WORD.findall(c)):
+                postings.setdefault(w, []).append(i)
+        words = sorted(postings)
+        self.words = _SEP.join(words)
+        self.word_starts = np.cumsum([0] + [len(w) + 1 for w in words[:-1]]).astype(np.int64)
+        self.post_ptr = np.cumsum([0] + [len(postings[w]) for w in words]).astype(np.int64)
+        self.post_ids = np.fromiter((i for w in words for i in postings[w]), dtype=np.int32,
+                                    count=int(self.post_ptr[-1]))
+
+        # fuzzy index: vocabulary unigrams sorted by length + per-word character counts
+        vocab = sorted((t for t in vocabulary if " " not in t), key=lambda t: (len(t), t))
+        self.vocab = vocab
+        self.vocab_set = set(vocab)
+        self.vocab_len = np.array([len(t) for t in vocab], dtype=np.int32)
+        freq = Counter(ch for t in vocab for ch in t)
+        self.alphabet = {ch: j for j, (ch, _) in enumerate(freq.most_common(ALPHABET_SIZE))}
+        self.char_counts = np.zeros((len(vocab), ALPHABET_SIZE + 1), dtype=np.uint16)
+        for r, t in enumerate(vocab):
+            for ch, n in Counter(t).items():
+                self.char_counts[r, self.alphabet.get(ch, ALPHABET_SIZE)] += n
+
+    # ---- exact containment ----
+    def _chunk_of(self, pos: int) -> int:
+        return int(np.searchsorted(self.starts, pos, side="right")) - 1
+
+    def containing(self, token: str) -> np.ndarray:
+        """Ids of chunks whose lowercased text contains `token` as a substring."""
+        if not token or _SEP in token:
+            return np.empty(0, dtype=np.int32)
+        if _WORD.fullmatch(token):
+            # an all-word-character token can only occur inside one word
+            parts, start = [], 0
+            while True:
+                pos = self.words.find(token, start)
+                if pos < 0:
+                    break
+                w = int(np.searchsorted(self.word_starts, pos, side="right")) - 1
+                parts.append(self.post_ids[self.post_ptr[w]:self.post_ptr[w + 1]])
+                start = int(self.word_starts[w + 1]) if w + 1 < len(self.word_starts) else len(self.words)
+            return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int32)
+        # punctuation inside the token: scan the corpus, one hit per chunk
+        hits, start = [], 0
+        while True:
+            pos = self.corpus.find(token, start)
+            if pos < 0:
+                break
+            i = self._chunk_of(pos)
+            hits.append(i)
+            if i + 1 >= self.n_chunks:
+                break
+            start = int(self.starts[i + 1])
+        return np.asarray(hits, dtype=np.int32)
+
+    def contains_any(self, tokens: List[str]) -> np.ndarray:
+        mask = np.zeros(self.n_chunks, dtype=bool)
+        for t in tokens:
+            mask[self.containing(t.lower())] = True
+        return mask
+
+    # ---- fuzzy correction ----
+    def closest(self, token: str, cutoff: float = 0.8) -> Optional[str]:
+        """Best vocabulary unigram with difflib ratio >= cutoff (get_close_matches order)."""
+        t = token.lower()
+        if t in self.vocab_set:
+            return t
+        lt = len(t)
+        if not lt or not self.vocab:
+            return None
+        # ratio <= 2*min(la, lb)/(la+lb): only a band of lengths can qualify
+        lo = int(np.searchsorted(self.vocab_len, int(np.ceil(lt * cutoff / (2 - cutoff))) - 1, side="left"))
+        hi = int(np.searchsorted(self.vocab_len, int(lt * (2 - cutoff) / cutoff) + 1, side="right"))
+        if lo >= hi:
+            return None
+        q = np.zeros(ALPHABET_SIZE + 1, dtype=np.uint16)
+        for ch, n in Counter(t).items():
+            q[self.alphabet.get(ch, ALPHABET_SIZE)] += n
+        common = np.minimum(self.char_counts[lo:hi], q).sum(axis=1)
+        bound = 2.0 * common / (self.vocab_len[lo:hi] + lt)
+        cand = np.nonzero(bound >= cutoff - 1e-9)[0]
+        s = difflib.SequenceMatcher()
+        s.set_seq2(t)
+        best = None
+        for r in cand:
+            w = self.vocab[lo + int(r)]
+            s.set_seq1(w)
+            score = s.ratio()
+            if score >= cutoff and (best is None or (score, w) > best):
+                best = (score, w)
+        return best[1] if best else None
@@ -0,0 +1,123 @@
+import os
+import json
+import mmap
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# sidecar of meta.jsonl: (chunk id, byte offset) rows sorted by id
+INDEX_DTYPE = np.dtype([("id", "<i8"), ("off", "<i8")])
+PREVIEW_CHARS = 300
+
+def offsets_path(meta_path: str) -> str:
+    return meta_path + ".idx.npy"
+
+class MetaWriter:
+    """
+    Writes meta.jsonl (one record per line) plus the id -> offset sidecar.
+    The 300-char "preview" copy is not stored; MetaStore derives it on read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, "wb")
+        self._ids: List[int] = []
+        self._offs: List[int] = []
+
+    def write(self, record: Dict, fallback_id: int = 0) -> int:
+        rec = {k: v for k, v in record.items() if k != "preview"}
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+        return self.write_raw(line, int(record.get("id", fallback_id)))
+
+    def write_raw(self, line: bytes, chunk_id: int) -> int:
+        self._ids.append(chunk_id)
+        self._offs.append(self._f.tell())
+        self._f.write(line)
+        return chunk_id
+
+    def __len__(self):
+        return len(self._ids)
+
+    def close(self):
+        self._f.close()
+        table = np.empty(len(self._ids), dtype=INDEX_DTYPE)
+        table["id"] = self._ids
+        table["off"] = self._offs
+        table.sort(order="id")
+        with open(offsets_path(self.path), "wb") as f:
+            np.save(f, table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_meta_lines(path: str) -> Iterator[Tuple[int, bytes]]:
+    """Yield (chunk id, raw line) for every record; ids default to line number."""
+    with open(path, "rb") as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                yield int(json.loads(line).get("id", i)), line
+
+
+class MetaStore:
+    """
+    Read-only view of meta.jsonl. Only the sorted (id, offset) table is
+    resident (memory-mapped); a record is parsed when it is asked for, so
+    a search materializes just its top-k hits and several worker
+    processes share the same pages through the OS page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        idx = offsets_path(path)
+        if os.path.exists(idx):
+            self._table = np.load(idx, mmap_mode="r")
+        else:
+            # meta.jsonl from before the sidecar existed: scan it once
+            self._table = self._scan()
+        self.ids = self._table["id"]
+
+    def _scan(self) -> np.ndarray:
+        ids, offs, off = [], [], 0
+        self._f.seek(0)
+        for i, line in enumerate(self._f):
+            if line.strip():
+                ids.append(int(json.loads(line).get("id", i)))
+                offs.append(off)
+            off += len(line)
+        table = np.empty(len(ids), dtype=INDEX_DTYPE)
+        table["id"], table["off"] = ids, offs
+        table.sort(order="id")
+        return table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, chunk_id: int) -> bool:
+        return self._find(chunk_id) is not None
+
+    def _find(self, chunk_id: int) -> Optional[int]:
+        pos = int(np.searchsorted(self.ids, chunk_id))
+        if pos < len(self.ids) and int(self.ids[pos]) == chunk_id:
+            return int(self._table["off"][pos])
+        return None
+
+    def get(self, chunk_id: int) -> Optional[Dict]:
+        off = self._find(int(chunk_id))
+        if off is None or self._mm is None:
+            return None
+        end = self._mm.find(b"\n", off)
+        rec = json.loads(self._mm[off:end if end >= 0 else len(self._mm)])
+        if "preview" not in rec:
+            rec["preview"] = (rec.get("content") or "")[:PREVIEW_CHARS]
+        return rec
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._f.close()
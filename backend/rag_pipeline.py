@@ -1,9 +1,18 @@
-import os,json
-from typing import List, Dict
+import os,json,time,asyncio,threading
+import numpy as np
+from typing import Any, List, Dict, Optional, AsyncIterator, Tuple
 from backend.rerank import mmr_rerank
+from backend.batching import MicroBatcher, MICROBATCH_MS
+from backend.cache import QueryCache, normalize_query, vector_key, text_key
+from backend.filters import filter_key
+from backend.concurrency import run_cpu, run_llm_blocking, call_llm, stream_llm
 
 INDEX_DIR = os.path.join(os.path.dirname(__file__), "data", "index")
 STATS_PATH = os.path.join(INDEX_DIR, "stats.json")
+# how often (seconds) a request may stat the index files to look for a rebuild
+RELOAD_CHECK_SECS = float(os.getenv("RAG_RELOAD_CHECK_SECS", "5"))
+# other occurrences (folded near-duplicates) listed per citation
+CITE_ALSO_MAX = int(os.getenv("RAG_CITE_ALSO_MAX", "10"))
 
 def load_provider_from_stats()-> str:
     if os.path.exists(STATS_PATH):
@@ -12,7 +21,7 @@ def load_provider_from_stats()-> str:
             return stats.get("provider", "sbert")
     return "sbert"
 
-def get_vectorstore():
+def get_vectorstore(model=None):
     provider=load_provider_from_stats()
     if provider=="openai":
         from .vectorstore_openai import VectorStoreOpenAI as VS
@@ -21,8 +30,12 @@ def get_vectorstore():
         from .vectorstore_pinecone import VectorStoreFastEmbed as VS
         return VS(INDEX_DIR)
     else:
+        from .shards import ShardedVectorStore, is_sharded
+        if is_sharded(INDEX_DIR):
+            # shards are opened with the model they were built with (it names the shared caches)
+            return ShardedVectorStore(_stats_model_name() or "all-MiniLM-L6-v2", index_dir=INDEX_DIR, model=model)
         from .vectorestore import VectorStore as VS
-        return VS(index_dir=INDEX_DIR)
+        return VS(index_dir=INDEX_DIR, model=model)
     
 SYSTEM_PROMPT=("You are a helpful assistant. Answer ONLY using the provided context. "
 "If the answer is not present, say you don't know. Keep it concise. "
@@ -42,6 +55,12 @@ def build_context(chunks:List[Dict],budget_chars:int =5000)->str:
     return "".join(buf).strip()
 
 class Answerer:
+    """
+    Gemini when configured, else an extractive summary of the context.
+    Every method also reports whether it was degraded: the model was
+    configured but failed or timed out and the extractive fallback was
+    used instead, so callers don't cache a transient outage.
+    """
 
     def __init__(self):
         self.api_key=os.getenv("Google_API_KEY")
@@ -57,37 +76,395 @@ class Answerer:
                 print(f"Error initializing Google Generative AI: {e}")
                 self.model=None
    
-    def answer(self, question: str, context: str) -> str:
+    def _prompt(self, question: str, context: str) -> str:
+        return (
+            f"{SYSTEM_PROMPT}\n\n"
+            f"CONTEXT:\n{context}\n\n"
+            f"Question: {question}\nAnswer:")
+
+    @staticmethod
+    def _extractive(context: str) -> str:
+        # simple extractive fallback
+        lines = [l for l in context.splitlines() if l and not l.startswith("[")]
+        summary = " ".join(lines)[:900]
+        return summary + (" [1]" if summary else "")
+
+    def answer(self, question: str, context: str) -> Tuple[str, bool]:
+        """(answer, degraded)."""
+        if not context.strip():
+            return "I don't know based on the provided documents.", False
+        if self.model is None:
+            return self._extractive(context), False
+        try:
+            resp = self.model.generate_content(self._prompt(question, context))
+            return (resp.text or "").strip() or "I don't know.", False
+        except Exception:
+            return self._extractive(context), True
+
+    async def answer_async(self, question: str, context: str) -> Tuple[str, bool]:
+        """Non-blocking (answer, degraded): async Gemini call under the shared LLM limit + timeout."""
         if not context.strip():
-            return "I don't know based on the provided documents."
+            return "I don't know based on the provided documents.", False
         if self.model is None:
-# simple extractive fallback
-            lines = [l for l in context.splitlines() if l and not l.startswith("[")]
-            summary = " ".join(lines)[:900]
-            return summary + (" [1]" if summary else "")
+            return self._extractive(context), False
+        prompt = self._prompt(question, context)
         try:
-            prompt = (
-                f"{SYSTEM_PROMPT}\n\n"
-                f"CONTEXT:\n{context}\n\n"
-                f"Question: {question}\nAnswer:")
-            resp = self.model.generate_content(prompt)
-            return (resp.text or "").strip() or "I don't know."
+            if hasattr(self.model, "generate_content_async"):
+                resp = await call_llm(lambda: self.model.generate_content_async(prompt))
+            else:
+                resp = await call_llm(lambda: run_llm_blocking(self.model.generate_content, prompt))
+            return (resp.text or "").strip() or "I don't know.", False
         except Exception:
-            lines = [l for l in context.splitlines() if l and not l.startswith("[")]
-            summary = " ".join(lines)[:900]
-            return summary + (" [1]" if summary else "")
+            return self._extractive(context), True
+
+    async def answer_stream(self, question: str, context: str) -> AsyncIterator[Tuple[str, bool]]:
+        """Yield (text, degraded) as the model produces it (one piece for fallbacks)."""
+        if not context.strip() or self.model is None or not hasattr(self.model, "generate_content_async"):
+            yield await self.answer_async(question, context)
+            return
+        prompt = self._prompt(question, context)
+        produced = False
+        try:
+            async for piece in stream_llm(lambda: self.model.generate_content_async(prompt, stream=True)):
+                produced = True
+                yield piece, False
+        except Exception:
+            if produced:
+                raise   # partial answer: let the caller report it (and not cache it)
+            yield self._extractive(context), True
+
+class RetrievalService:
+    """
+    Long-lived holder for the loaded vector store and answerer.
+    Loaded once (at app startup) and shared by every request; when
+    stats.json / faiss.index change on disk a fresh store is loaded
+    off to the side and swapped in, so in-flight requests keep using
+    the snapshot they started with.
+    """
+
+    WATCHED = ("stats.json", "faiss.index")
+
+    def __init__(self, index_dir: str = INDEX_DIR):
+        self.index_dir = index_dir
+        self.vs = None
+        self.answerer: Optional[Answerer] = None
+        self.loaded_at: Optional[float] = None
+        self.load_seconds: Optional[float] = None
+        self.reloads = 0
+        self.last_error: Optional[str] = None
+        self._fingerprint = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self.cache = QueryCache()
+        self.batcher: Optional[MicroBatcher] = None
+        if MICROBATCH_MS > 0:
+            # each batched result carries the store snapshot it came from
+            self.batcher = MicroBatcher(self._search_pinned, trim=lambda r, k: (r[0], r[1][:k]))
+
+    def _disk_fingerprint(self):
+        fp = []
+        for name in self.WATCHED:
+            try:
+                st = os.stat(os.path.join(self.index_dir, name))
+                fp.append((name, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                fp.append((name, None, None))
+        return tuple(fp)
+
+    def load(self):
+        """(Re)load the index from disk and swap it in atomically."""
+        with self._lock:
+            self._load_locked()
+        return self
+
+    def _load_locked(self):
+        fp = self._disk_fingerprint()
+        t0 = time.perf_counter()
+        prev = self.vs
+        # keep the encoder across reloads unless the embedding model changed
+        model = None
+        if prev is not None and getattr(prev, "model_name", None) == _stats_model_name():
+            model = getattr(prev, "model", None)
+        try:
+            vs = get_vectorstore(model=model)
+            vs.load()
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+        if self.answerer is None:
+            self.answerer = Answerer()
+        # single reference assignment: readers see either the old or the new store
+        self.vs = vs
+        if prev is not None:
+            self.cache.invalidate(model_changed=prev.model_name != vs.model_name)
+        self._fingerprint = fp
+        self.load_seconds = time.perf_counter() - t0
+        self.loaded_at = time.time()
+        self.last_error = None
+        if prev is not None:
+            self.reloads += 1
+        self._last_check = time.monotonic()
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if self.vs is not None and now - self._last_check < RELOAD_CHECK_SECS:
+            return
+        self._last_check = now
+        if self.vs is not None and self._disk_fingerprint() == self._fingerprint:
+            return
+        with self._lock:
+            # another request may have reloaded while we waited for the lock
+            if self.vs is None or self._disk_fingerprint() != self._fingerprint:
+                self._load_locked()
+
+    def store(self):
+        self.maybe_reload()
+        return self.vs
+
+    def search_batch(self, queries: List[str], k: int, filters: Optional[Dict] = None, vs=None) -> List[List[Dict]]:
+        """
+        Cached batched search: only queries whose embedding / hits are not
+        cached are encoded / searched, still as one batch each. `filters`
+        (parsed, see filters.parse_filters) applies to every query; `vs`
+        pins the store snapshot to search (default: the current one).
+        """
+        if vs is None:
+            vs = self.store()
+        cache = self.cache
+        norm = [normalize_query(q) for q in queries]
+        vecs = [cache.embeddings.get(n) for n in norm]
+        missing = [i for i, v in enumerate(vecs) if v is None]
+        if missing:
+            encoded = vs.encode([norm[i] for i in missing])
+            for i, row in zip(missing, encoded):
+                vecs[i] = row
+                cache.embeddings.put(norm[i], row)
+        keys = [(vector_key(v), k, vs.version, filter_key(filters)) for v in vecs]
+        results: List[Optional[List[Dict]]] = [cache.hits.get(key) for key in keys]
+        todo = [i for i, r in enumerate(results) if r is None]
+        if todo:
+            found = vs.search_vectors(np.vstack([vecs[i] for i in todo]), top_k=k,
+                                      queries=[norm[i] for i in todo], filters=filters)
+            for i, hits in zip(todo, found):
+                cache.hits.put(keys[i], hits)
+                results[i] = hits
+        # hand out copies so callers can't mutate cached hits
+        return [[dict(h) for h in hits] for hits in results]
+
+    def _search_pinned(self, queries: List[str], k: int) -> List[Tuple[Any, List[Dict]]]:
+        vs = self.store()
+        return [(vs, hits) for hits in self.search_batch(queries, k, vs=vs)]
+
+    def search_with_store(self, q: str, k: int = 8, filters: Optional[Dict] = None) -> Tuple[Any, List[Dict]]:
+        """
+        (store, hits) of a single-query search; concurrent unfiltered callers
+        are micro-batched together. Read the hits' metadata and vectors from
+        that store: a hot reload may have swapped self.vs since.
+        """
+        if self.batcher is None or filters:
+            vs = self.store()
+            return vs, self.search_batch([q], k, filters, vs=vs)[0]
+        return self.batcher.search(q, k)
+
+    def search(self, q: str, k: int = 8, filters: Optional[Dict] = None) -> List[Dict]:
+        return self.search_with_store(q, k, filters)[1]
+
+    async def asearch_with_store(self, q: str, k: int = 8, filters: Optional[Dict] = None) -> Tuple[Any, List[Dict]]:
+        """search_with_store without holding an event-loop or executor thread while batched."""
+        if self.batcher is None or filters:
+            return await run_cpu(self.search_with_store, q, k, filters)
+        if self.vs is None:
+            # first use: load the index on the CPU pool, not in the batcher thread
+            await run_cpu(self.maybe_reload)
+        return await asyncio.wrap_future(self.batcher.submit(q, k))
+
+    async def asearch(self, q: str, k: int = 8, filters: Optional[Dict] = None) -> List[Dict]:
+        return (await self.asearch_with_store(q, k, filters))[1]
 
+    # degraded (fallback) answers are returned but never cached: a transient
+    # LLM outage must not pin them for RAG_ANSWER_CACHE_TTL
+    async def aanswer(self, q: str, context: str) -> str:
+        key = (normalize_query(q), text_key(context))
+        ans = self.cache.answers.get(key)
+        if ans is None:
+            ans, degraded = await self.answerer.answer_async(q, context)
+            if not degraded:
+                self.cache.answers.put(key, ans)
+        return ans
 
+    async def astream_answer(self, q: str, context: str) -> AsyncIterator[str]:
+        key = (normalize_query(q), text_key(context))
+        ans = self.cache.answers.get(key)
+        if ans is not None:
+            yield ans
+            return
+        parts: List[str] = []
+        degraded = False
+        async for piece, fallback in self.answerer.answer_stream(q, context):
+            degraded = degraded or fallback
+            parts.append(piece)
+            yield piece
+        if not degraded:
+            self.cache.answers.put(key, "".join(parts).strip())
 
+    def answer(self, q: str, context: str) -> str:
+        key = (normalize_query(q), text_key(context))
+        ans = self.cache.answers.get(key)
+        if ans is None:
+            ans, degraded = self.answerer.answer(q, context)
+            if not degraded:
+                self.cache.answers.put(key, ans)
+        return ans
 
-def query_pipeline(q: str, k: int = 8) -> Dict:
-    vs = get_vectorstore()
-    vs.load()
-    hits = vs.search(q, top_k=k)
-    # apply MMR reranking on the retrieved hits
-    reranked = mmr_rerank(hits, top_n=min(6, k), lambda_mult=0.7)
+    def info(self) -> Dict:
+        vs = self.vs
+        if vs is None:
+            return {"loaded": False, "error": self.last_error}
+        index_bytes = 0
+        meta_bytes = 0
+        for attr in ("index_path", "meta_path"):
+            path = getattr(vs, attr, None)
+            if path and os.path.exists(path):
+                if attr == "index_path":
+                    index_bytes = os.path.getsize(path)
+                else:
+                    meta_bytes = os.path.getsize(path)
+        index = getattr(vs, "index", None)
+        return {
+            "loaded": True,
+            "model": getattr(vs, "model_name", None),
+            "index_type": getattr(vs, "index_type", None),
+            "mmap": getattr(vs, "mmap", False),
+            "vectors": int(index.ntotal) if index is not None else int(getattr(vs, "count", 0) or 0),
+            "bm25_docs": len(vs.bm25) if getattr(vs, "bm25", None) is not None else None,
+            "shards": vs.shard_info() if hasattr(vs, "shard_info") else None,
+            "index_bytes": index_bytes,
+            "meta_bytes": meta_bytes,
+            "load_seconds": round(self.load_seconds or 0.0, 4),
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "error": self.last_error,
+            "microbatch": self.batcher.stats() if self.batcher else None,
+            "cache": self.cache.stats(),
+        }
+
+
+def _stats_model_name() -> Optional[str]:
+    if os.path.exists(STATS_PATH):
+        with open(STATS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f).get("model")
+    return None
+
+
+_SERVICE: Optional[RetrievalService] = None
+_SERVICE_LOCK = threading.Lock()
+
+def get_service() -> RetrievalService:
+    """Process-wide RetrievalService (created lazily, loaded on first use)."""
+    global _SERVICE
+    if _SERVICE is None:
+        with _SERVICE_LOCK:
+            if _SERVICE is None:
+                _SERVICE = RetrievalService()
+    return _SERVICE
+
+
+def _hit_embeddings(vs, hits: List[Dict]) -> Optional[np.ndarray]:
+    if vs is None or not hasattr(vs, "reconstruct") or any("id" not in h for h in hits):
+        return None
+    return vs.reconstruct([int(h["id"]) for h in hits])
+
+
+def _prepare(hits: List[Dict], k: int, vs=None):
+    # apply MMR reranking on the retrieved hits, redundancy from their stored embeddings
+    reranked = mmr_rerank(hits, top_n=min(6, k), lambda_mult=0.7, embeddings=_hit_embeddings(vs, hits))
     context = build_context(reranked)
-    ans = Answerer().answer(q, context)
-    citations = [{"id": i + 1, "source": h.get("source"), "page": h.get("page")}
-        for i, h in enumerate(reranked)]
-    return {"answer": ans, "citations": citations, "retrieved": reranked}
\ No newline at end of file
+    citations = [_citation(i + 1, h) for i, h in enumerate(reranked)]
+    return reranked, context, citations
+
+
+def _citation(n: int, h: Dict) -> Dict:
+    cit = {"id": n, "source": h.get("source"), "page": h.get("page")}
+    also = h.get("also")
+    if also:
+        # the same text elsewhere in the corpus (near-duplicates indexed once)
+        seen, out = {(cit["source"], cit["page"])}, []
+        for o in also:
+            key = (o.get("source"), o.get("page"))
+            if key not in seen:
+                seen.add(key)
+                out.append({"source": key[0], "page": key[1]})
+        cit["also"] = out[:CITE_ALSO_MAX]
+        if len(out) > CITE_ALSO_MAX:
+            cit["also_total"] = len(out)
+    return cit
+
+
+def _answer_from_hits(svc: RetrievalService, vs, q: str, hits: List[Dict], k: int) -> Dict:
+    reranked, context, citations = _prepare(hits, k, vs)
+    ans = svc.answer(q, context)
+    return {"answer": ans, "citations": citations, "retrieved": reranked}
+
+
+def query_pipeline(q: str, k: int = 8, filters: Optional[Dict] = None) -> Dict:
+    svc = get_service()
+    vs, hits = svc.search_with_store(q, k, filters)
+    return _answer_from_hits(svc, vs, q, hits, k)
+
+
+def query_batch_pipeline(qs: List[str], k: int = 8, filters: Optional[Dict] = None) -> List[Dict]:
+    """Many questions in one call: one batched encode + FAISS search."""
+    svc = get_service()
+    vs = svc.store()   # one snapshot for the search and the hits' metadata / vectors
+    all_hits = svc.search_batch(qs, k, filters, vs=vs)
+    return [_answer_from_hits(svc, vs, q, hits, k) for q, hits in zip(qs, all_hits)]
+
+
+async def aquery_pipeline(q: str, k: int = 8, retrieve_only: bool = False,
+                          filters: Optional[Dict] = None) -> Dict:
+    """
+    Async /query: retrieval + rerank on the CPU executor, the LLM call
+    awaited under the shared concurrency limit. retrieve_only skips
+    generation entirely so it never waits on the LLM.
+    """
+    svc = get_service()
+    vs, hits = await svc.asearch_with_store(q, k, filters)
+    reranked, context, citations = await run_cpu(_prepare, hits, k, vs)
+    if retrieve_only:
+        return {"answer": None, "citations": citations, "retrieved": reranked}
+    ans = await svc.aanswer(q, context)
+    return {"answer": ans, "citations": citations, "retrieved": reranked}
+
+
+async def aquery_stream(q: str, k: int = 8, filters: Optional[Dict] = None) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    Streaming /query: yields (event, payload) pairs — citations as soon as
+    retrieval is done, then answer tokens, then the final answer.
+    """
+    svc = get_service()
+    vs, hits = await svc.asearch_with_store(q, k, filters)
+    reranked, context, citations = await run_cpu(_prepare, hits, k, vs)
+    yield "citations", {"citations": citations, "retrieved": reranked}
+    parts: List[str] = []
+    try:
+        async for piece in svc.astream_answer(q, context):
+            parts.append(piece)
+            yield "token", {"text": piece}
+    except Exception as e:
+        yield "verdict", {"answer": "".join(parts).strip(), "complete": False, "error": str(e)}
+        return
+    yield "verdict", {"answer": "".join(parts).strip(), "complete": True}
+
+
+async def aquery_batch_pipeline(qs: List[str], k: int = 8, retrieve_only: bool = False,
+                                filters: Optional[Dict] = None) -> List[Dict]:
+    svc = get_service()
+    vs = await run_cpu(svc.store)
+    all_hits = await run_cpu(svc.search_batch, qs, k, filters, vs)
+    prepared = await run_cpu(lambda: [_prepare(hits, k, vs) for hits in all_hits])
+    if retrieve_only:
+        answers = [None] * len(qs)
+    else:
+        answers = await asyncio.gather(*(svc.aanswer(q, ctx) for q, (_, ctx, _) in zip(qs, prepared)))
+    return [{"answer": a, "citations": cit, "retrieved": rr}
+            for a, (rr, _, cit) in zip(answers, prepared)]
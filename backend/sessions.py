@@ -0,0 +1,348 @@
+import os
+import sys
+import time
+import uuid
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+SESSION_DIR = os.path.join(os.path.dirname(__file__), "data", "uploaded")
+# idle seconds before a session expires
+SESSION_TTL = float(os.getenv("SESSION_TTL_SECS", "3600"))
+# total bytes of sessions kept in this process; least recently used are evicted first
+SESSION_BUDGET = int(float(os.getenv("SESSION_BUDGET_MB", "512")) * 1024 * 1024)
+# memory (this process only) | file | sqlite (shared by every worker on the host)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+# memory backend only: pickle LRU-evicted sessions to disk instead of dropping them
+SESSION_SPILL = os.getenv("SESSION_SPILL", "0") == "1"
+
+
+def deep_sizeof(obj, _seen: Optional[set] = None) -> int:
+    """Approximate resident bytes of a session (arrays, sparse matrices, str/list/dict, sklearn objects)."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "indptr") and hasattr(obj, "data"):   # scipy CSR/CSC
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(deep_sizeof(k, _seen) + deep_sizeof(v, _seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(deep_sizeof(v, _seen) for v in obj)
+    if hasattr(obj, "__dict__"):
+        return sys.getsizeof(obj) + deep_sizeof(vars(obj), _seen)
+    return sys.getsizeof(obj)
+
+
+# ---- shared backends ----
+# Backends store (version, blob): the version changes on every put, so a
+# worker can tell its cached copy is stale without loading the blob.
+class FileBackend:
+    """One pickle per session under SESSION_DIR/sessions; expiry = file mtime + ttl."""
+
+    MAGIC = b"RAGS"
+    HEADER = len(MAGIC) + 32   # magic + version (uuid hex)
+
+    def __init__(self, root: str = os.path.join(SESSION_DIR, "sessions"), ttl: float = SESSION_TTL):
+        self.root = root
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, sid: str) -> str:
+        return os.path.join(self.root, f"{sid}.pkl")
+
+    def put(self, sid: str, blob: bytes, version: str = ""):
+        tmp = self._path(sid) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC + version.encode("ascii").ljust(32)[:32])
+            f.write(blob)
+        os.replace(tmp, self._path(sid))
+
+    def _split(self, data: bytes) -> Tuple[str, bytes]:
+        if not data.startswith(self.MAGIC):
+            return "", data   # written before versions existed
+        return data[len(self.MAGIC):self.HEADER].decode("ascii").strip(), data[self.HEADER:]
+
+    def get(self, sid: str) -> Optional[Tuple[str, bytes]]:
+        path = self._path(sid)
+        try:
+            if self.ttl > 0 and os.path.getmtime(path) + self.ttl < time.time():
+                self.delete(sid)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)   # sliding expiry
+            return self._split(data)
+        except FileNotFoundError:
+            return None
+
+    def version(self, sid: str) -> Optional[str]:
+        """Current version without reading the blob (or touching the expiry)."""
+        try:
+            with open(self._path(sid), "rb") as f:
+                return self._split(f.read(self.HEADER))[0]
+        except FileNotFoundError:
+            return None
+
+    def delete(self, sid: str):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        for fn in os.listdir(self.root):
+            path = os.path.join(self.root, fn)
+            if fn.endswith(".pkl") and self.ttl > 0 and os.path.getmtime(path) < cutoff:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class SqliteBackend:
+    """Sessions as BLOB rows in one SQLite file (WAL mode, safe for several worker processes)."""
+
+    def __init__(self, path: str = os.path.join(SESSION_DIR, "sessions.sqlite"), ttl: float = SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._conn() as c:
+            c.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, blob BLOB, touched REAL)")
+            try:
+                c.execute("ALTER TABLE sessions ADD COLUMN version TEXT")
+            except sqlite3.OperationalError:
+                pass   # already there
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, sid: str, blob: bytes, version: str = ""):
+        with self._conn() as c:
+            c.execute("INSERT OR REPLACE INTO sessions (sid, blob, touched, version) VALUES (?, ?, ?, ?)",
+                      (sid, sqlite3.Binary(blob), time.time(), version))
+
+    def get(self, sid: str) -> Optional[Tuple[str, bytes]]:
+        with self._conn() as c:
+            row = c.execute("SELECT blob, touched, version FROM sessions WHERE sid = ?", (sid,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl > 0 and row[1] + self.ttl < time.time():
+                c.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+                return None
+            c.execute("UPDATE sessions SET touched = ? WHERE sid = ?", (time.time(), sid))
+            return row[2] or "", bytes(row[0])
+
+    def version(self, sid: str) -> Optional[str]:
+        row = self._conn().execute("SELECT version FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        return None if row is None else (row[0] or "")
+
+    def delete(self, sid: str):
+        with self._conn() as c:
+            c.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def purge(self):
+        if self.ttl > 0:
+            with self._conn() as c:
+                c.execute("DELETE FROM sessions WHERE touched < ?", (time.time() - self.ttl,))
+
+
+def make_store() -> "SessionStore":
+    """SessionStore configured from SESSION_BACKEND / SESSION_SPILL."""
+    if SESSION_BACKEND == "file":
+        return SessionStore(backend=FileBackend())
+    if SESSION_BACKEND == "sqlite":
+        return SessionStore(backend=SqliteBackend())
+    if SESSION_SPILL:
+        return SessionStore(backend=FileBackend(), write_through=False)
+    return SessionStore()
+
+
+class SessionStore:
+    """
+    Upload sessions with idle TTL and LRU eviction under a total-bytes
+    budget. With a shared backend (file/sqlite) every session is also
+    pickled there on put(), so another worker — or this one after an
+    eviction — can load it back on get(). With write_through=False the
+    backend is only a spill area: sessions are pickled when evicted.
+
+    A session whose meta has "indexing" set is still being published in
+    steps (possibly by another worker), so get() compares its cached copy
+    against the backend's version and reloads when a newer one is there.
+    Upload job status lives in the same backend (put_status/get_status)
+    so any worker can answer for a job another one is running.
+    """
+
+    PURGE_EVERY = 100   # puts between sweeps of expired backend entries
+
+    def __init__(self, budget_bytes: int = SESSION_BUDGET, ttl: float = SESSION_TTL, backend=None,
+                 write_through: bool = True):
+        self.budget = budget_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self.write_through = write_through and backend is not None
+        self._items: "OrderedDict[str, Dict]" = OrderedDict()  # sid -> {session, bytes, created, touched}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.evictions = self.expirations = self.backend_loads = self.spills = 0
+
+    def put(self, sid: str, session: Dict):
+        size = deep_sizeof(session)
+        blob = pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL) if self.write_through else None
+        version = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            old = self._items.pop(sid, None)
+            if old:
+                self._bytes -= old["bytes"]
+            self._items[sid] = {"session": session, "bytes": size, "version": version,
+                                "created": old["created"] if old else now, "touched": now}
+            self._bytes += size
+            evicted = self._evict_locked(keep=sid)
+            self._puts += 1
+            purge = self.backend is not None and self._puts % self.PURGE_EVERY == 0
+        if blob is not None:
+            self.backend.put(sid, blob, version)
+        self._spill(evicted)
+        if purge:
+            self.backend.purge()
+
+    def get(self, sid: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            item = self._items.get(sid)
+            if item is not None:
+                if self.ttl > 0 and item["touched"] + self.ttl < now:
+                    self._drop_locked(sid)
+                    self.expirations += 1
+                    item = None
+                else:
+                    item["touched"] = now
+                    self._items.move_to_end(sid)
+                    if not self._maybe_stale(item):
+                        return item["session"]
+        if item is not None and not self._is_stale(sid, item):
+            return item["session"]
+        if self.backend is None:
+            return None
+        got = self.backend.get(sid)
+        if got is None:
+            return None
+        version, blob = got
+        session = pickle.loads(blob)
+        with self._lock:
+            self.backend_loads += 1
+            self._drop_locked(sid)
+            self._items[sid] = {"session": session, "bytes": deep_sizeof(session), "version": version,
+                                "created": now, "touched": now}
+            self._bytes += self._items[sid]["bytes"]
+            evicted = self._evict_locked(keep=sid)
+        self._spill(evicted)
+        return session
+
+    def _maybe_stale(self, item: Dict) -> bool:
+        # only sessions still being published can change under us
+        return self.write_through and bool(item["session"].get("meta", {}).get("indexing"))
+
+    def _is_stale(self, sid: str, item: Dict) -> bool:
+        """Outside the lock: does the backend hold a newer version than this cached one?"""
+        if not self._maybe_stale(item):
+            return False
+        version = self.backend.version(sid)
+        return version is not None and version != item.get("version")
+
+    def put_status(self, job_id: str, status: Dict):
+        """Publish a job's status to the shared backend (no-op without one)."""
+        if self.write_through:
+            self.backend.put(f"job-{job_id}", pickle.dumps(status, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def get_status(self, job_id: str) -> Optional[Dict]:
+        if not self.write_through:
+            return None
+        got = self.backend.get(f"job-{job_id}")
+        return pickle.loads(got[1]) if got else None
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._drop_locked(sid)
+        if self.backend is not None:
+            self.backend.delete(sid)
+
+    def _drop_locked(self, sid: str):
+        item = self._items.pop(sid, None)
+        if item:
+            self._bytes -= item["bytes"]
+
+    def _spill(self, evicted: List):
+        if self.backend is None or self.write_through:
+            return   # nothing to do: dropped, or already in the shared backend
+        for sid, session in evicted:
+            self.backend.put(sid, pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL))
+            self.spills += 1
+
+    def _evict_locked(self, keep: str) -> List:
+        # expired first, then least recently used, never the session just stored
+        evicted = []
+        now = time.time()
+        if self.ttl > 0:
+            for sid in [s for s, it in self._items.items() if it["touched"] + self.ttl < now and s != keep]:
+                self._drop_locked(sid)
+                self.expirations += 1
+        while self._bytes > self.budget and len(self._items) > 1:
+            sid = next(iter(self._items))
+            if sid == keep:
+                self._items.move_to_end(sid)
+                sid = next(iter(self._items))
+            evicted.append((sid, self._items[sid]["session"]))
+            self._drop_locked(sid)
+            self.evictions += 1
+        return evicted
+
+    def __contains__(self, sid: str) -> bool:
+        return self.get(sid) is not None
+
+    def session_info(self, sid: str) -> Optional[Dict]:
+        if self.get(sid) is None:
+            return None
+        with self._lock:
+            item = self._items.get(sid)
+            if item is None:
+                return None
+            now = time.time()
+            return {"bytes": item["bytes"], "age_secs": round(now - item["created"], 1),
+                    "idle_secs": round(now - item["touched"], 1)}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            top: List[Dict] = sorted(({"session_id": sid, "bytes": it["bytes"]} for sid, it in self._items.items()),
+                                     key=lambda d: d["bytes"], reverse=True)[:10]
+            return {
+                "sessions": len(self._items),
+                "bytes": self._bytes,
+                "budget_bytes": self.budget,
+                "ttl_secs": self.ttl,
+                "backend": type(self.backend).__name__ if self.backend else "memory",
+                "write_through": self.write_through,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "backend_loads": self.backend_loads,
+                "spills": self.spills,
+                "largest": top,
+            }
@@ -0,0 +1,351 @@
+import os
+import json
+import uuid
+import zlib
+import heapq
+import shutil
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .vectorestore import VectorStore, INDEX_TYPE, EMBED_BATCH, INDEX_MMAP, HYBRID_DEPTH, fuse_hits
+from .embedding import as_engine
+from .embed_cache import EmbeddingCache, ChunkKeys, EMBED_CACHE
+from .metastore import offsets_path
+from .bm25 import BM25Index, share_collection_stats
+from .filters import FilterIndex
+from .concurrency import SEARCH_EXECUTOR
+
+# shards a full build partitions the corpus into; 1 = one unsharded index
+SHARDS = int(os.getenv("RAG_SHARDS", "1"))
+# source: all chunks of a document land in one shard | hash: spread by chunk id
+SHARD_BY = os.getenv("RAG_SHARD_BY", "source")
+# shards this node serves, e.g. "0,2"; empty = every shard in the manifest
+SHARD_IDS = os.getenv("RAG_SHARD_IDS", "")
+# shards built / loaded concurrently; 0 = one per shard, up to the core count
+SHARD_WORKERS = int(os.getenv("RAG_SHARD_WORKERS", "0"))
+
+MANIFEST = "shards.json"
+SHARD_BY_CHOICES = ("source", "hash")
+
+def shard_name(i: int) -> str:
+    return f"shard-{i:03d}"
+
+def shard_of(chunk: Dict, n_shards: int, by: str = SHARD_BY) -> int:
+    """Stable shard number of a chunk record (crc32, identical across runs and hosts)."""
+    key = chunk.get("source") if by == "source" else None
+    if key is None:
+        key = chunk.get("id")
+    return zlib.crc32(str(key).encode("utf-8")) % n_shards
+
+def read_manifest(index_dir: str) -> Dict:
+    path = os.path.join(index_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def is_sharded(index_dir: str) -> bool:
+    """stats.json is written last by either layout, so it decides which one is live."""
+    path = os.path.join(index_dir, "stats.json")
+    if not os.path.exists(path):
+        return False
+    with open(path, "r", encoding="utf-8") as f:
+        return bool(json.load(f).get("shards"))
+
+def remove_shards(index_dir: str):
+    """Drop a previous sharded layout once an unsharded build has been published."""
+    for entry in read_manifest(index_dir).get("shards", []):
+        shutil.rmtree(os.path.join(index_dir, entry["dir"]), ignore_errors=True)
+    try:
+        os.remove(os.path.join(index_dir, MANIFEST))
+    except FileNotFoundError:
+        pass
+
+def _parse_ids(spec: str) -> Optional[Set[int]]:
+    ids = {int(s) for s in spec.replace(" ", "").split(",") if s}
+    return ids or None
+
+def merge_top_k(rankings: List[List[Tuple[int, float]]], k: int) -> List[Tuple[int, float, int]]:
+    """k best (id, score, shard) across per-shard rankings, each already sorted best first."""
+    tagged = ([(i, s, shard) for i, s in ranking] for shard, ranking in enumerate(rankings))
+    return list(itertools.islice(heapq.merge(*tagged, key=lambda t: t[1], reverse=True), k))
+
+
+class ShardedVectorStore:
+    """
+    N independent VectorStores under <index_dir>/shard-NNN, partitioned
+    by source document (or chunk id hash). Each shard is built, updated
+    and saved on its own; shards.json lists them and stats.json (written
+    last) marks the directory as sharded. Searches fan out over the
+    shards on SEARCH_EXECUTOR and the per-shard rankings are merged with
+    a heap. load() opens only the shards assigned by RAG_SHARD_IDS, so a
+    node (or later a separate process) can serve a subset.
+    """
+
+    def __init__(self, embedding_model_name: str = "all-MiniLM-L6-v2", index_dir: str = None, normalize: bool = True,
+                 model=None, index_type: str = INDEX_TYPE, index_params: Dict = None,
+                 n_shards: Optional[int] = None, shard_by: Optional[str] = None, assigned: Optional[Iterable[int]] = None):
+        if index_dir is None:
+            index_dir = os.path.join(os.path.dirname(__file__), "data", "index")
+        manifest = read_manifest(index_dir)
+        self.index_dir = index_dir
+        self.model_name = embedding_model_name
+        self.normalize = normalize
+        self.model = as_engine(model, embedding_model_name)
+        self.n_shards = int(n_shards or manifest.get("n_shards") or SHARDS)
+        self.shard_by = shard_by or manifest.get("shard_by") or SHARD_BY
+        if self.shard_by not in SHARD_BY_CHOICES:
+            raise ValueError(f"shard_by must be one of {SHARD_BY_CHOICES}, got {self.shard_by!r}")
+        self.assigned = set(assigned) if assigned is not None else _parse_ids(SHARD_IDS)
+        self.index_type = index_type
+        self.index_params = index_params
+        self.shard_ids = list(range(self.n_shards))
+        self.shards = [self._store(i) for i in self.shard_ids]
+        self.dim = self.shards[0].dim
+        self.mmap = False
+        self.version = None
+        self.count = 0
+        self.embed_cache: Optional[EmbeddingCache] = None   # shared by the shards while building
+        self.embed_stats: Optional[Dict] = None
+
+    def _store(self, i: int) -> VectorStore:
+        return VectorStore(self.model_name, os.path.join(self.index_dir, shard_name(i)), self.normalize,
+                           model=self.model, index_type=self.index_type, index_params=self.index_params)
+
+    @property
+    def stats_path(self):
+        return os.path.join(self.index_dir, "stats.json")
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.index_dir, MANIFEST)
+
+    def _workers(self) -> int:
+        return max(1, SHARD_WORKERS or min(len(self.shards), os.cpu_count() or 1))
+
+    def _each(self, fn, items: List) -> List:
+        with ThreadPoolExecutor(max_workers=self._workers(), thread_name_prefix="rag-shard") as pool:
+            return list(pool.map(fn, items))
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.shards[0].encode(texts)
+
+    # ---- build ----
+    def open_embed_cache(self) -> Optional[EmbeddingCache]:
+        if EMBED_CACHE and self.embed_cache is None:
+            self.embed_cache = EmbeddingCache(self.model_name, self.normalize, self.dim)
+        for s in self.shards:
+            s.embed_cache = self.embed_cache
+        return self.embed_cache
+
+    def close_embed_cache(self):
+        for s in self.shards:
+            s.embed_cache = None
+        if self.embed_cache is not None:
+            self.embed_cache.close()
+            self.embed_stats = self.embed_cache.stats()
+            self.embed_cache = None
+
+    def _spool(self, chunks: Iterable[Dict]) -> List[str]:
+        # one pass routes the stream into per-shard files; memory stays bounded
+        paths = []
+        for s in self.shards:
+            s.ensure_index_dir()
+            paths.append(os.path.join(s.index_dir, "spool.jsonl.tmp"))
+        files = [open(p, "w", encoding="utf-8") for p in paths]
+        try:
+            for c in chunks:
+                files[shard_of(c, self.n_shards, self.shard_by)].write(json.dumps(c, ensure_ascii=False) + "\n")
+        finally:
+            for f in files:
+                f.close()
+        return paths
+
+    @staticmethod
+    def _read_spool(path: str) -> Iterator[Dict]:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def build(self, chunks: Iterable[Dict], batch_size: int = EMBED_BATCH,
+              train_sample: Optional[List[Dict]] = None):
+        """
+        Partition the chunks, then build every shard concurrently. Trained
+        engines all fit their quantizer on the same corpus-wide sample.
+        """
+        self.open_embed_cache()
+        spools: List[str] = []
+        try:
+            spools = self._spool(chunks)
+            if train_sample and self.embed_cache is not None:
+                self.shards[0].embed_chunks(train_sample)   # encode the sample once, not per shard
+            self._each(lambda i: self.shards[i].build(self._read_spool(spools[i]), batch_size, train_sample),
+                       list(range(len(self.shards))))
+        finally:
+            self.close_embed_cache()
+            for p in spools:
+                if os.path.exists(p):
+                    os.remove(p)
+        self.count = sum(s.count for s in self.shards)
+
+    def load_index(self, mmap: bool = False):
+        """Load every shard's index for an in-place update."""
+        self._each(lambda s: s.load_index(mmap=mmap), self.shards)
+
+    def _holds_any(self, s: VectorStore, ids: np.ndarray) -> bool:
+        path = offsets_path(s.meta_path)
+        if not os.path.exists(path):
+            return True
+        return bool(np.isin(np.load(path, mmap_mode="r")["id"], ids).any())
+
+    def apply_delta(self, upserts: List[Dict], delete_ids: Iterable[int], batch_size: int = EMBED_BATCH):
+        """
+        Route upserts to their shard and drop deleted / moved ids wherever
+        they live. Shards the delta does not touch are left as they are.
+        """
+        drop = {int(i) for i in delete_ids}
+        drop.update(int(c["id"]) for c in upserts)
+        drop_arr = np.fromiter(drop, dtype="int64", count=len(drop))
+        routed: List[List[Dict]] = [[] for _ in self.shards]
+        for c in upserts:
+            routed[shard_of(c, self.n_shards, self.shard_by)].append(c)
+        todo = [i for i, s in enumerate(self.shards) if routed[i] or self._holds_any(s, drop_arr)]
+        self.open_embed_cache()
+        try:
+            self._each(lambda i: self.shards[i].apply_delta(routed[i], drop, batch_size), todo)
+        finally:
+            self.close_embed_cache()
+
+    def save(self):
+        """
+        Save the shards that changed, then shards.json and stats.json (last,
+        it triggers reloads). Files of a previous layout are removed after.
+        """
+        prev = read_manifest(self.index_dir)
+        for s in self.shards:
+            if s.dirty:
+                s.save()
+        entries = []
+        for i, s in zip(self.shard_ids, self.shards):
+            with open(s.stats_path, "r", encoding="utf-8") as f:
+                st = json.load(f)
+            entries.append({"id": i, "dir": shard_name(i), "count": st.get("count", 0),
+                            "index_type": st.get("index_type"), "version": st.get("version")})
+        self.count = sum(e["count"] for e in entries)
+        self.version = uuid.uuid4().hex
+        manifest = {"n_shards": self.n_shards, "shard_by": self.shard_by, "version": self.version, "shards": entries}
+        stats = {
+            "model": self.model_name,
+            "normalize": self.normalize,
+            "dim": self.dim,
+            "count": self.count,
+            # the engine asked for (the default of the next build); small shards may have fallen back to flat
+            "index_type": self.index_type,
+            "shard_index_types": sorted({e["index_type"] for e in entries if e["index_type"]}),
+            "shards": self.n_shards,
+            "shard_by": self.shard_by,
+            "version": self.version,
+        }
+        for path, doc in ((self.manifest_path, manifest), (self.stats_path, stats)):
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(doc, f, ensure_ascii=False, indent=2)
+            os.replace(path + ".tmp", path)
+        live = {e["dir"] for e in entries}
+        for entry in prev.get("shards", []):
+            if entry["dir"] not in live:
+                shutil.rmtree(os.path.join(self.index_dir, entry["dir"]), ignore_errors=True)
+        for name in ("faiss.index", "meta.jsonl", offsets_path("meta.jsonl"), ChunkKeys.FILE):
+            try:
+                os.remove(os.path.join(self.index_dir, name))
+            except FileNotFoundError:
+                pass
+        for d in (BM25Index.dir_for(self.index_dir), FilterIndex.dir_for(self.index_dir)):
+            shutil.rmtree(d, ignore_errors=True)
+
+    # ---- serve ----
+    def load(self, mmap: bool = INDEX_MMAP):
+        """Open the assigned shards listed in shards.json (all of them by default)."""
+        manifest = read_manifest(self.index_dir)
+        if not manifest:
+            raise FileNotFoundError(f"No {MANIFEST} in {self.index_dir}")
+        entries = [e for e in manifest["shards"] if self.assigned is None or e["id"] in self.assigned]
+        if not entries:
+            raise RuntimeError(f"None of shards {sorted(self.assigned)} are in {self.manifest_path}")
+        self.n_shards, self.shard_by = manifest["n_shards"], manifest["shard_by"]
+        self.shard_ids = [e["id"] for e in entries]
+        self.shards = [self._store(i) for i in self.shard_ids]
+        self._each(lambda s: s.load(mmap=mmap), self.shards)
+        if all(s.bm25 is not None for s in self.shards):
+            share_collection_stats([s.bm25 for s in self.shards])
+        self.index_type = "+".join(sorted({s.index_type for s in self.shards}))
+        self.version = manifest["version"]
+        self.count = sum(s.count for s in self.shards)
+        self.mmap = mmap
+
+    def search(self, query: str, top_k: int = 8, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, filters: Optional[Dict] = None) -> List[Dict]:
+        return self.search_batch([query], top_k=top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)[0]
+
+    def search_batch(self, queries: List[str], top_k: int = 8, nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None, filters: Optional[Dict] = None) -> List[List[Dict]]:
+        if not queries:
+            return []
+        return self.search_vectors(self.encode(queries), top_k=top_k, nprobe=nprobe, ef_search=ef_search,
+                                   queries=queries, filters=filters)
+
+    def search_vectors(self, q: np.ndarray, top_k: int = 8, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None, queries: Optional[List[str]] = None,
+                       filters: Optional[Dict] = None) -> List[List[Dict]]:
+        """
+        Same contract as VectorStore.search_vectors. Every shard's FAISS
+        (and BM25) search is its own task, filtered by the shard's own
+        filter index; the global top-k of each ranking is merged from
+        the per-shard lists before RRF. BM25 scores are comparable across
+        shards because load() gave them corpus-wide statistics.
+        """
+        hybrid = queries is not None and all(s.bm25 is not None for s in self.shards)
+        depth = max(top_k, HYBRID_DEPTH) if hybrid else top_k
+        dense_f = [SEARCH_EXECUTOR.submit(s.dense_rankings, q, depth, nprobe, ef_search, filters)
+                   for s in self.shards]
+        sparse_f = [SEARCH_EXECUTOR.submit(s.lexical_rankings, queries, depth, filters)
+                    for s in self.shards] if hybrid else []
+        dense = [f.result() for f in dense_f]
+        sparse = [f.result() for f in sparse_f]
+        results: List[List[Dict]] = []
+        for qi in range(len(q)):
+            d = merge_top_k([rows[qi] for rows in dense], depth)
+            owner = {i: shard for i, _, shard in d}
+            if not hybrid:
+                hits = (self.shards[shard]._hit(i, s) for i, s, shard in d)
+                results.append([h for h in hits if h is not None])
+                continue
+            lex = merge_top_k([rows[qi] for rows in sparse], depth)
+            owner.update((i, shard) for i, _, shard in lex)
+            results.append(fuse_hits([(i, s) for i, s, _ in d], [(i, s) for i, s, _ in lex], top_k,
+                                     lambda i, s: self.shards[owner[i]]._hit(i, s)))
+        return results
+
+    def reconstruct(self, ids: List[int]) -> Optional[np.ndarray]:
+        """Stored vectors of the chunk ids, each read from the shard holding it."""
+        if not ids:
+            return None
+        out = np.zeros((len(ids), self.dim), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        for s in self.shards:
+            mine = [j for j, i in enumerate(ids) if not found[j] and int(i) in s.meta]
+            if not mine:
+                continue
+            vecs = s.reconstruct([ids[j] for j in mine])
+            if vecs is None:
+                return None
+            out[mine] = vecs
+            found[mine] = True
+        return out if found.all() else None
+
+    def shard_info(self) -> List[Dict]:
+        return [{"id": i, "index_type": s.index_type, "vectors": int(s.index.ntotal) if s.index is not None else 0,
+                 "bm25_docs": len(s.bm25) if s.bm25 is not None else None}
+                for i, s in zip(self.shard_ids, self.shards)]
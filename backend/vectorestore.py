@@ -1,21 +1,124 @@
 import os
 import json
+import math
+import uuid
 import faiss
 import numpy as np
-from typing import List, Dict
+from array import array
+from typing import Callable, List, Dict, Iterable, Iterator, Optional, Tuple, Union
 from sentence_transformers import SentenceTransformer
+from .embedding import EmbeddingEngine, as_engine
+from .metastore import MetaStore, MetaWriter, iter_meta_lines, offsets_path
+from .bm25 import BM25Index
+from .rerank import rrf_fuse
+from .concurrency import SEARCH_EXECUTOR
+from .embed_cache import EmbeddingCache, ChunkKeys, EMBED_CACHE, chunk_key
+from .filters import FilterIndex
+from .scoring import top_k_indices
+
+# chunks embedded + added per step during build; bounds peak memory
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "1024"))
+
+# serve the FAISS index read-only from a memory map (shared page cache across workers)
+INDEX_MMAP = os.getenv("RAG_INDEX_MMAP", "1") == "1"
+
+# build-time index engine: flat | ivf_flat | ivf_pq | hnsw
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+# max vectors held back to train IVF/PQ quantizers before adding the rest
+INDEX_TRAIN_SIZE = int(os.getenv("INDEX_TRAIN_SIZE", "50000"))
+# below this many training vectors IVF/PQ are not worth it; fall back to flat
+MIN_TRAIN_SIZE = 1000
+
+# fuse dense hits with the BM25 index (when build_index wrote one) via reciprocal rank fusion
+HYBRID = os.getenv("RAG_HYBRID", "1") == "1"
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# candidates taken from each retriever before fusion (at least top_k)
+HYBRID_DEPTH = int(os.getenv("RAG_HYBRID_DEPTH", "20"))
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq_fp16", "sq_int8", "pq")
+# engines whose quantizer is fit on a training sample
+TRAINED_TYPES = ("ivf_flat", "ivf_pq", "sq_int8", "pq")
+# engines storing lossy codes; search can re-score candidates with exact vectors
+COMPRESSED_TYPES = ("ivf_pq", "sq_fp16", "sq_int8", "pq")
+# candidates fetched per requested hit and re-scored exactly (from the embedding
+# cache) on compressed engines; 1 disables re-scoring
+RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "4"))
+# filtered searches matching at most this many chunks score them directly
+FILTER_EXACT_MAX = int(os.getenv("RAG_FILTER_EXACT_MAX", "4096"))
+# engines whose FAISS search rejects an IDSelector; filtered searches over-fetch instead
+NO_SELECTOR_TYPES = ("pq",)
+DEFAULT_INDEX_PARAMS = {
+    "nlist": None,         # IVF cells; None = ~4*sqrt(n) from the training sample
+    "pq_m": None,          # PQ sub-quantizers (ivf_pq / pq); None = largest divisor of dim <= dim/8
+    "pq_nbits": 8,
+    "hnsw_m": 32,
+    "ef_construction": 40,
+    "nprobe": 16,          # query-time: IVF cells visited
+    "ef_search": 64,       # query-time: HNSW candidate list size
+}
+
+def iter_batches(items: Iterable, size: int) -> Iterator[List]:
+    batch: List = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def fuse_hits(dense: List[Tuple[int, float]], lexical: List[Tuple[int, float]], top_k: int,
+              hit: Callable[[int, float], Optional[Dict]]) -> List[Dict]:
+    """RRF of a dense and a BM25 ranking of (chunk id, score); `hit` materializes the winners."""
+    dense_scores, lexical_scores = dict(dense), dict(lexical)
+    out = []
+    for chunk_id, score in rrf_fuse([list(dense_scores), list(lexical_scores)], k=RRF_K)[:top_k]:
+        item = hit(chunk_id, score)
+        if item is None:
+            continue
+        if chunk_id in dense_scores:
+            item["dense_score"] = dense_scores[chunk_id]
+        if chunk_id in lexical_scores:
+            item["bm25_score"] = lexical_scores[chunk_id]
+        out.append(item)
+    return out
+
+_LOGGED = set()
+
+def _log_once(msg: str):
+    if msg not in _LOGGED:
+        _LOGGED.add(msg)
+        print(msg)
 
 class VectorStore:
-    def __init__(self, embedding_model_name: str = "all-MiniLM-L6-v2", index_dir: str = None, normalize: bool = True):
+    def __init__(self, embedding_model_name: str = "all-MiniLM-L6-v2", index_dir: str = None, normalize: bool = True,
+                 model: Optional[Union[SentenceTransformer, EmbeddingEngine]] = None, index_type: str = INDEX_TYPE, index_params: Dict = None):
         if index_dir is None:
             index_dir = os.path.join(os.path.dirname(__file__), "data", "index")
         self.index_dir = index_dir
         self.model_name = embedding_model_name
         self.normalize = normalize
-        self.model = SentenceTransformer(embedding_model_name)
+        # reuse an already-loaded encoder when the caller has one (e.g. on hot reload)
+        self.model = as_engine(model, embedding_model_name)
         self.index = None
-        self.meta: List[Dict] = []
+        self.meta: Optional[MetaStore] = None   # lazy id -> record view, set by load()
+        self.bm25: Optional[BM25Index] = None   # sparse side of hybrid search, set by load()
+        self.rescore_cache: Optional[EmbeddingCache] = None   # exact vectors for re-scoring, set by load()
+        self.chunk_keys: Optional[ChunkKeys] = None   # id -> embedding cache key, set by load()
+        self.filters: Optional[FilterIndex] = None   # metadata filter lookups, set by load()
+        self._bm25_aligned = False
+        self.quantization: Optional[Dict] = None   # recall report written to stats.json
+        self.mmap = False
+        self.version = None   # changes on every save(); keys caches of search results
+        self.count = 0
+        self._staged_meta = None          # meta written during build, moved into place by save()
+        self.embed_cache: Optional[EmbeddingCache] = None   # open only while building
+        self.embed_stats: Optional[Dict] = None             # hits/misses of the last build
         self.dim = self.model.get_sentence_embedding_dimension()
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"index_type must be one of {INDEX_TYPES}, got {index_type!r}")
+        self.index_type = index_type
+        self.index_params = {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
     @property
     def index_path(self):
         return os.path.join(self.index_dir, "faiss.index")
@@ -26,56 +129,465 @@ class VectorStore:
     @property
     def stats_path(self):
         return os.path.join(self.index_dir, "stats.json")
+
+    @property
+    def staged_meta_path(self):
+        """meta.jsonl as the next save() will publish it."""
+        return self._staged_meta or self.meta_path
     
     def ensure_index_dir(self):
         os.makedirs(self.index_dir, exist_ok=True)
     
     def encode(self, texts: List[str]) -> np.ndarray:
-        embeddings = self.model.encode(texts, convert_to_numpy=True, show_progress_bar=True)
+        embeddings = self.model.encode(texts)
         if self.normalize:
             faiss.normalize_L2(embeddings)
         return embeddings
-    
-    def build(self,chunks: List[Dict]):
+
+    def open_embed_cache(self) -> Optional[EmbeddingCache]:
+        if EMBED_CACHE and self.embed_cache is None:
+            self.embed_cache = EmbeddingCache(self.model_name, self.normalize, self.dim)
+        return self.embed_cache
+
+    def close_embed_cache(self):
+        if self.embed_cache is not None:
+            self.embed_cache.close()
+            self.embed_stats = self.embed_cache.stats()
+            self.embed_cache = None
+
+    def embed_chunks(self, chunks: List[Dict]) -> np.ndarray:
+        """encode() the chunks' content, reusing cached vectors of unchanged text."""
+        cache = self.embed_cache
+        if cache is None:
+            return self.encode([c["content"] for c in chunks])
+        keys = [chunk_key(c) for c in chunks]
+        hit, embeddings = cache.get(keys)
+        miss = np.nonzero(~hit)[0]
+        if len(miss):
+            fresh = self.encode([chunks[i]["content"] for i in miss])
+            embeddings[miss] = fresh
+            cache.put([keys[i] for i in miss], fresh)
+        return embeddings
+
+    @staticmethod
+    def _ids_for(chunks: List[Dict], start: int = 0) -> np.ndarray:
+        # records from ingest carry a stable "id"; fall back to position
+        return np.array([c.get("id", start + i) for i, c in enumerate(chunks)], dtype="int64")
+
+    # ---- index engines ----
+    def _resolve_params(self, n_train: int) -> Dict:
+        p = dict(self.index_params)
+        if self.index_type in ("ivf_flat", "ivf_pq"):
+            nlist = p["nlist"] or int(4 * math.sqrt(max(n_train, 1)))
+            # k-means wants ~39 points per centroid
+            p["nlist"] = max(1, min(nlist, n_train // 39 or 1))
+        if self.index_type in ("ivf_pq", "pq"):
+            m = p["pq_m"]
+            if not m:
+                m = max(d for d in range(1, max(1, self.dim // 8) + 1) if self.dim % d == 0)
+            p["pq_m"] = m
+            p["pq_nbits"] = min(p["pq_nbits"], max(1, int(math.log2(max(n_train, 2)))))
+        return p
+
+    def _factory_string(self, p: Dict) -> str:
+        if self.index_type == "ivf_flat":
+            return f"IDMap2,IVF{p['nlist']},Flat"
+        if self.index_type == "ivf_pq":
+            return f"IDMap2,IVF{p['nlist']},PQ{p['pq_m']}x{p['pq_nbits']}"
+        if self.index_type == "hnsw":
+            return f"IDMap2,HNSW{p['hnsw_m']},Flat"
+        if self.index_type == "sq_fp16":
+            return "IDMap2,SQfp16"
+        if self.index_type == "sq_int8":
+            return "IDMap2,SQ8"
+        if self.index_type == "pq":
+            return f"IDMap2,PQ{p['pq_m']}x{p['pq_nbits']}"
+        return "IDMap2,Flat"
+
+    def _needs_training(self) -> bool:
+        return self.index_type in TRAINED_TYPES
+
+    def _create_index(self, sample: Optional[np.ndarray] = None):
+        """Create (and train on `sample` if needed) an empty id-mapped index."""
+        n = 0 if sample is None else len(sample)
+        # SQ8 only fits per-dimension ranges; any non-empty sample will do
+        if self._needs_training() and n < (1 if self.index_type == "sq_int8" else MIN_TRAIN_SIZE):
+            print(f"[index] only {n} training vectors; using flat instead of {self.index_type}")
+            self.index_type = "flat"
+        self.index_params = self._resolve_params(n)
+        # IDMap2 so later incremental builds can remove/replace vectors by id
+        index = faiss.index_factory(self.dim, self._factory_string(self.index_params), faiss.METRIC_INNER_PRODUCT)
+        if self.index_type == "hnsw":
+            faiss.downcast_index(index.index).hnsw.efConstruction = self.index_params["ef_construction"]
+        if not index.is_trained:
+            index.train(sample)
+        self.index = index
+        self._apply_search_params()
+
+    def _apply_search_params(self):
+        base = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+        if isinstance(base, faiss.IndexIVF):
+            base.nprobe = int(self.index_params.get("nprobe") or 1)
+        elif isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = int(self.index_params.get("ef_search") or 16)
+
+    def _search_params(self, nprobe: Optional[int], ef_search: Optional[int], sel=None):
+        """Per-query overrides of the defaults restored from stats.json, plus an optional id selector."""
+        ivf, hnsw = self.index_type in ("ivf_flat", "ivf_pq"), self.index_type == "hnsw"
+        if sel is None and not (nprobe and ivf) and not (ef_search and hnsw):
+            return None
+        if ivf:
+            return faiss.SearchParametersIVF(sel=sel, nprobe=int(nprobe or self.index_params.get("nprobe") or 1))
+        if hnsw:
+            return faiss.SearchParametersHNSW(sel=sel, efSearch=int(ef_search or self.index_params.get("ef_search") or 16))
+        return faiss.SearchParameters(sel=sel)
+
+    def build(self, chunks: Iterable[Dict], batch_size: int = EMBED_BATCH,
+              train_sample: Optional[List[Dict]] = None):
+        """
+        Stream chunks through encode -> index.add in batches. Metadata is
+        written straight to a staging file, so memory is bounded by the
+        batch size; call save() to publish and load() to search.
+
+        IVF engines are trained on `train_sample` when given (e.g. a
+        reservoir sample of the corpus); otherwise the first
+        INDEX_TRAIN_SIZE vectors of the stream are held back and used.
+        """
         self.ensure_index_dir()
-        texts = [c["content"] for c in chunks]
-        self.meta = chunks
-        embeddings = self.encode(texts)
-        self.index = faiss.IndexFlatIP(self.dim) 
-        self.index.add(embeddings)
-        self.meta = chunks
+        self.index = None
+        owned = self.embed_cache is None   # a sharded build passes one shared cache in
+        self.open_embed_cache()
+        try:
+            self._build(chunks, batch_size, train_sample)
+        finally:
+            if owned:
+                self.close_embed_cache()
+
+    def _build(self, chunks: Iterable[Dict], batch_size: int, train_sample: Optional[List[Dict]]):
+        if not self._needs_training():
+            self._create_index()
+        elif train_sample:
+            self._create_index(self.embed_chunks(train_sample))
+        self.meta, self.count = None, 0
+        held: List = []   # (embeddings, ids) waiting for the quantizer to be trained
+        n_held = 0
+        staged = self.meta_path + ".tmp"
+        with MetaWriter(staged) as f:
+            for batch in iter_batches(chunks, batch_size):
+                embeddings = self.embed_chunks(batch)
+                ids = self._ids_for(batch, self.count)
+                if self.index is None:
+                    held.append((embeddings, ids))
+                    n_held += len(batch)
+                    if n_held >= INDEX_TRAIN_SIZE:
+                        self._flush_held(held)
+                else:
+                    self.index.add_with_ids(embeddings, ids)
+                for c, i in zip(batch, ids):
+                    f.write(c, int(i))
+                self.count += len(batch)
+            if self.index is None:
+                self._flush_held(held)
+        self._staged_meta = staged
+
+    def _flush_held(self, held: List):
+        self._create_index(np.vstack([e for e, _ in held]) if held else None)
+        for embeddings, ids in held:
+            self.index.add_with_ids(embeddings, ids)
+        held.clear()
+
+    def apply_delta(self, upserts: List[Dict], delete_ids: Iterable[int], batch_size: int = EMBED_BATCH):
+        """
+        Incrementally update the index loaded with load_index(): drop
+        deleted/replaced ids and embed + add only the upserted chunks.
+        meta.jsonl is rewritten by streaming it into the staging file.
+        """
+        if not isinstance(self.index, faiss.IndexIDMap):
+            raise RuntimeError("Index was built without ids; run build_index --full once.")
+        if not self.supports_delete:
+            raise RuntimeError(f"{self.index_type} index does not support removals; run build_index --full.")
+        drop = {int(i) for i in delete_ids}
+        drop.update(int(c["id"]) for c in upserts)
+        if drop:
+            self.index.remove_ids(np.fromiter(drop, dtype="int64", count=len(drop)))
+        self.meta, self.count = None, 0
+        staged = self.meta_path + ".tmp"
+        with MetaWriter(staged) as out:
+            for chunk_id, line in iter_meta_lines(self.meta_path):
+                if chunk_id not in drop:
+                    out.write_raw(line, chunk_id)
+            owned = self.embed_cache is None
+            self.open_embed_cache()
+            try:
+                for batch in iter_batches(upserts, batch_size):
+                    embeddings = self.embed_chunks(batch)
+                    self.index.add_with_ids(embeddings, self._ids_for(batch))
+                    for c in batch:
+                        out.write(c)
+            finally:
+                if owned:
+                    self.close_embed_cache()
+            self.count = len(out)
+        self._staged_meta = staged
 
     def save(self):
         self.ensure_index_dir()
-        faiss.write_index(self.index, self.index_path)
-        with open(self.meta_path, "w", encoding="utf-8") as f:
-            for m in self.meta:
-                f.write(json.dumps(m, ensure_ascii=False) + "\n")
-        
-        with open(self.stats_path, "w", encoding="utf-8") as f:
+        # write to temp files and rename, stats.json last, so a process
+        # watching the directory never loads a half-written index
+        faiss.write_index(self.index, self.index_path + ".tmp")
+        self.version = uuid.uuid4().hex
+        index_bytes = os.path.getsize(self.index_path + ".tmp")
+        with open(self.stats_path + ".tmp", "w", encoding="utf-8") as f:
             json.dump({
                 "model": self.model_name,
                 "normalize": self.normalize,
+                "encoder": {"backend": self.model.backend, "quantize": self.model.quantize},
                 "dim": self.dim,
-                "count": len(self.meta)
+                "count": self.count,
+                "id_map": isinstance(self.index, faiss.IndexIDMap),
+                "index_type": self.index_type,
+                "index_params": self.index_params,
+                "version": self.version,
+                # index file size per vector vs. what a flat float32 index needs
+                "bytes_per_vector": round(index_bytes / self.count, 1) if self.count else None,
+                "flat_bytes_per_vector": self.dim * 4 + 8,
+                "quantization": self.quantization,
             }, f, ensure_ascii=False, indent=2)
+        if self._staged_meta is not None:
+            os.replace(offsets_path(self._staged_meta), offsets_path(self.meta_path))
+            os.replace(self._staged_meta, self.meta_path)
+        for path in (self.index_path, self.stats_path):
+            os.replace(path + ".tmp", path)
+        self._staged_meta = None
+
+    @property
+    def dirty(self) -> bool:
+        """Built or updated since the last save()."""
+        return self._staged_meta is not None
+
+    @property
+    def supports_delete(self) -> bool:
+        return self.index_type != "hnsw"
+
+    def load_index(self, mmap: bool = False):
+        # restore the engine + query-time parameters chosen at build time
+        if os.path.exists(self.stats_path):
+            with open(self.stats_path, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+            self.index_type = stats.get("index_type", "flat")
+            self.version = stats.get("version") or str(os.path.getmtime(self.stats_path))
+            self.index_params = {**DEFAULT_INDEX_PARAMS, **stats.get("index_params", {})}
+        if mmap:
+            flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+            self.index = faiss.read_index(self.index_path, flag | faiss.IO_FLAG_READ_ONLY)
+        else:
+            self.index = faiss.read_index(self.index_path)
+        if self.version is None:
+            self.version = str(os.path.getmtime(self.index_path))
+        self._apply_search_params()
+
+    def load(self, mmap: bool = INDEX_MMAP):
+        """Open the index (memory-mapped, read-only by default) and the lazy metadata view."""
+        self.load_index(mmap=mmap)
+        if self.index_type in ("ivf_flat", "ivf_pq"):
+            # reconstruct() by id (MMR reranking) needs IVF's id -> list map
+            try:
+                faiss.extract_index_ivf(self.index).make_direct_map()
+            except RuntimeError as e:
+                print(f"[vectorstore] no direct map, MMR falls back to source/page: {e}")
+        self.mmap = mmap
+        self.meta = MetaStore(self.meta_path)
+        self.count = len(self.meta)
+        self.bm25 = BM25Index.load(self.index_dir, mmap=mmap) if HYBRID else None
+        self.filters = FilterIndex.load(self.index_dir, mmap=mmap)
+        self._check_alignment()
+        self.rescore_cache, self.chunk_keys = None, None
+        if self.index_type in COMPRESSED_TYPES and RESCORE_FACTOR > 1 and EMBED_CACHE:
+            self.chunk_keys = ChunkKeys.load(self.index_dir, mmap=mmap)
+            if self.chunk_keys is not None:
+                self.rescore_cache = EmbeddingCache.open_readonly(self.model_name, self.normalize, self.dim)
+            if self.rescore_cache is None:
+                # the exact vectors live in the build host's embedding cache; without it scores stay approximate
+                reason = "embedding cache not found" if self.chunk_keys is not None else f"no {ChunkKeys.FILE}"
+                _log_once(f"[vectorstore] {self.index_dir}: exact re-scoring off ({reason}); "
+                          f"serving {self.index_type} scores as is")
     
-    def load(self):
-        self.index = faiss.read_index(self.index_path)
-        self.meta = []
-        with open(self.meta_path, "r", encoding="utf-8") as f:
-            for line in f:
-                self.meta.append(json.loads(line))
-    
-    def search(self, query: str, top_k: int = 8) -> List[Dict]:
-        q=self.encode([query])
-        scores,idxs=self.index.search(q, top_k)
-        out: List[Dict] = []
-
-        for score, idx in zip(scores[0], idxs[0]):
-            if idx<0 or idx>=len(self.meta):
-                continue
-            item = self.meta[idx].copy()
+    def search(self, query: str, top_k: int = 8, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, filters: Optional[Dict] = None) -> List[Dict]:
+        return self.search_batch([query], top_k=top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)[0]
+
+    def search_batch(self, queries: List[str], top_k: int = 8, nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None, filters: Optional[Dict] = None) -> List[List[Dict]]:
+        """One encode + one FAISS search for many queries."""
+        if not queries:
+            return []
+        return self.search_vectors(self.encode(queries), top_k=top_k, nprobe=nprobe, ef_search=ef_search,
+                                   queries=queries, filters=filters)
+
+    def search_vectors(self, q: np.ndarray, top_k: int = 8, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None, queries: Optional[List[str]] = None,
+                       filters: Optional[Dict] = None) -> List[List[Dict]]:
+        """
+        Search already-encoded query vectors (one row per query). When the
+        query texts are given and a BM25 index is loaded, BM25 runs in
+        parallel with FAISS and the two rankings are fused with RRF.
+        `filters` (see filters.parse_filters) restricts both rankings to
+        the matching chunks inside the search, so k hits still come back.
+        """
+        if queries is None or self.bm25 is None:
+            return [[h for h in (self._hit(i, sc) for i, sc in row) if h is not None]
+                    for row in self.dense_rankings(q, top_k, nprobe, ef_search, filters)]
+        depth = max(top_k, HYBRID_DEPTH)
+        sparse = SEARCH_EXECUTOR.submit(self.lexical_rankings, queries, depth, filters)
+        dense_rows = self.dense_rankings(q, depth, nprobe, ef_search, filters)
+        return [fuse_hits(row, lexical, top_k, self._hit) for row, lexical in zip(dense_rows, sparse.result())]
+
+    def select(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        """Rows (FilterIndex order) matching parsed filters; None when there are none."""
+        if not filters:
+            return None
+        if self.filters is None:
+            print(f"[vectorstore] no filter index in {self.index_dir}; building it from meta.jsonl")
+            self.filters = FilterIndex.from_meta(self.meta_path)
+            self._check_alignment()
+        return self.filters.select(filters)
+
+    def _check_alignment(self):
+        # BM25 and filter rows both follow meta.jsonl order when written by the same build
+        self._bm25_aligned = (self.bm25 is not None and self.filters is not None
+                              and np.array_equal(self.bm25.doc_ids, self.filters.ids))
+
+    def dense_rankings(self, q: np.ndarray, depth: int, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None, filters: Optional[Dict] = None) -> List[List[Tuple[int, float]]]:
+        """Per query, the best `depth` (chunk id, score) of this index, best first."""
+        rows = self.select(filters)
+        if rows is None:
+            return self._dense(q, depth, self._search_params(nprobe, ef_search))
+        ids = np.asarray(self.filters.ids[rows])
+        if not len(ids):
+            return [[] for _ in q]
+        if len(ids) <= FILTER_EXACT_MAX:
+            # few matches: scoring them directly beats any index scan
+            exact = self._score_ids(q, ids, depth)
+            if exact is not None:
+                return exact
+        if self.index_type in NO_SELECTOR_TYPES:
+            return self._post_filter(q, depth, self._search_params(nprobe, ef_search), ids)
+        sel = faiss.IDSelectorBatch(ids)   # referenced until the search returns
+        return self._dense(q, depth, self._search_params(nprobe, ef_search, sel))
+
+    def lexical_rankings(self, queries: List[str], depth: int,
+                         filters: Optional[Dict] = None) -> List[List[Tuple[int, float]]]:
+        """BM25 (chunk id, score) rankings, restricted like dense_rankings."""
+        rows = self.select(filters)
+        if rows is not None and not self._bm25_aligned:
+            rows = np.nonzero(np.isin(self.bm25.doc_ids, self.filters.ids[rows]))[0]
+        return [list(zip(ids.tolist(), scores.tolist()))
+                for ids, scores in self.bm25.search_batch(queries, depth, allowed=rows)]
+
+    def _score_ids(self, q: np.ndarray, ids: np.ndarray, depth: int) -> Optional[List[List[Tuple[int, float]]]]:
+        vecs = self.reconstruct(ids)
+        if vecs is None:
+            return None
+        fetch = depth * RESCORE_FACTOR if self.rescore_cache is not None else depth
+        out = []
+        for qv, scores in zip(q, q @ vecs.T):
+            row = [(int(ids[j]), float(scores[j])) for j in top_k_indices(scores, fetch)]
+            out.append(self._rescore(qv, row)[:depth] if self.rescore_cache is not None else row)
+        return out
+
+    def _post_filter(self, q: np.ndarray, depth: int, params, ids: np.ndarray) -> List[List[Tuple[int, float]]]:
+        # engines without IDSelector support: widen the search until enough hits match
+        allowed = np.sort(ids)
+        want = min(depth, len(ids))
+        fetch = depth * 4
+        while True:
+            rows = self._dense(q, min(fetch, self.index.ntotal), params)
+            kept = []
+            for row in rows:
+                ok = np.isin([i for i, _ in row], allowed) if row else []
+                kept.append([r for r, m in zip(row, ok) if m][:depth])
+            if all(len(r) >= want for r in kept) or fetch >= self.index.ntotal:
+                return kept
+            fetch *= 4
+
+    def _dense(self, q: np.ndarray, depth: int, params) -> List[List[Tuple[int, float]]]:
+        """FAISS (id, score) rankings; compressed engines over-fetch and re-score exactly."""
+        fetch = depth * RESCORE_FACTOR if self.rescore_cache is not None else depth
+        scores,idxs=self.index.search(q, fetch, params=params) if params else self.index.search(q, fetch)
+        rows = [[(int(i), float(sc)) for sc, i in zip(row_scores, row_idxs) if i >= 0]
+                for row_scores, row_idxs in zip(scores, idxs)]
+        if self.rescore_cache is None:
+            return rows
+        return [self._rescore(qv, row)[:depth] for qv, row in zip(q, rows)]
+
+    def _rescore(self, qv: np.ndarray, row: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+        # exact inner product for candidates whose vector is cached; others keep the code's score
+        hit, vecs = self.rescore_cache.get(self.chunk_keys.get([i for i, _ in row]))
+        exact = vecs @ qv
+        out = [(i, float(exact[j]) if hit[j] else sc) for j, (i, sc) in enumerate(row)]
+        out.sort(key=lambda t: t[1], reverse=True)
+        return out
+
+    def quantization_report(self, n_queries: int = 100, k: int = 10) -> Dict:
+        """
+        Recall@k of the built index against exact search, with and without
+        re-scoring, using sampled corpus vectors as queries. Exact vectors
+        come from the embedding cache; empty if it is unavailable.
+        """
+        cache = EmbeddingCache.open_readonly(self.model_name, self.normalize, self.dim) if EMBED_CACHE else None
+        if cache is None or self.index is None or not self.count:
+            return {}
+        try:
+            ids, keys = array("q"), bytearray()
+            for chunk_id, line in iter_meta_lines(self.staged_meta_path):
+                ids.append(chunk_id)
+                keys += chunk_key(json.loads(line))
+            ids = np.frombuffer(ids, dtype=np.int64)
+            keys = np.frombuffer(bytes(keys), dtype="S16")
+            rng = np.random.default_rng(0)
+            qpos = rng.choice(len(ids), size=min(n_queries, len(ids)), replace=False)
+            _, Q = cache.get(keys[qpos].tolist())
+            k = min(k, len(ids))
+            # brute force over the exact vectors, block by block
+            best_s = np.full((len(Q), 0), -np.inf, dtype=np.float32)
+            best_i = np.empty((len(Q), 0), dtype=np.int64)
+            for start in range(0, len(ids), 65536):
+                _, V = cache.get(keys[start:start + 65536].tolist())
+                s_all = np.hstack([best_s, Q @ V.T])
+                i_all = np.hstack([best_i, np.broadcast_to(ids[start:start + 65536], (len(Q), len(V)))])
+                top = np.argpartition(-s_all, k - 1, axis=1)[:, :k]
+                best_s = np.take_along_axis(s_all, top, axis=1)
+                best_i = np.take_along_axis(i_all, top, axis=1)
+            truth = [set(row) for row in best_i.tolist()]
+            _, approx = self.index.search(Q, k)
+            order = np.argsort(ids)
+            def exact_rerank(cand: np.ndarray, qv: np.ndarray) -> List[int]:
+                cand = cand[cand >= 0]
+                pos = order[np.searchsorted(ids, cand, sorter=order)]
+                _, V = cache.get(keys[pos].tolist())
+                return cand[np.argsort(-(V @ qv), kind="stable")][:k].tolist()
+            _, wide = self.index.search(Q, k * max(RESCORE_FACTOR, 1))
+            rescored = [exact_rerank(cand, qv) for qv, cand in zip(Q, wide)]
+            recall = float(np.mean([len(t & set(a.tolist())) / k for t, a in zip(truth, approx)]))
+            recall_rs = float(np.mean([len(t & set(r)) / k for t, r in zip(truth, rescored)]))
+            return {"k": k, "queries": len(Q), "recall": round(recall, 4),
+                    "recall_rescored": round(recall_rs, 4), "rescore_factor": RESCORE_FACTOR}
+        finally:
+            cache.close()
+
+    def reconstruct(self, ids: List[int]) -> Optional[np.ndarray]:
+        """Stored vectors for the given chunk ids (approximate for PQ), or None if unavailable."""
+        if self.index is None or not len(ids):
+            return None
+        try:
+            return self.index.reconstruct_batch(np.asarray(ids, dtype="int64"))
+        except RuntimeError:
+            return None
+
+    def _hit(self, chunk_id: int, score: float) -> Optional[Dict]:
+        # only the winners are parsed out of meta.jsonl
+        item = self.meta.get(int(chunk_id))
+        if item is not None:
             item["score"] = float(score)
-            out.append(item)
-        return out
\ No newline at end of file
+        return item
@@ -0,0 +1,41 @@
+import asyncio
+
+from backend import app
+
+CONTEXT = "[1] Source: a.pdf page 1\nRefunds take 5 days to process."
+
+
+def _events(gen):
+    async def collect():
+        return [ev async for ev in gen]
+    return asyncio.run(collect())
+
+
+def test_grounder_holds_back_uncited_sentence():
+    g = app.StreamingGrounder(CONTEXT)
+    assert g.feed("Refunds take 5 ") == ""
+    assert g.feed("days [1]. Some") == "Refunds take 5 days [1]. "
+    assert g.feed(" made up claim") == ""
+    assert g.flush() == ""
+    assert g.violation and g.verdict()["answer"] == app.IDK
+
+
+def test_grounder_releases_cited_tail_on_flush():
+    g = app.StreamingGrounder(CONTEXT)
+    assert g.feed("Refunds take 5 days to process [1]") == ""
+    assert g.flush() == "Refunds take 5 days to process [1]"
+    assert g.verdict()["complete"] is True
+
+
+def test_ask_stream_marks_cut_off_answer_incomplete(monkeypatch):
+    async def failing_stream(question, context):
+        yield "Refunds take 5 days [1]. And"
+        raise TimeoutError("llm down")
+    monkeypatch.setattr(app, "GOOGLE_API_KEY", "key")
+    monkeypatch.setattr(app, "_gemini_stream", failing_stream)
+    events = _events(app._ask_stream("refunds?", CONTEXT, [], [], "a.pdf"))
+    assert [e for e, _ in events] == ["citations", "token", "verdict"]
+    assert events[1][1]["text"] == "Refunds take 5 days [1]. "
+    verdict = events[-1][1]
+    assert verdict["complete"] is False and verdict["grounded"] is False
+    assert verdict["error"] == "llm down"
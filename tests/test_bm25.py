@@ -0,0 +1,19 @@
+import numpy as np
+
+from backend.bm25 import BM25Index, share_collection_stats
+
+
+def test_shared_stats_match_one_index_over_the_union():
+    docs = [(1, "refund policy thirty days"), (2, "refund in five days"), (3, "shipping takes two days"),
+            (4, "password reset by email"), (5, "refund refund refund"), (6, "support hours")]
+    whole = BM25Index.build(docs)
+    shards = [BM25Index.build(docs[:2]), BM25Index.build(docs[2:])]
+    share_collection_stats(shards)
+    ids, scores = whole.search("refund days", 10)
+    expected = dict(zip(ids.tolist(), scores.tolist()))
+    got = {}
+    for s in shards:
+        ids, scores = s.search("refund days", 10)
+        got.update(zip(ids.tolist(), scores.tolist()))
+    assert got.keys() == expected.keys()
+    assert np.allclose([got[i] for i in expected], list(expected.values()))
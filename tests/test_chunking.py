@@ -0,0 +1,33 @@
+import random
+
+import pytest
+
+from backend.chunking import StreamChunker, Tokenizer, chunk_spans
+
+
+@pytest.fixture(scope="module")
+def regex_tokenizer(tmp_path_factory):
+    # an empty model directory: the tokenizer falls back to its regex approximation
+    return Tokenizer(str(tmp_path_factory.mktemp("no-model")))
+
+
+def _csv(rows: int) -> str:
+    rng = random.Random(0)
+    return "".join(",".join(str(rng.randint(0, 10**6)) for _ in range(8)) + "\n" for _ in range(rows))
+
+
+def _one_shot(text: str, tokenizer) -> list:
+    return [text[s:e] for s, e in chunk_spans(text, 128, 16, tokenizer)[0]]
+
+
+def test_unpunctuated_stream_keeps_buffer_bounded(regex_tokenizer):
+    text = _csv(5000)   # no sentence ends, no blank lines
+    chunker = StreamChunker(max_tokens=128, overlap_tokens=16, tokenizer=regex_tokenizer)
+    out, biggest = [], 0
+    for i in range(0, len(text), 16 * 1024):
+        out += chunker.feed(text[i:i + 16 * 1024])
+        biggest = max(biggest, len(chunker.buf))
+    out += chunker.finish()
+    assert biggest < 4096
+    assert out == _one_shot(text, regex_tokenizer)   # same chunks as splitting the whole text
+    assert all(len(regex_tokenizer.starts(c)) <= 128 - regex_tokenizer.special for c in out)
@@ -0,0 +1,15 @@
+import time
+
+from backend import ingest
+
+
+def test_extract_files_in_process_timeout_skips_file(monkeypatch):
+    def slow_or_fast(path, rel_path, pages=None):
+        if rel_path == "slow.pdf":
+            time.sleep(5)
+        return [{"path": rel_path}]
+
+    monkeypatch.setattr(ingest, "ingest_file", slow_or_fast)
+    files = [("raw/slow.pdf", "slow.pdf"), ("raw/ok.txt", "ok.txt")]
+    out = list(ingest.extract_files(files, workers=1, timeout=0.05))
+    assert out == [("slow.pdf", None), ("ok.txt", [{"path": "ok.txt"}])]
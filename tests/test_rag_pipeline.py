@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from backend.rag_pipeline import Answerer, RetrievalService
+
+
+class FlakyModel:
+    def __init__(self):
+        self.fail = True
+
+    def generate_content(self, prompt):
+        if self.fail:
+            raise TimeoutError("llm down")
+        return type("Resp", (), {"text": "from the model [1]"})()
+
+
+def _service():
+    svc = RetrievalService()
+    svc.answerer = Answerer()
+    svc.answerer.model = FlakyModel()
+    return svc
+
+
+def test_fallback_answer_is_not_cached():
+    svc = _service()
+    context = "[1] Source: a.pdf page 1\nRefunds take 5 days."
+    assert svc.answer("refunds?", context) == "Refunds take 5 days. [1]"
+    svc.answerer.model.fail = False
+    assert svc.answer("refunds?", context) == "from the model [1]"
+    svc.answerer.model.fail = True
+    assert svc.answer("refunds?", context) == "from the model [1]"   # the real answer is cached
+
+
+def test_async_fallback_answer_is_not_cached():
+    svc = _service()
+    context = "[1] Source: a.pdf page 1\nRefunds take 5 days."
+    assert asyncio.run(svc.aanswer("refunds?", context)) == "Refunds take 5 days. [1]"
+    assert len(svc.cache.answers) == 0
+
+
+class FakeStore:
+    def __init__(self, version):
+        self.version = version
+        self.model_name = "fake"
+
+    def encode(self, texts):
+        import numpy as np
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+    def search_vectors(self, q, top_k, queries=None, filters=None):
+        return [[{"id": 1, "content": self.version}] for _ in q]
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_search_returns_the_store_it_searched(monkeypatch, batched):
+    from backend.batching import MicroBatcher
+    svc = RetrievalService()
+    svc.batcher = MicroBatcher(svc._search_pinned, trim=lambda r, k: (r[0], r[1][:k])) if batched else None
+    old, new = FakeStore("old"), FakeStore("new")
+    stores = iter([old, new])
+    monkeypatch.setattr(svc, "store", lambda: next(stores))   # a reload lands right after the search
+    vs, hits = svc.search_with_store("q", 3)
+    assert vs is old and hits[0]["content"] == "old"
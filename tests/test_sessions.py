@@ -0,0 +1,33 @@
+import pytest
+
+from backend.jobs import JobQueue
+from backend.sessions import FileBackend, SessionStore, SqliteBackend
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def two_workers(request, tmp_path):
+    if request.param == "file":
+        make = lambda: FileBackend(root=str(tmp_path / "sessions"))
+    else:
+        make = lambda: SqliteBackend(path=str(tmp_path / "sessions.sqlite"))
+    return SessionStore(backend=make()), SessionStore(backend=make())
+
+
+def test_indexing_session_is_refreshed_from_other_worker(two_workers):
+    a, b = two_workers
+    a.put("s", {"chunks": ["page1"], "meta": {"indexing": True}})
+    assert b.get("s")["chunks"] == ["page1"]
+    a.put("s", {"chunks": ["page1", "page2"], "meta": {"indexing": True}})
+    assert b.get("s")["chunks"] == ["page1", "page2"]
+    a.put("s", {"chunks": ["page1", "page2", "page3"], "meta": {"indexing": False}})
+    assert b.get("s") == {"chunks": ["page1", "page2", "page3"], "meta": {"indexing": False}}
+
+
+def test_job_status_visible_to_other_worker(two_workers):
+    a, b = two_workers
+    queue = JobQueue(workers=1, on_change=lambda job: a.put_status(job.id, job.snapshot()))
+    job = queue.submit(lambda job: job.update(chunks=3) or "ok", job_id="j1")
+    job.future.result()
+    status = b.get_status("j1")
+    assert status["status"] == "done" and status["chunks"] == 3
+    assert b.get_status("missing") is None